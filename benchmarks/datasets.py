@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Synthetic protein datasets for the biobb_bioml benchmarks.
+
+Every generator is seeded so two commits benchmarked on the same host read identical inputs.
+"""
+import csv
+import zipfile
+from pathlib import Path
+import numpy as np
+
+AMINO_ACIDS = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+# Background frequencies of the amino acids in UniProt, in the order of AMINO_ACIDS
+FREQUENCIES = np.array([8.25, 1.38, 5.46, 6.72, 3.86, 7.07, 2.27, 5.91, 5.80, 9.65,
+                        2.41, 4.06, 4.74, 3.93, 5.53, 6.64, 5.35, 6.86, 1.10, 2.92])
+FREQUENCIES = FREQUENCIES / FREQUENCIES.sum()
+SCALES = {
+    "1k": {"sequences": 1000, "features": 1000},
+    "10k": {"sequences": 10000, "features": 5000},
+    "100k": {"sequences": 100000, "features": 20000},
+}
+
+
+def write_fasta(path: str, sequences: int, seed: int = 0, min_length: int = 50, max_length: int = 500) -> str:
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(min_length, max_length, size=sequences)
+    with open(path, "w") as fasta:
+        for index, length in enumerate(lengths):
+            fasta.write(f">seq{index}\n{''.join(rng.choice(AMINO_ACIDS, size=length, p=FREQUENCIES))}\n")
+    return path
+
+
+def read_fasta(path: str):
+    name, chunks = None, []
+    with open(path) as fasta:
+        for line in fasta:
+            line = line.strip()
+            if line.startswith(">"):
+                if name:
+                    yield name, "".join(chunks)
+                name, chunks = line[1:].split()[0], []
+            elif line:
+                chunks.append(line)
+    if name:
+        yield name, "".join(chunks)
+
+
+def write_pssm_zip(path: str, fasta_path: str, seed: int = 0) -> str:
+    """Zip one PSI-BLAST like ASCII PSSM per sequence in pssm/<id>.pssm."""
+    rng = np.random.default_rng(seed)
+    header = "           " + "  ".join(AMINO_ACIDS)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as pssm_zip:
+        for name, sequence in read_fasta(fasta_path):
+            scores = rng.integers(-5, 9, size=(len(sequence), 20))
+            rows = [f"{position + 1:5d} {residue}   " + " ".join(f"{score:3d}" for score in row)
+                    for position, (residue, row) in enumerate(zip(sequence, scores))]
+            pssm_zip.writestr(f"pssm/{name}.pssm", "\nLast position-specific scoring matrix computed\n"
+                              + header + "\n" + "\n".join(rows) + "\n")
+    return path
+
+
+def write_features(path: str, rows: int, features: int, seed: int = 0, chunk_rows: int = 1000) -> str:
+    """Random feature matrix with a header and the sequence names in the first column, written by chunks."""
+    rng = np.random.default_rng(seed)
+    with open(path, "w", newline="") as features_file:
+        writer = csv.writer(features_file)
+        writer.writerow([""] + [f"feature_{column}" for column in range(features)])
+        for start in range(0, rows, chunk_rows):
+            block = rng.standard_normal((min(chunk_rows, rows - start), features)).astype(np.float32)
+            writer.writerows([f"seq{start + index}"] + [f"{value:.4f}" for value in row] for index, row in enumerate(block))
+    return path
+
+
+def write_labels(path: str, rows: int, seed: int = 0) -> str:
+    rng = np.random.default_rng(seed)
+    with open(path, "w", newline="") as labels_file:
+        writer = csv.writer(labels_file)
+        writer.writerow(["", "label"])
+        writer.writerows([f"seq{index}", label] for index, label in enumerate(rng.integers(0, 2, size=rows)))
+    return path
+
+
+def write_metrics(path: str, candidates: int, seed: int = 0) -> str:
+    """Metrics table with the layout read by the Rerank block."""
+    from biobb_bioml.bioml.rerank import SPLITS, METRICS
+    rng = np.random.default_rng(seed)
+    columns = [f"{split}_{metric}" for split in SPLITS for metric in METRICS]
+    with open(path, "w", newline="") as metrics_file:
+        writer = csv.writer(metrics_file)
+        writer.writerow(["candidate"] + columns)
+        writer.writerows([f"candidate{index}"] + [f"{value:.4f}" for value in row]
+                         for index, row in enumerate(rng.random((candidates, len(columns)))))
+    return path
+
+
+def build(workdir: str, scale: str, seed: int = 0) -> dict:
+    """Write every input of the suite for one scale, reusing the files of a previous run."""
+    sizes = SCALES[scale]
+    directory = Path(workdir).joinpath(scale)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = {name: str(directory.joinpath(name)) for name in
+             ("input.fasta", "pssm.zip", "features.csv", "labels.csv", "metrics.csv", "hyperparameters.csv")}
+    if not Path(paths["input.fasta"]).exists():
+        write_fasta(paths["input.fasta"], sizes["sequences"], seed)
+        write_pssm_zip(paths["pssm.zip"], paths["input.fasta"], seed)
+        write_features(paths["features.csv"], sizes["sequences"], sizes["features"], seed)
+        write_labels(paths["labels.csv"], sizes["sequences"], seed)
+        write_metrics(paths["metrics.csv"], sizes["features"], seed)
+        with open(paths["hyperparameters.csv"], "w") as hyperparameters:
+            hyperparameters.write("model,parameters\nlr,{}\n")
+    return {"directory": str(directory), **sizes, **paths}
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+"""Validation report of the float32 precision mode against float64.
+
+``compare`` reads the metrics tables (output_metrics of Model_training or Ensemble) of the same
+training run with dtype float64 and float32 and reports, for every metric, the largest and mean
+absolute differences and how much the ranking of the candidates moved. ``synthetic`` checks the
+numerics on the benchmark datasets without BioML: the features are scaled and a ridge classifier is
+fitted in both precisions, then the predictions and the MCC are compared. Usage::
+
+    python benchmarks/precision.py compare metrics_float64.csv metrics_float32.csv --output report.json
+    python benchmarks/precision.py synthetic --scale 10k --workdir benchmark_data
+"""
+import argparse
+import json
+import numpy as np
+import datasets
+from biobb_bioml.bioml.rerank import read_metrics, rank_scores
+
+
+def compare_metrics(reference_path: str, candidate_path: str, top: int = 10) -> dict:
+    reference_names, reference = read_metrics(reference_path)
+    candidate_names, candidate = read_metrics(candidate_path)
+    order = [candidate_names.index(name) for name in reference_names]
+    report = {"candidates": len(reference_names), "metrics": {}}
+    for column, values in reference.items():
+        difference = np.abs(values - candidate[column][order])
+        report["metrics"][column] = {"max_abs_diff": round(float(difference.max(initial=0)), 6),
+                                     "mean_abs_diff": round(float(difference.mean()) if difference.size else 0.0, 6)}
+    reference_rank = np.argsort(-rank_scores(reference), kind="stable")
+    candidate_rank = np.argsort(-rank_scores({column: values[order] for column, values in candidate.items()}), kind="stable")
+    report["same_best_candidate"] = bool(reference_rank[:1].tolist() == candidate_rank[:1].tolist())
+    report[f"top{top}_overlap"] = len(set(reference_rank[:top]) & set(candidate_rank[:top]))
+    return report
+
+
+def mcc(truth: np.ndarray, predicted: np.ndarray) -> float:
+    tp = float(np.sum(truth & predicted))
+    tn = float(np.sum(~truth & ~predicted))
+    fp = float(np.sum(~truth & predicted))
+    fn = float(np.sum(truth & ~predicted))
+    denominator = np.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+    return (tp * tn - fp * fn) / denominator if denominator else 0.0
+
+
+def fit_predict(features: np.ndarray, labels: np.ndarray, dtype, alpha: float = 1.0):
+    features = features.astype(dtype)
+    split = int(len(features) * 0.8)
+    mean, std = features[:split].mean(axis=0), features[:split].std(axis=0)
+    scaled = (features - mean) / np.where(std > 0, std, 1).astype(dtype)
+    train, test = scaled[:split], scaled[split:]
+    target = (labels[:split] * 2 - 1).astype(dtype)
+    weights = np.linalg.solve(train.T @ train + alpha * np.eye(train.shape[1], dtype=dtype), train.T @ target)
+    return test @ weights, labels[split:].astype(bool)
+
+
+def synthetic(workdir: str, scale: str, features: int = None) -> dict:
+    data = datasets.build(workdir, scale)
+    matrix = np.loadtxt(data["features.csv"], delimiter=",", skiprows=1, usecols=range(1, (features or data["features"]) + 1))
+    labels = np.loadtxt(data["labels.csv"], delimiter=",", skiprows=1, usecols=1).astype(int)
+    # A signal on the first features so the classifier has something to learn
+    matrix[:, :10] += labels[:, None] * 0.5
+    scores = {}
+    for dtype in (np.float64, np.float32):
+        decision, truth = fit_predict(matrix, labels, dtype)
+        scores[np.dtype(dtype).name] = {"decision": decision.astype(np.float64), "mcc": mcc(truth, decision > 0),
+                                        "matrix_mb": round(matrix.astype(dtype).nbytes / 2**20, 1)}
+    reference, candidate = scores["float64"], scores["float32"]
+    return {"scale": scale, "rows": matrix.shape[0], "features": matrix.shape[1],
+            "mcc_float64": round(reference["mcc"], 6), "mcc_float32": round(candidate["mcc"], 6),
+            "max_abs_decision_diff": float(np.abs(reference["decision"] - candidate["decision"]).max()),
+            "changed_predictions": int(np.sum((reference["decision"] > 0) != (candidate["decision"] > 0))),
+            "matrix_mb_float64": reference["matrix_mb"], "matrix_mb_float32": candidate["matrix_mb"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the float32 precision mode of biobb_bioml with float64.")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument('reference', help="Metrics table of the float64 run")
+    compare_parser.add_argument('candidate', help="Metrics table of the float32 run")
+    compare_parser.add_argument('--output')
+    synthetic_parser = subparsers.add_parser("synthetic")
+    synthetic_parser.add_argument('--scale', default="1k", choices=list(datasets.SCALES))
+    synthetic_parser.add_argument('--features', type=int, help="Only use the first features, the ridge solve is cubic in them")
+    synthetic_parser.add_argument('--workdir', default="benchmark_data")
+    synthetic_parser.add_argument('--output')
+    args = parser.parse_args()
+
+    if args.mode == "compare":
+        report = compare_metrics(args.reference, args.candidate)
+    else:
+        report = synthetic(args.workdir, args.scale, args.features)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=4)
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()
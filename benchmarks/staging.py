@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+"""Bytes copied and time spent staging a large input with every staging strategy.
+
+The input is made read-only, as the inputs shared by several runs should be, so "link" can fall
+back to a hardlink where reflinks are not supported. The method actually used is reported.
+
+Usage::
+
+    python benchmarks/staging.py --size_mb 2048 --workdir /scratch/bench
+"""
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml.rerank import Rerank
+
+
+def stage_once(input_path: str, strategy: str) -> dict:
+    # Any block does, only its staging is exercised
+    block = Rerank(input_metrics=input_path, output_ranking="ranking.csv", properties={"staging": strategy})
+    start = time.perf_counter()
+    com.stage_files(block)
+    elapsed = time.perf_counter() - start
+    block.tmp_files.append(block.stage_io_dict["unique_dir"])
+    block.remove_tmp_files()
+    report = block.staging_report
+    return {"strategy": strategy, "method": report["methods"].get("input_metrics"), "seconds": round(elapsed, 4),
+            "copied_bytes": report["copied_bytes"], "linked_bytes": report["linked_bytes"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the staging strategies of the biobb_bioml blocks.")
+    parser.add_argument('--size_mb', type=int, default=512)
+    parser.add_argument('--workdir', default=".")
+    args = parser.parse_args()
+
+    os.chdir(args.workdir)
+    input_path = str(Path("staging_benchmark.fasta").resolve())
+    with open(input_path, "wb") as input_file:
+        for _ in range(args.size_mb):
+            input_file.write(os.urandom(2**20))
+    # A writable input is copied by the "link" strategy, a command could edit it through a hardlink
+    os.chmod(input_path, 0o444)
+    try:
+        results = [stage_once(input_path, strategy) for strategy in ("copy", "link", "symlink")]
+    finally:
+        os.remove(input_path)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Stand-in for the BioML command lines used by the benchmarks when BioML, POSSUM, iFeature or PSI-BLAST are missing.
+
+It reads every input of the command line, does work proportional to their size (parsing, column statistics
+and a gram matrix) and writes the outputs the wrappers expect, so the wrapper overheads are measured
+on realistic input sizes.
+"""
+import sys
+import zipfile
+from pathlib import Path
+import numpy as np
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def parse_args(argv):
+    args = {}
+    for index, token in enumerate(argv):
+        if token.startswith("-") and index + 1 < len(argv) and not argv[index + 1].startswith("-"):
+            args[token] = argv[index + 1]
+    return args
+
+
+def read_fasta(path):
+    sequences, name = {}, None
+    with open(path) as fasta:
+        for line in fasta:
+            if line.startswith(">"):
+                name = line[1:].split()[0]
+                sequences[name] = []
+            elif name:
+                sequences[name].append(line.strip())
+    return {name: "".join(chunks) for name, chunks in sequences.items()}
+
+
+def composition(sequence):
+    codes = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    return np.array([np.count_nonzero(codes == ord(residue)) for residue in AMINO_ACIDS]) / max(len(codes), 1)
+
+
+def read_matrix(path):
+    with open(path) as table:
+        header = table.readline().rstrip("\n").split(",")
+        numeric = [line.rstrip("\n").split(",", 1)[-1] for line in table if line.strip()]
+    if not numeric:
+        return np.zeros((0, len(header) - 1))
+    return np.loadtxt(numeric, delimiter=",", ndmin=2)
+
+
+def consume(path):
+    """Read an input and return a summary matrix, the cost grows with its size."""
+    suffix = Path(path).suffix
+    if suffix in (".fasta", ".fa", ".faa"):
+        return np.array([composition(sequence) for sequence in read_fasta(path).values()])
+    if suffix == ".zip":
+        with zipfile.ZipFile(path) as archive:
+            return np.array([[len(archive.read(member))] for member in archive.namelist()], dtype=float)
+    if suffix in (".csv", ".xlsx"):
+        try:
+            return read_matrix(path)
+        except ValueError:
+            pass
+    return np.frombuffer(Path(path).read_bytes(), dtype=np.uint8)[:, None].astype(float)
+
+
+def run(file_outputs=(), dir_outputs=()):
+    args = parse_args(sys.argv[1:])
+    summaries = [consume(value) for flag, value in args.items() if flag not in file_outputs and Path(value).is_file()]
+    stats = []
+    for matrix in summaries:
+        if matrix.size:
+            # Column statistics and a gram matrix of the first columns, like the scalers and models of BioML
+            head = matrix[:, :256]
+            stats.append(np.concatenate([matrix.mean(axis=0)[:256], matrix.std(axis=0)[:256],
+                                         (head.T @ head).ravel()[:256]]))
+    summary = np.concatenate(stats) if stats else np.zeros(1)
+    for flag in file_outputs:
+        if args.get(flag):
+            Path(args[flag]).parent.mkdir(parents=True, exist_ok=True)
+            np.savetxt(args[flag], summary[None, :], delimiter=",", fmt="%.6f")
+    for flag in dir_outputs:
+        if args.get(flag):
+            Path(args[flag]).mkdir(parents=True, exist_ok=True)
+            np.savetxt(Path(args[flag]).joinpath("summary.csv"), summary[None, :], delimiter=",", fmt="%.6f")
+    return args
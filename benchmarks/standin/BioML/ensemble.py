@@ -0,0 +1,9 @@
+from BioML import _standin
+
+
+def main():
+    _standin.run(file_outputs=("--metrics_table",), dir_outputs=("--ensemble_output",))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+from BioML import _standin
+
+
+def main():
+    _standin.run(file_outputs=("--excel",), dir_outputs=())
+
+
+if __name__ == "__main__":
+    main()
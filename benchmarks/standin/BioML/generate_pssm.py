@@ -0,0 +1,17 @@
+from pathlib import Path
+import numpy as np
+from BioML import _standin
+
+
+def main():
+    args = _standin.run()
+    # The wrapper zips the pssm folder next to the staged fasta
+    pssm_dir = Path(args["--i"]).parent.joinpath("pssm")
+    pssm_dir.mkdir(exist_ok=True)
+    for name, sequence in _standin.read_fasta(args["--i"]).items():
+        scores = np.round(np.outer(np.ones(len(sequence)), _standin.composition(sequence)) * 20 - 5).astype(int)
+        np.savetxt(pssm_dir.joinpath(f"{name}.pssm"), scores, fmt="%3d")
+
+
+if __name__ == "__main__":
+    main()
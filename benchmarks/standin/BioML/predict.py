@@ -0,0 +1,9 @@
+from BioML import _standin
+
+
+def main():
+    _standin.run(file_outputs=(), dir_outputs=("--res_dir",))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+"""Reproducible benchmark of every biobb_bioml block on synthetic protein datasets.
+
+The datasets are generated once per scale (see datasets.SCALES) and every block is run through its
+Python API with the telemetry of the package, recording latency, throughput (sequences per second)
+and the peak memory of the command. Unless --real is given the BioML command lines are served by
+the stand-ins of benchmarks/standin, so no POSSUM, iFeature or PSI-BLAST installation is needed and
+the numbers measure the wrappers (staging, zipping, caching...) on realistic input sizes. Usage::
+
+    python benchmarks/suite.py run --scales 1k 10k --output results_new.json
+    python benchmarks/suite.py compare results_old.json results_new.json --tolerance 0.1
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+import datasets
+from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import telemetry
+
+STANDIN = str(Path(__file__).resolve().parent.joinpath("standin"))
+BLOCKS = {
+    "generate_pssm": lambda data: {"input_fasta": data["input.fasta"], "output_pssm": "pssm.zip"},
+    "feature_extraction": lambda data: {"input_fasta": data["input.fasta"], "pssm": data["pssm.zip"],
+                                        "every_features": "every_features.csv", "new_features": "new_features.xlsx"},
+    "feature_selection": lambda data: {"input_features": data["features.csv"], "label": data["labels.csv"],
+                                       "output_excel": "selected_features.csv", "output_zip": "shap_features.zip"},
+    "outlier": lambda data: {"input_excel": data["features.csv"], "output_outlier": "outliers.csv"},
+    "model_training": lambda data: {"input_excel": data["features.csv"], "label": data["labels.csv"],
+                                    "hyperparameters": "hyperparameters.zip", "training_output": "training.zip",
+                                    "output_metrics": "metrics.csv"},
+    "generate_model": lambda data: {"input_excel": data["features.csv"], "input_hyperparameter": data["hyperparameters.csv"],
+                                    "sheets": "1", "label": data["labels.csv"], "output_model": "models.zip"},
+    "ensemble": lambda data: {"input_excel": data["features.csv"], "input_hyperparameter": data["hyperparameters.csv"],
+                              "sheets": "1", "label": data["labels.csv"], "output_ensemble": "ensemble.zip"},
+    "predict": lambda data: {"input_excel": data["features.csv"], "extracted": data["features.csv"],
+                             "input_fasta": data["input.fasta"], "output_model": "models.zip"},
+    "rerank": lambda data: {"input_metrics": data["metrics.csv"], "output_ranking": "ranking.csv"},
+}
+
+
+def run_block(block: str, data: dict, workdir: str, properties: dict) -> dict:
+    """Run a block once in a clean directory and return its telemetry record."""
+    function = getattr(importlib.import_module(f"biobb_bioml.bioml.{block}"), block)
+    run_dir = tempfile.mkdtemp(prefix=f"{block}_", dir=workdir)
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+    try:
+        function(**BLOCKS[block](data), properties={**properties, "telemetry_dir": "telemetry"})
+        return telemetry.load_records(["telemetry"])[0]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def benchmark(scales, blocks, repeats: int, workdir: str, properties: dict) -> list:
+    results = []
+    for scale in scales:
+        data = datasets.build(workdir, scale)
+        for block in blocks:
+            records = [run_block(block, data, workdir, properties) for _ in range(repeats)]
+            latency = statistics.median(record["wall_time"] for record in records)
+            results.append({"block": block, "scale": scale, "sequences": data["sequences"], "features": data["features"],
+                            "repeats": repeats, "return_code": max(record["return_code"] or 0 for record in records),
+                            "latency_s": round(latency, 4),
+                            "command_s": round(statistics.median(record["phases"].get("command", 0) for record in records), 4),
+                            "throughput_seq_per_s": round(data["sequences"] / latency, 2) if latency else None,
+                            "peak_rss_mb": max(record.get("peak_rss_mb", 0) for record in records)})
+            print(json.dumps(results[-1]))
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path: str, new_path: str, tolerance: float) -> int:
+    """Print the blocks whose latency or peak memory grew more than tolerance and return how many."""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    baseline = {(result["block"], result["scale"]): result for result in old["results"]}
+    regressions = 0
+    for result in new["results"]:
+        reference = baseline.get((result["block"], result["scale"]))
+        if not reference:
+            continue
+        for metric in ("latency_s", "peak_rss_mb"):
+            before, after = reference.get(metric) or 0, result.get(metric) or 0
+            change = (after - before) / before if before else 0.0
+            flag = "REGRESSION" if change > tolerance else "ok"
+            regressions += flag == "REGRESSION"
+            print(f"{flag:10} {result['block']:20} {result['scale']:5} {metric:12} {before:>10} -> {after:<10} ({change:+.1%})")
+    print(f"{regressions} regressions between {old.get('commit')} and {new.get('commit')}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the biobb_bioml blocks on synthetic protein datasets.")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument('--scales', nargs='+', default=["1k"], choices=list(datasets.SCALES))
+    run_parser.add_argument('--blocks', nargs='+', default=list(BLOCKS), choices=list(BLOCKS))
+    run_parser.add_argument('--repeats', type=int, default=3)
+    run_parser.add_argument('--workdir', default="benchmark_data", help="Where the datasets are generated and kept between runs")
+    run_parser.add_argument('--backend', default="subprocess", choices=["subprocess", "inprocess"])
+    run_parser.add_argument('--real', action='store_true', help="Run the installed BioML instead of the stand-ins")
+    run_parser.add_argument('--output', default="benchmark_results.json")
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1, help="Relative growth reported as a regression")
+    args = parser.parse_args()
+
+    if args.mode == "compare":
+        raise SystemExit(1 if compare(args.old, args.new, args.tolerance) else 0)
+
+    properties = {"backend": args.backend}
+    if not args.real:
+        # The child command lines and the in-process backend import BioML from the stand-ins
+        os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [STANDIN, os.environ.get("PYTHONPATH")]))
+        sys.path.insert(0, STANDIN)
+    Path(args.workdir).mkdir(parents=True, exist_ok=True)
+    workdir = str(Path(args.workdir).resolve())
+    results = benchmark(args.scales, args.blocks, args.repeats, workdir, properties)
+    with open(args.output, "w") as output:
+        json.dump({"commit": git_commit(), "python": platform.python_version(), "host_cores": com.host_cores(),
+                   "standin": not args.real, "backend": args.backend, "results": results}, output, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+"""Throughput of parallel BLAS workers with and without the biobb_bioml thread budget.
+
+Every worker process multiplies random matrices in a loop, like the joblib workers spawned by
+the BioML blocks. Without limits each worker opens one BLAS thread per core, with the budget the
+cores are split between the workers. Usage::
+
+    python benchmarks/thread_budget.py --workers 40 --size 512 --seconds 20
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from biobb_bioml.bioml import common as com
+
+WORKER = """
+import time, numpy as np
+a = np.random.rand({size}, {size})
+done, end = 0, time.perf_counter() + {seconds}
+while time.perf_counter() < end:
+    a @ a
+    done += 1
+print(done)
+"""
+
+
+def run_workers(workers: int, size: int, seconds: float, env: dict) -> float:
+    """Launch the workers at once and return the total matrix products per second."""
+    code = WORKER.format(size=size, seconds=seconds)
+    base_env = {name: value for name, value in os.environ.items() if name not in com.BLAS_THREAD_VARS}
+    start = time.perf_counter()
+    processes = [subprocess.Popen([sys.executable, "-c", code], env={**base_env, **env}, stdout=subprocess.PIPE)
+                 for _ in range(workers)]
+    done = sum(int(process.communicate()[0]) for process in processes)
+    return done / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BLAS oversubscription between parallel workers.")
+    parser.add_argument('--workers', type=int, default=com.host_cores())
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    _, threads = com.thread_budget(args.workers)
+    results = {"workers": args.workers, "cores": com.host_cores(), "threads_per_worker": threads,
+               "unlimited_products_per_s": round(run_workers(args.workers, args.size, args.seconds, {}), 2),
+               "budget_products_per_s": round(run_workers(args.workers, args.size, args.seconds, com.limit_threads_env(threads)), 2)}
+    results["speedup"] = round(results["budget_products_per_s"] / max(results["unlimited_products_per_s"], 1e-9), 2)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
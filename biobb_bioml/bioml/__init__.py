@@ -1,2 +1,2 @@
 name = "bioml"
-__all__ = ["ensemble", "feature_extraction", "feature_selection", "generate_model", "model_training", "outlier", "predict"]
\ No newline at end of file
+__all__ = ["ensemble", "feature_extraction", "feature_selection", "generate_model", "generate_pssm", "model_training", "outlier", "predict", "rerank"]
\ No newline at end of file
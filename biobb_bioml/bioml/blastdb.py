@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Module containing the fingerprinted and locked build of the BLAST databases used by Generate_pssm."""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import typing
+from contextlib import contextmanager
+from pathlib import Path
+from biobb_common.tools import file_utils as fu
+
+# Files written by makeblastdb for a single volume (.pin) or a multi volume (.pal) protein database
+DATABASE_SUFFIXES = (".pin", ".pal")
+
+
+def headers_hash(fasta: str, block_size: int = 2**20) -> str:
+    """Hash of the header lines of a fasta, enough to tell two releases of a database apart."""
+    digest = hashlib.sha1()
+    with open(fasta, "rb") as fasta_file:
+        tail = b""
+        while True:
+            block = fasta_file.read(block_size)
+            if not block:
+                break
+            lines = (tail + block).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                if line.startswith(b">"):
+                    digest.update(line)
+        if tail.startswith(b">"):
+            digest.update(tail)
+    return digest.hexdigest()
+
+
+def fingerprint_path(dbout: str) -> Path:
+    return Path(f"{dbout}.fingerprint.json")
+
+
+def read_fingerprint(dbout: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    try:
+        with open(fingerprint_path(dbout)) as fingerprint_file:
+            return json.load(fingerprint_file)
+    except (OSError, ValueError):
+        return None
+
+
+def is_up_to_date(dbinp: str, dbout: str) -> bool:
+    """True when dbout was built by this module from the current contents of dbinp.
+
+    The size and modification time are compared first, the header hash is only computed when the
+    file was touched without changing its size.
+    """
+    stored = read_fingerprint(dbout)
+    if not stored or not any(Path(f"{dbout}{suffix}").exists() for suffix in DATABASE_SUFFIXES):
+        return False
+    stat = Path(dbinp).stat()
+    if stored.get("dbinp") != str(Path(dbinp).resolve()) or stored.get("size") != stat.st_size:
+        return False
+    if stored.get("mtime_ns") == stat.st_mtime_ns:
+        return True
+    return stored.get("headers_sha1") == headers_hash(dbinp)
+
+
+def source_fingerprint(dbinp: str) -> typing.Dict[str, typing.Any]:
+    """Path, size and modification time of the fasta of a database, cheap enough to compute on every launch."""
+    stat = Path(dbinp).stat()
+    return {"dbinp": str(Path(dbinp).resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def write_fingerprint(dbinp: str, dbout: str) -> None:
+    fingerprint = {**source_fingerprint(dbinp), "headers_sha1": headers_hash(dbinp)}
+    tmp_path = Path(f"{fingerprint_path(dbout)}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as fingerprint_file:
+        json.dump(fingerprint, fingerprint_file, indent=4)
+    os.replace(tmp_path, fingerprint_path(dbout))
+
+
+def build_database(dbinp: str, dbout: str, makeblastdb_path: str = "makeblastdb",
+                   out_log: logging.Logger = None, global_log: logging.Logger = None) -> int:
+    cmd = [makeblastdb_path, "-in", dbinp, "-dbtype", "prot", "-out", dbout]
+    fu.log(f'Building the BLAST database: {" ".join(cmd)}', out_log, global_log)
+    process = subprocess.run(cmd, capture_output=True, text=True)
+    if process.stdout and out_log:
+        out_log.info(process.stdout)
+    if process.returncode:
+        fu.log(f'makeblastdb failed with exit code {process.returncode}: {process.stderr}', out_log, global_log)
+    return process.returncode
+
+
+@contextmanager
+def database(dbinp: str, dbout: str, makeblastdb_path: str = "makeblastdb",
+             out_log: logging.Logger = None, global_log: logging.Logger = None) -> typing.Iterator[None]:
+    """Make sure dbout is an up to date database of dbinp and keep it from being rebuilt while in use.
+
+    The check and the build run under an exclusive lock on <dbout>.lock so concurrent runs sharing
+    the database build it only once, the lock is then downgraded to a shared one until the caller
+    finishes searching the database.
+    """
+    Path(dbout).parent.mkdir(parents=True, exist_ok=True)
+    with open(f"{dbout}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if is_up_to_date(dbinp, dbout):
+                fu.log(f'The BLAST database {dbout} is up to date with {dbinp}, skipping the build', out_log, global_log)
+            else:
+                if fingerprint_path(dbout).exists():
+                    fingerprint_path(dbout).unlink()
+                if build_database(dbinp, dbout, makeblastdb_path, out_log, global_log):
+                    raise RuntimeError(f"makeblastdb could not build {dbout} from {dbinp}")
+                write_fingerprint(dbinp, dbout)
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
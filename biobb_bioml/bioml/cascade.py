@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+"""Module containing the early exit (cascade) evaluation of the models of Predict.
+
+A sample is positive when at least prediction_threshold of the models vote for it, so once the
+votes already counted reach that share, or the models left can not reach it any more, the rest of
+the models can not change the prediction. The models are ordered from the cheapest to the most
+expensive and every batch of samples only goes through the models while some of its samples are
+still undecided, giving the same predictions as evaluating every model on every sample.
+
+Generate_model fits every model on the features of its own sheet, so every model is given the
+columns of its sheet, scaled like them. A model belongs to the sheet named by a folder of its path
+or by the prefix of its file name (``<sheet>_<fold>``), a workbook of several sheets whose models
+can not be told apart is refused.
+"""
+import csv
+import math
+import time
+import typing
+from pathlib import Path
+import numpy as np
+from biobb_common.tools import file_utils as fu
+from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import projection
+from biobb_bioml.bioml import sketch
+try:
+    import joblib
+except ImportError:
+    joblib = None
+try:
+    from sklearn import preprocessing
+except ImportError:
+    preprocessing = None
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+MODEL_SUFFIXES = (".joblib", ".pkl")
+SCALER_NAME = "scaler.npz"
+SCALERS = {"robust": "RobustScaler", "standard": "StandardScaler", "minmax": "MinMaxScaler"}
+
+
+def load_models(model_dir: str) -> typing.Dict[str, typing.Any]:
+    """Every model saved with joblib below model_dir, by file name."""
+    if joblib is None:
+        raise ImportError("joblib is needed to load the models of the cascade prediction")
+    paths = sorted(path for path in Path(model_dir).rglob("*") if path.suffix in MODEL_SUFFIXES)
+    models = {str(path.relative_to(model_dir)): joblib.load(path) for path in paths}
+    models = {name: model for name, model in models.items() if hasattr(model, "predict")}
+    if not models:
+        raise ValueError(f"No models with a predict method in {model_dir}")
+    return models
+
+
+def read_table(path: str, sheet: str = None) -> typing.Tuple[typing.List[str], typing.List[str], np.ndarray]:
+    """Ids, column names and values of a feature table, a CSV or a sheet of an Excel file (first sheet by default)."""
+    if Path(path).suffix == ".csv":
+        with open(path, newline="") as table:
+            rows = [row for row in csv.reader(table) if row]
+    else:
+        if openpyxl is None:
+            raise ImportError(f"openpyxl is needed to read {path}")
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        worksheet = workbook[sheet] if sheet else workbook.worksheets[0]
+        rows = [["" if value is None else str(value) for value in row] for row in worksheet.iter_rows(values_only=True)]
+        workbook.close()
+    values = np.array([row[1:] for row in rows[1:]], dtype=float).reshape(len(rows) - 1, len(rows[0]) - 1)
+    return [row[0] for row in rows[1:]], rows[0][1:], values
+
+
+def sheet_columns(path: str, sheets: str = None) -> typing.Dict[typing.Optional[str], typing.List[str]]:
+    """Feature columns of every sheet of a feature table by sheet name, the given sheets or all of them.
+
+    A CSV table is a single sheet named None.
+    """
+    if Path(path).suffix == ".csv":
+        return {None: projection.selected_columns(path)}
+    if openpyxl is None:
+        raise ImportError(f"openpyxl is needed to read {path}")
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    names = [sheet for sheet, _ in com.parse_sheets(sheets)] if sheets else workbook.sheetnames
+    columns = {}
+    for name in dict.fromkeys(names):
+        worksheet = workbook.worksheets[int(name)] if name.isdigit() else workbook[name]
+        header = next(worksheet.iter_rows(max_row=1, values_only=True), ())
+        columns[worksheet.title] = [str(column) for column in header[1:] if column is not None]
+    workbook.close()
+    return columns
+
+
+def models_by_sheet(models: typing.Dict[str, typing.Any], sheets: typing.Sequence[typing.Optional[str]]) -> typing.Dict[typing.Optional[str], typing.Dict[str, typing.Any]]:
+    """Split the models by the sheet they were fitted on, from a folder of their path or the prefix of their file name."""
+    if len(sheets) == 1:
+        return {sheets[0]: dict(models)}
+    grouped: typing.Dict[typing.Optional[str], typing.Dict[str, typing.Any]] = {sheet: {} for sheet in sheets}
+    unknown = []
+    for name, model in models.items():
+        parts = Path(name).parts
+        owners = [sheet for sheet in sheets if sheet in parts[:-1] or Path(parts[-1]).stem.startswith(f"{sheet}_")]
+        if len(owners) != 1:
+            unknown.append(name)
+            continue
+        grouped[owners[0]][name] = model
+    if unknown:
+        raise ValueError(f"The features of {len(sheets)} sheets can not be given to the models {unknown[:10]}, "
+                         f"their sheet is not a folder of their path nor the prefix of their name")
+    return {sheet: sheet_models for sheet, sheet_models in grouped.items() if sheet_models}
+
+
+class SheetModel:
+    """A model given the block of columns of its sheet out of the features of every sheet side by side."""
+
+    def __init__(self, model: typing.Any, columns: slice) -> None:
+        self.model = model
+        self.columns = columns
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        return self.model.predict(features[:, self.columns])
+
+    def predict_proba(self, features: np.ndarray) -> np.ndarray:
+        return self.model.predict_proba(features[:, self.columns])
+
+
+def sheet_features(columns: typing.Dict[typing.Optional[str], typing.List[str]], models: typing.Dict[str, typing.Any],
+                   scale: typing.Callable[[typing.Optional[str], typing.List[str]], np.ndarray]) -> typing.Tuple[np.ndarray, typing.List[str], typing.Dict[str, typing.Any]]:
+    """The scaled features of every sheet side by side, their names and the models wrapped to read the block of their sheet.
+
+    scale returns the scaled values of the columns of a sheet.
+    """
+    grouped = models_by_sheet(models, list(columns))
+    blocks, names, wrapped, start = [], [], {}, 0
+    for sheet, sheet_models in grouped.items():
+        blocks.append(scale(sheet, columns[sheet]))
+        names.extend(columns[sheet])
+        block = slice(start, start + len(columns[sheet]))
+        start = block.stop
+        wrapped.update({name: SheetModel(model, block) if len(grouped) > 1 else model for name, model in sheet_models.items()})
+    return np.hstack(blocks), names, wrapped
+
+
+def saved_scaler(*paths: typing.Optional[str]) -> typing.Optional[sketch.StreamingRobustScaler]:
+    """The robust scaler saved in the first existing path, None if there is none."""
+    for path in paths:
+        if path and Path(path).is_file():
+            return sketch.StreamingRobustScaler.load(path)
+    return None
+
+
+def fit_scaler(name: str, training: np.ndarray) -> typing.Any:
+    """The scaler of the scaler property fitted on the training features, the robust one with quantile sketches."""
+    if (name or "robust") == "robust":
+        return sketch.StreamingRobustScaler().fit(training)
+    if preprocessing is None:
+        raise ImportError("scikit-learn is needed to scale the features of the cascade prediction")
+    return getattr(preprocessing, SCALERS.get(name or "robust", "RobustScaler"))().fit(training)
+
+
+class CascadeEvaluator:
+    """Majority vote of the models with early exit, identical to evaluating every model on every sample.
+
+    Args:
+        models (dict): The models by name, objects with a scikit-learn like predict method.
+        prediction_threshold (float): (1.0) Share of the models that must vote for a sample to call it positive.
+        batch_size (int): (1024) Number of samples that go through the models together.
+        positive_label (Any): (1) The label predicted by the models for the positive class.
+    """
+
+    def __init__(self, models: typing.Dict[str, typing.Any], prediction_threshold: float = 1.0, batch_size: int = 1024,
+                 positive_label: typing.Any = 1) -> None:
+        self.models = dict(models)
+        self.batch_size = max(1, int(batch_size))
+        self.positive_label = positive_label
+        # The small tolerance keeps thresholds like 0.7 of 10 models at exactly 7 votes
+        self.needed = max(1, math.ceil(float(prediction_threshold) * len(self.models) - 1e-9))
+        self.costs: typing.Dict[str, float] = {}
+
+    def order_by_cost(self, probe: np.ndarray) -> typing.List[str]:
+        """Sort the models by their prediction time per sample on probe, cheapest first."""
+        for name, model in self.models.items():
+            start = time.perf_counter()
+            model.predict(probe)
+            self.costs[name] = (time.perf_counter() - start) / max(len(probe), 1)
+        self.models = dict(sorted(self.models.items(), key=lambda item: self.costs[item[0]]))
+        return list(self.models)
+
+    def predict(self, features: np.ndarray) -> typing.Dict[str, typing.Any]:
+        """Votes, evaluated models and prediction of every sample, and the number of model evaluations."""
+        n_samples, n_models = len(features), len(self.models)
+        votes = np.zeros(n_samples, dtype=int)
+        evaluated = np.zeros(n_samples, dtype=int)
+        for start in range(0, n_samples, self.batch_size):
+            active = np.arange(start, min(start + self.batch_size, n_samples))
+            for done, model in enumerate(self.models.values(), start=1):
+                votes[active] += np.asarray(model.predict(features[active])) == self.positive_label
+                evaluated[active] += 1
+                left = n_models - done
+                undecided = (votes[active] < self.needed) & (votes[active] + left >= self.needed)
+                active = active[undecided]
+                if not len(active):
+                    break
+        evaluations = int(evaluated.sum())
+        return {"votes": votes, "evaluated": evaluated, "prediction": votes >= self.needed,
+                "evaluations": evaluations, "skipped": n_samples * n_models - evaluations}
+
+
+def run(biobb_object, first_pass: typing.Callable[[np.ndarray, typing.List[str]], np.ndarray] = None) -> None:
+    """Cascade prediction of a Predict block, writing cascade_predictions.csv to its result folder.
+
+    Every model is given the extracted columns of its sheet of input_excel, scaled with input_scaler,
+    the scaler.npz saved with the models when the scaler property is robust, or else the scaler fitted
+    on that sheet. first_pass returns the scores of a cheaper model and the samples it rejects, those
+    are negative without the ensemble except the student_audit ones used to measure how often it disagrees.
+    """
+    stage = biobb_object.stage_io_dict
+    columns = sheet_columns(stage["in"]["input_excel"])
+    ids, extracted_columns, extracted = read_table(stage["in"]["extracted"])
+    positions = {name: index for index, name in enumerate(extracted_columns)}
+    missing = [column for sheet in columns.values() for column in sheet if column not in positions]
+    if missing:
+        raise ValueError(f"{len(missing)} selected features are not in {stage['in']['extracted']}: {missing[:10]}")
+    # The scaler saved with the models spares reading the training features
+    saved = None
+    if (biobb_object.scaler or "robust") == "robust":
+        saved = saved_scaler(stage["in"].get("input_scaler"), str(Path(biobb_object.model_output).joinpath(SCALER_NAME)))
+    dtype = np.dtype(getattr(biobb_object, "dtype", None) or "float64")
+
+    def scale(sheet: typing.Optional[str], sheet_columns: typing.List[str]) -> np.ndarray:
+        if saved is not None and all(column in saved.columns for column in sheet_columns):
+            scaler = saved.select(sheet_columns)
+        else:
+            _, training_columns, training = read_table(stage["in"]["input_excel"], sheet)
+            scaler = fit_scaler(biobb_object.scaler, training[:, [training_columns.index(column) for column in sheet_columns]])
+        return scaler.transform(extracted[:, [positions[column] for column in sheet_columns]]).astype(dtype)
+
+    features, columns, models = sheet_features(columns, load_models(biobb_object.model_output), scale)
+
+    scores, rejected = first_pass(features, columns) if first_pass else (None, np.zeros(len(ids), dtype=bool))
+    audit_size = getattr(biobb_object, "student_audit", None) or 0
+    audited = np.flatnonzero(rejected)[::max(1, int(rejected.sum()) // audit_size)][:audit_size] if audit_size else np.zeros(0, dtype=int)
+    evaluate = ~rejected
+    evaluate[audited] = True
+
+    evaluator = CascadeEvaluator(models, biobb_object.prediction_threshold or 1.0,
+                                 getattr(biobb_object, "batch_size", None) or 1024)
+    evaluator.order_by_cost(features[evaluate][:64] if evaluate.any() else features[:64])
+    result = evaluator.predict(features[evaluate])
+    votes, evaluated = np.zeros(len(ids), dtype=int), np.zeros(len(ids), dtype=int)
+    votes[evaluate], evaluated[evaluate] = result["votes"], result["evaluated"]
+    prediction = np.zeros(len(ids), dtype=bool)
+    prediction[evaluate] = result["prediction"]
+    prediction[rejected] = False
+
+    res_dir = Path(stage["out"]["prediction_results"].rstrip('.zip'))
+    res_dir.mkdir(parents=True, exist_ok=True)
+    with open(res_dir.joinpath("cascade_predictions.csv"), "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(["", "positive_votes", "evaluated_models", "prediction"] + (["student_probability"] if first_pass else []))
+        for index, row in enumerate(zip(ids, votes, evaluated, prediction.astype(int))):
+            writer.writerow(list(row) + ([round(float(scores[index]), 6)] if first_pass else []))
+    skipped = len(ids) * len(evaluator.models) - int(evaluated.sum())
+    biobb_object.cascade_report = {"models": len(evaluator.models), "samples": len(ids), "evaluations": int(evaluated.sum()),
+                                   "skipped_evaluations": skipped}
+    if first_pass:
+        evaluated_positive = np.zeros(len(ids), dtype=bool)
+        evaluated_positive[evaluate] = result["prediction"]
+        passed = evaluate & ~rejected
+        biobb_object.cascade_report.update({
+            "student_rejected": int(rejected.sum()), "student_audited": len(audited),
+            "audit_missed_positives": int(evaluated_positive[audited].sum()),
+            "student_agreement": round(float(np.mean((scores[evaluate] >= 0.5) == evaluated_positive[evaluate])), 4) if evaluate.any() else 1.0,
+            "passed_positive_rate": round(float(evaluated_positive[passed].mean()), 4) if passed.any() else 0.0})
+        fu.log(f'Student first pass: {int(rejected.sum())} of {len(ids)} samples rejected, '
+               f'{biobb_object.cascade_report["audit_missed_positives"]} of {len(audited)} audited ones are positive for the ensemble',
+               biobb_object.out_log, biobb_object.global_log)
+    fu.log(f'Cascade prediction: {skipped} of {len(ids) * len(evaluator.models)} model evaluations skipped, '
+           f'{int(prediction.sum())} of {len(ids)} samples positive', biobb_object.out_log, biobb_object.global_log)
+    biobb_object.return_code = 0
@@ -1,12 +1,37 @@
 """ Common functions for package biobb_bioml """
+import hashlib
+import importlib
+import json
 import logging
 import os
+import runpy
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+import time
+import traceback
 import typing
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
+import psutil
+from biobb_common.tools import file_utils as fu
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+from biobb_bioml.bioml import blastdb
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import telemetry
 
 
-def zip_list(zip_file: str, file_list: typing.Iterable[str], out_log: logging.Logger = None):
+def zip_list(zip_file: str, file_list: typing.Iterable[str], out_log: logging.Logger = None, biobb_object=None):
+    """fu.zip_list timed in the zipping phase of the telemetry of biobb_object, the outputs phase goes on after it."""
+    telemetry.mark(biobb_object, "zipping")
     file_list.sort()
     with zipfile.ZipFile(zip_file, 'w') as zip_f:
         inserted = []
@@ -25,4 +50,552 @@ def zip_list(zip_file: str, file_list: typing.Iterable[str], out_log: logging.Lo
     if out_log:
         out_log.info("Adding:")
         out_log.info(str(file_list))
-        out_log.info("to: " + str(Path(zip_file).resolve()))
\ No newline at end of file
+        out_log.info("to: " + str(Path(zip_file).resolve()))
+    telemetry.mark(biobb_object, "outputs")
+
+
+BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                    "BLIS_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def limit_threads_env(num_threads: int) -> typing.Dict[str, str]:
+    """Environment variables capping the BLAS/OpenMP thread pools of a child process."""
+    return {var: str(max(1, int(num_threads))) for var in BLAS_THREAD_VARS}
+
+
+def host_cores() -> int:
+    """Number of physical cores of the host, logical ones if they cannot be told apart."""
+    return psutil.cpu_count(logical=False) or psutil.cpu_count() or 1
+
+
+def thread_budget(num_thread: typing.Optional[int], cores: int = None) -> typing.Tuple[int, int]:
+    """Split the host cores between num_thread workers.
+
+    Returns the number of workers, capped to the available cores, and how many
+    BLAS/OpenMP threads each of them can use without oversubscribing the host.
+    """
+    cores = cores or host_cores()
+    workers = min(max(1, int(num_thread or 1)), cores)
+    return workers, max(1, cores // workers)
+
+
+def apply_thread_budget(biobb_object, num_thread: typing.Optional[int]) -> int:
+    """Cap the BLAS/OpenMP pools of the block child process to its share of the cores.
+
+    The limits are merged into the env_vars_dict of the block, values set explicitly by the user win.
+    """
+    workers, threads = thread_budget(num_thread)
+    biobb_object.env_vars_dict = {**limit_threads_env(threads), **(biobb_object.env_vars_dict or {})}
+    fu.log(f'Thread budget: {workers} workers with {threads} BLAS/OpenMP threads each', biobb_object.out_log, biobb_object.global_log)
+    return threads
+
+
+def apply_memory_budget(biobb_object, num_thread: typing.Optional[int]) -> typing.Optional[int]:
+    """Cap num_thread to the workers that fit in the memory_budget of the block, each one holding its own copy of the data.
+
+    This is only a cap of the worker pool of BioML, which can not be resized once started: the
+    tasks are queued by BioML on the smaller pool. The footprint of a worker is the largest
+    process measured with psutil in the previous runs recorded in the telemetry_dir, scaled to
+    the size of the inputs by the planner. Without previous runs num_thread is not capped and a
+    warning is logged.
+    """
+    budget = getattr(biobb_object, "memory_budget", None)
+    if not budget or not num_thread:
+        return num_thread
+    block = type(biobb_object).__name__
+    properties = {name: getattr(biobb_object, name, None) for name in biobb_object.doc_properties_dict}
+    footprint, calibrated = planner.worker_footprint(block, biobb_object.io_dict["in"], properties)
+    biobb_object.admission_report = {"memory_budget_mb": float(budget), "requested": int(num_thread), "calibrated_from": calibrated}
+    if not calibrated:
+        fu.log(f'WARNING: the memory footprint of a worker is unknown, there are no previous runs of {block} in telemetry_dir, '
+               f'all the {num_thread} workers are started regardless of memory_budget', biobb_object.out_log, biobb_object.global_log)
+        biobb_object.admission_report.update({"footprint_mb": None, "workers": int(num_thread)})
+        return num_thread
+    admission = AdmissionController(float(budget), int(num_thread), footprint)
+    workers = admission.capacity()
+    biobb_object.admission_report.update({"footprint_mb": footprint, "workers": workers})
+    fu.log(f'Memory budget: {workers} of the {num_thread} requested workers fit in {budget} MB with {footprint} MB each '
+           f'({calibrated} previous runs)', biobb_object.out_log, biobb_object.global_log)
+    return workers
+
+
+def parse_sheets(sheets: str) -> typing.List[typing.Tuple[str, typing.Optional[str]]]:
+    """Split the sheets argument into independent (sheet, kfold model) jobs.
+
+    Every whitespace separated item is either ``sheet:index1,index2`` or a comma separated
+    list of sheets without indices, in which case all the kfold models of the sheet form a single job.
+    """
+    jobs = []
+    for item in str(sheets).split():
+        if ":" in item:
+            sheet, folds = item.split(":", 1)
+            jobs.extend((sheet, fold) for fold in folds.split(",") if fold)
+        else:
+            jobs.extend((sheet, None) for sheet in item.split(",") if sheet)
+    return jobs
+
+
+def _tree_rss(process: psutil.Process) -> int:
+    rss = 0
+    for proc in [process] + process.children(recursive=True):
+        try:
+            rss += proc.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return rss
+
+
+def run_monitored(cmd: typing.List[str], env: typing.Mapping[str, str] = None, log_path: str = None,
+                  interval: float = 0.2) -> typing.Dict[str, typing.Any]:
+    """Run an argv list, without a shell, sampling the resident memory of its whole process tree."""
+    start = time.perf_counter()
+    log_file = open(log_path, "w") if log_path else subprocess.DEVNULL
+    try:
+        process = subprocess.Popen([str(arg) for arg in cmd], env={**os.environ, **(env or {})},
+                                   stdout=log_file, stderr=subprocess.STDOUT)
+        peak_rss = 0
+        try:
+            monitor = psutil.Process(process.pid)
+            while process.poll() is None:
+                peak_rss = max(peak_rss, _tree_rss(monitor))
+                time.sleep(interval)
+        except psutil.NoSuchProcess:
+            pass
+        return_code = process.wait()
+    finally:
+        if log_path:
+            log_file.close()
+    return {"return_code": return_code, "wall_time": round(time.perf_counter() - start, 3),
+            "peak_rss_mb": round(peak_rss / 2**20, 1)}
+
+
+def job_cmd_line(biobb_object, cmd: typing.List[str]) -> typing.List[str]:
+    """Argv of a job running a variant of the command line of a block, with its dev options and container.
+
+    The first element of cmd is the program with its fixed arguments, like ``python -m BioML.<module>``.
+    The container command is built by biobb_common, which quotes the job for a shell, but ``<shell> -c``
+    receives it here as a single argument.
+    """
+    argv = shlex.split(str(cmd[0])) + [str(arg) for arg in cmd[1:]]
+    if biobb_object.dev:
+        argv += biobb_object.dev.split()
+    if not biobb_object.container_path:
+        return fu.create_cmd_line(argv)
+    container_cmd = fu.create_cmd_line(argv, container_path=biobb_object.container_path,
+                                       host_volume=biobb_object.stage_io_dict["unique_dir"],
+                                       container_volume=biobb_object.container_volume_path,
+                                       container_working_dir=biobb_object.container_working_dir,
+                                       container_user_uid=biobb_object.container_user_id,
+                                       container_shell_path=biobb_object.container_shell_path,
+                                       container_image=biobb_object.container_image,
+                                       out_log=biobb_object.out_log, global_log=biobb_object.global_log)
+    return container_cmd[:-1] + [shlex.join(argv)]
+
+
+class AdmissionController:
+    """Admit tasks while the memory footprints of the running ones fit in a memory budget.
+
+    Every task is assumed to hold as much memory as the largest one measured so far. Until the
+    first task finishes the footprint is unknown, and only probe tasks run unless an initial
+    footprint is given. The tasks that do not fit wait for a running one to finish. A single task
+    is always admitted, even when its footprint is over the budget.
+
+    Args:
+        memory_budget (float): Megabytes shared by the tasks running at the same time.
+        max_workers (int): Most tasks running at the same time.
+        footprint (float): (None) Megabytes of a task before any is measured.
+        probe (int): (1) Tasks running at the same time while the footprint is unknown.
+    """
+
+    def __init__(self, memory_budget: float, max_workers: int, footprint: float = None, probe: int = 1) -> None:
+        self.memory_budget = float(memory_budget)
+        self.max_workers = max(1, int(max_workers))
+        self.initial_footprint = footprint
+        self.probe = max(1, int(probe))
+        self.measured: typing.List[float] = []
+        self.running = 0
+        self.queued = 0
+        self.peak_running = 0
+        self._condition = threading.Condition()
+
+    @property
+    def footprint(self) -> typing.Optional[float]:
+        return max(self.measured) if self.measured else self.initial_footprint
+
+    def capacity(self) -> int:
+        """Tasks that can run at the same time with the current footprint."""
+        footprint = self.footprint
+        if footprint is None:
+            return min(self.max_workers, self.probe)
+        return max(1, min(self.max_workers, int(self.memory_budget // max(footprint, 1.0))))
+
+    def acquire(self) -> None:
+        with self._condition:
+            if self.running and self.running >= self.capacity():
+                self.queued += 1
+            while self.running and self.running >= self.capacity():
+                self._condition.wait()
+            self.running += 1
+            self.peak_running = max(self.peak_running, self.running)
+
+    def release(self, peak_mb: float = None) -> None:
+        """Free the slot of a finished task, peak_mb is the peak resident memory measured for it."""
+        with self._condition:
+            self.running -= 1
+            if peak_mb:
+                self.measured.append(float(peak_mb))
+            self._condition.notify_all()
+
+    @contextmanager
+    def admit(self):
+        """Run the block when the task fits, the block sets the measured peak in the yielded dict."""
+        measurement: typing.Dict[str, float] = {}
+        self.acquire()
+        try:
+            yield measurement
+        finally:
+            self.release(measurement.get("peak_rss_mb"))
+
+    def report(self) -> typing.Dict[str, typing.Any]:
+        footprint = self.footprint
+        return {"memory_budget_mb": self.memory_budget, "footprint_mb": round(footprint, 1) if footprint is not None else None,
+                "capacity": self.capacity(), "peak_running": self.peak_running, "queued": self.queued}
+
+
+def run_jobs(jobs: typing.List[typing.Tuple[str, typing.List[str]]], max_workers: int, threads_per_job: int,
+             log_dir: str = None, out_log: logging.Logger = None, global_log: logging.Logger = None,
+             admission: AdmissionController = None, env: typing.Mapping[str, str] = None) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Run independent (name, argv) jobs in parallel, each one limited to threads_per_job BLAS/OpenMP threads.
+
+    With an admission controller the jobs only start while their measured footprints fit in its memory budget.
+    The variables of env, like the telemetry marker of the block, are set in the environment of every job.
+    """
+    env = {**(env or {}), **limit_threads_env(threads_per_job)}
+
+    def run(job):
+        name, cmd = job
+        log_path = os.path.join(log_dir, f"{name}.log") if log_dir else None
+        with admission.admit() if admission else nullcontext({}) as measurement:
+            record = {"job": name, **run_monitored(cmd, env=env, log_path=log_path)}
+            measurement["peak_rss_mb"] = record["peak_rss_mb"]
+        fu.log(f"Job {name} exited with code {record['return_code']} in {record['wall_time']} s, "
+               f"peak memory {record['peak_rss_mb']} MB", out_log, global_log)
+        return record
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return list(executor.map(run, jobs))
+
+
+_IN_PROCESS_LOCK = threading.Lock()
+
+
+def run_in_process(cmd: typing.List[str], env: typing.Mapping[str, str] = None, out_log: logging.Logger = None,
+                   global_log: logging.Logger = None) -> int:
+    """Run a ``python -m BioML.<module>`` command line inside the current interpreter.
+
+    The BioML module and its scientific dependencies are imported only once per interpreter, so
+    chaining several blocks from Python does not pay the start up and import time of every block.
+    """
+    module_name = cmd[0].split()[-1]
+    argv = shlex.split(" ".join(cmd[1:]))
+    fu.log(f'Running {module_name} in process: {" ".join(argv)}', out_log, global_log)
+
+    env = env or {}
+    # sys.argv and os.environ are process wide, blocks run from several threads take turns
+    _IN_PROCESS_LOCK.acquire()
+    saved_argv, saved_env = sys.argv, dict(os.environ)
+    sys.argv = [module_name] + argv
+    os.environ.update(env)
+    # The BLAS/OpenMP pools of an interpreter are created once, the environment alone does not resize them
+    limits = nullcontext()
+    if threadpool_limits and env.get("OMP_NUM_THREADS"):
+        limits = threadpool_limits(limits=int(env["OMP_NUM_THREADS"]))
+    try:
+        with limits:
+            module = importlib.import_module(module_name)
+            if hasattr(module, "main"):
+                module.main()
+            else:
+                runpy.run_module(module_name, run_name="__main__", alter_sys=True)
+        return_code = 0
+    except SystemExit as exit_error:
+        return_code = exit_error.code if isinstance(exit_error.code, int) else int(bool(exit_error.code))
+    except Exception:
+        # A child process would have printed the traceback and exited with 1
+        fu.log(traceback.format_exc(), out_log, global_log)
+        return_code = 1
+    finally:
+        sys.argv = saved_argv
+        os.environ.clear()
+        os.environ.update(saved_env)
+        _IN_PROCESS_LOCK.release()
+    fu.log(f'Exit code {return_code}', out_log, global_log)
+    return return_code
+
+
+def run_block(biobb_object, run: typing.Callable[[], typing.Any] = None) -> None:
+    """Run the command line of a block with the backend selected in its properties, or the given run callable."""
+    in_process = getattr(biobb_object, "backend", None) == "inprocess"
+    if in_process and run is None:
+        # The interpreter can not change its working directory or run inside a container per block
+        unsupported = [name for name in ("chdir_sandbox", "container_path", "dev") if getattr(biobb_object, name, None)]
+        if unsupported:
+            raise ValueError(f'The inprocess backend does not support the {", ".join(unsupported)} properties, use the subprocess backend')
+    telemetry.mark(biobb_object, "command")
+    if run is not None:
+        run()
+    elif in_process:
+        biobb_object.return_code = run_in_process(biobb_object.cmd, env=biobb_object.env_vars_dict,
+                                                  out_log=biobb_object.out_log, global_log=biobb_object.global_log)
+    else:
+        biobb_object.run_biobb()
+    telemetry.mark(biobb_object, "outputs")
+
+
+def remove_tmp_files(biobb_object) -> None:
+    """Remove the temporal files of a block, timed as the cleanup phase of its telemetry."""
+    telemetry.mark(biobb_object, "cleanup")
+    biobb_object.remove_tmp_files()
+
+
+# Properties that change how a block runs but not what it computes
+CACHE_IGNORED_PROPERTIES = {"num_thread", "backend", "cache_dir", "staging", "parallel_jobs", "jobs_report", "telemetry_dir",
+                            "memory_budget", "prefilter_memory_mb", "stream_batch_size", "stream_workers", "batch_size"}
+
+
+def hash_path(path: str, block_size: int = 2**20) -> str:
+    """sha256 of the contents of a file, or of every file below a directory."""
+    digest = hashlib.sha256()
+    files = [Path(path)] if Path(path).is_file() else sorted(p for p in Path(path).rglob("*") if p.is_file())
+    for file_path in files:
+        digest.update(str(file_path.relative_to(path)).encode() if file_path != Path(path) else b"")
+        with open(file_path, "rb") as stream:
+            for block in iter(lambda: stream.read(block_size), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(biobb_object) -> str:
+    """Content address of a block run: its class, the contents of its inputs, its effective properties and the outputs asked for.
+
+    The properties listed in the FILE_PROPERTIES of the block are paths, hashed by content like the inputs.
+    The ones in its FINGERPRINT_PROPERTIES, too large to hash on every launch like the fasta of a BLAST
+    database, are keyed by their path, size and modification time.
+    """
+    inputs = {}
+    for file_ref, value in biobb_object.io_dict["in"].items():
+        if value and Path(value).exists():
+            inputs[file_ref] = hash_path(value)
+        else:
+            inputs[file_ref] = value
+    file_properties = getattr(biobb_object, "FILE_PROPERTIES", ())
+    fingerprint_properties = getattr(biobb_object, "FINGERPRINT_PROPERTIES", ())
+    properties = {}
+    for name in biobb_object.doc_properties_dict:
+        if name in CACHE_IGNORED_PROPERTIES:
+            continue
+        value = getattr(biobb_object, name, None)
+        if name in file_properties and isinstance(value, str) and value and Path(value).exists():
+            value = hash_path(value)
+        elif name in fingerprint_properties and isinstance(value, str) and value and Path(value).is_file():
+            value = blastdb.source_fingerprint(value)
+        properties[name] = value
+    # A run asking for an extra output is not served by the entry of a run that did not write it
+    outputs = sorted(file_ref for file_ref, value in biobb_object.io_dict["out"].items() if value)
+    payload = json.dumps({"block": type(biobb_object).__name__, "in": inputs, "properties": properties, "out": outputs},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+FICLONE = 0x40049409
+
+
+def _reflink(source: str, destination: str) -> bool:
+    """Copy-on-write clone of source, only supported by some filesystems (btrfs, xfs)."""
+    try:
+        import fcntl
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        shutil.copystat(source, destination)
+        return True
+    except (ImportError, OSError):
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+
+def clone_or_copy(source: str, destination: str) -> None:
+    """Reflink source to destination, copying it when the filesystem can not clone.
+
+    Unlike a hardlink, editing one of the files in place never changes the other one.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    Path(destination).parent.mkdir(parents=True, exist_ok=True)
+    if not _reflink(source, destination):
+        shutil.copy2(source, destination)
+
+
+def check_cache(biobb_object) -> bool:
+    """Serve the outputs of a block from the cache_dir if an identical run was already cached."""
+    cache_dir = getattr(biobb_object, "cache_dir", None)
+    if not cache_dir:
+        return False
+    biobb_object.cache_entry = str(Path(cache_dir).joinpath(cache_key(biobb_object)))
+    manifest_path = Path(biobb_object.cache_entry).joinpath("manifest.json")
+    if not manifest_path.exists():
+        fu.log(f'Cache miss: {biobb_object.cache_entry}', biobb_object.out_log, biobb_object.global_log)
+        return False
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    for file_ref, file_name in manifest.items():
+        destination = biobb_object.io_dict["out"].get(file_ref)
+        if destination:
+            clone_or_copy(str(Path(biobb_object.cache_entry).joinpath(file_name)), destination)
+    fu.log(f'Cache hit: outputs copied from {biobb_object.cache_entry}', biobb_object.out_log, biobb_object.global_log)
+    biobb_object.return_code = 0
+    return True
+
+
+def store_cache(biobb_object) -> None:
+    """Save the outputs of a successful run in the cache entry computed by check_cache."""
+    cache_entry = getattr(biobb_object, "cache_entry", None)
+    if not cache_entry or biobb_object.return_code:
+        return
+    telemetry.mark(biobb_object, "caching")
+    staging_entry = Path(f"{cache_entry}.{os.getpid()}.tmp")
+    staging_entry.mkdir(parents=True, exist_ok=True)
+    manifest = {}
+    for file_ref, file_path in biobb_object.io_dict["out"].items():
+        if file_path and Path(file_path).is_file():
+            manifest[file_ref] = f"{file_ref}{''.join(Path(file_path).suffixes)}"
+            clone_or_copy(file_path, str(staging_entry.joinpath(manifest[file_ref])))
+    with open(staging_entry.joinpath("manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    try:
+        # Publish the entry at once so concurrent runs never see it half written
+        os.rename(staging_entry, cache_entry)
+        fu.log(f'Outputs cached in {cache_entry}', biobb_object.out_log, biobb_object.global_log)
+    except OSError:
+        shutil.rmtree(staging_entry, ignore_errors=True)
+
+
+def stage_file(source: str, destination: str, strategy: str = "copy") -> str:
+    """Place source at destination with the staging strategy and return the method used.
+
+    "link" tries a reflink, then a hardlink when source is read-only, and copies otherwise (i.e.
+    across filesystems or a writable source, that a command editing its inputs in place would
+    change through the hardlink), "symlink" creates a symbolic link and "copy" always copies.
+    """
+    if strategy == "symlink":
+        os.symlink(os.path.abspath(source), destination)
+        return "symlink"
+    if strategy == "link" and Path(source).is_file():
+        if _reflink(source, destination):
+            return "reflink"
+        if not os.stat(source).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH):
+            try:
+                os.link(source, destination)
+                return "hardlink"
+            except OSError:
+                pass
+    if Path(source).is_dir():
+        shutil.copytree(source, destination)
+    else:
+        shutil.copy2(source, destination)
+    return "copy"
+
+
+def _size(path: str) -> int:
+    if Path(path).is_dir():
+        return sum(p.stat().st_size for p in Path(path).rglob("*") if p.is_file())
+    return Path(path).stat().st_size
+
+
+def stage_files(biobb_object, skip: typing.Iterable[str] = ()) -> None:
+    """Stage the inputs of a block in its unique directory with the strategy of its staging property.
+
+    The inputs of skip are not staged, only their path in the unique directory is set, for the
+    block to write them there itself, like the indexed subset of a fasta.
+    """
+    telemetry.mark(biobb_object, "staging")
+    if getattr(biobb_object, "telemetry_dir", None):
+        # Kept in the telemetry record to calibrate the planner
+        properties = {name: getattr(biobb_object, name, None) for name in biobb_object.doc_properties_dict}
+        biobb_object.workload = planner.workload(type(biobb_object).__name__, biobb_object.io_dict["in"], properties)
+    skipped = {file_ref: biobb_object.io_dict["in"][file_ref] for file_ref in skip if biobb_object.io_dict["in"].get(file_ref)}
+    strategy = getattr(biobb_object, "staging", None) or "copy"
+    if strategy == "copy" or biobb_object.disable_sandbox or biobb_object.container_path:
+        biobb_object.io_dict["in"].update(dict.fromkeys(skipped))
+        try:
+            biobb_object.stage_files()
+        finally:
+            biobb_object.io_dict["in"].update(skipped)
+        staged = {} if biobb_object.disable_sandbox else {
+            file_ref: file_path for file_ref, file_path in biobb_object.io_dict["in"].items()
+            if file_path and file_ref not in skipped and Path(file_path).exists()}
+        biobb_object.staging_report = {"copied_bytes": sum(_size(path) for path in staged.values()), "linked_bytes": 0,
+                                       "methods": dict.fromkeys(staged, "copy")}
+    else:
+        unique_dir = str(Path(fu.create_unique_dir()).resolve())
+        biobb_object.stage_io_dict = {"in": {}, "out": {}, "unique_dir": unique_dir}
+        biobb_object.staging_report = {"copied_bytes": 0, "linked_bytes": 0, "methods": {}}
+        for file_ref, file_path in biobb_object.io_dict["in"].items():
+            if not file_path or file_ref in skipped:
+                continue
+            if not Path(file_path).exists():
+                biobb_object.stage_io_dict["in"][file_ref] = file_path
+                continue
+            destination = str(Path(unique_dir).joinpath(Path(file_path).name))
+            method = stage_file(file_path, destination, strategy)
+            biobb_object.staging_report["copied_bytes" if method == "copy" else "linked_bytes"] += _size(file_path)
+            biobb_object.staging_report["methods"][file_ref] = method
+            fu.log(f"{method.capitalize()}: {file_path} to {unique_dir}", biobb_object.out_log)
+            biobb_object.stage_io_dict["in"][file_ref] = Path(file_path).name if biobb_object.chdir_sandbox else destination
+        for file_ref, file_path in biobb_object.io_dict["out"].items():
+            if file_path:
+                biobb_object.stage_io_dict["out"][file_ref] = (
+                    Path(file_path).name if biobb_object.chdir_sandbox else str(Path(unique_dir).joinpath(Path(file_path).name)))
+    if biobb_object.disable_sandbox:
+        # The staged paths are the host ones, the skipped inputs get a new name next to them
+        biobb_object.stage_io_dict["in"] = dict(biobb_object.stage_io_dict["in"])
+    for file_ref, file_path in skipped.items():
+        name = Path(file_path).name
+        if biobb_object.disable_sandbox:
+            biobb_object.stage_io_dict["in"][file_ref] = str(Path(biobb_object.stage_io_dict["unique_dir"]).joinpath(f"subset_{name}"))
+        elif biobb_object.container_path:
+            biobb_object.stage_io_dict["in"][file_ref] = str(Path(biobb_object.container_volume_path).joinpath(name))
+        else:
+            biobb_object.stage_io_dict["in"][file_ref] = name if biobb_object.chdir_sandbox else str(Path(biobb_object.stage_io_dict["unique_dir"]).joinpath(name))
+    fu.log(f'Staging ({strategy}): {biobb_object.staging_report["copied_bytes"]} bytes copied, '
+           f'{biobb_object.staging_report["linked_bytes"]} bytes linked', biobb_object.out_log, biobb_object.global_log)
+
+
+def copy_to_host(biobb_object, file_refs: typing.Iterable[str] = None) -> None:
+    """Bring the outputs back from the unique directory, moving them unless staging is "copy".
+
+    When file_refs is given only those outputs are brought back.
+    """
+    strategy = getattr(biobb_object, "staging", None) or "copy"
+    file_refs = list(biobb_object.io_dict["out"]) if file_refs is None else list(file_refs)
+    for file_ref in file_refs:
+        if biobb_object.io_dict["out"].get(file_ref):
+            Path(biobb_object.io_dict["out"][file_ref]).parent.mkdir(parents=True, exist_ok=True)
+    copy = strategy == "copy" or biobb_object.container_path
+    if copy and len(file_refs) == len(biobb_object.io_dict["out"]):
+        biobb_object.copy_to_host()
+        return
+    for file_ref in file_refs:
+        file_path = biobb_object.stage_io_dict["out"].get(file_ref)
+        if not file_path:
+            continue
+        sandbox_file_path = Path(biobb_object.stage_io_dict["unique_dir"]).joinpath(Path(file_path).name)
+        destination = Path(biobb_object.io_dict["out"][file_ref])
+        if not sandbox_file_path.exists() or (destination.exists() and sandbox_file_path.samefile(destination)):
+            continue
+        if copy:
+            shutil.copy2(str(sandbox_file_path), str(destination))
+            continue
+        if destination.exists():
+            destination.unlink()
+        shutil.move(str(sandbox_file_path), str(destination))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""Module containing the helpers to profile and extract every unique sequence only once."""
+import csv
+import hashlib
+import shutil
+import typing
+from pathlib import Path
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from biobb_common.tools import file_utils as fu
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+
+def sequence_hash(sequence: str) -> str:
+    """Hash of a sequence ignoring the case, the line breaks and the stop codon."""
+    return hashlib.sha1("".join(sequence.split()).upper().rstrip("*").encode()).hexdigest()
+
+
+def deduplicate_fasta(input_fasta: str, output_fasta: str) -> typing.Dict[str, typing.List[str]]:
+    """Write the first record of every distinct sequence to output_fasta.
+
+    Returns the ids of the duplicated records grouped by the id of the record kept in their place,
+    only for the sequences that appear more than once.
+    """
+    representatives: typing.Dict[str, str] = {}
+    duplicates: typing.Dict[str, typing.List[str]] = {}
+    with open(input_fasta) as in_handle, open(output_fasta, "w") as out_handle:
+        for title, sequence in SimpleFastaParser(in_handle):
+            record_id = title.split(None, 1)[0] if title else title
+            key = sequence_hash(sequence)
+            if key in representatives:
+                duplicates.setdefault(representatives[key], []).append(record_id)
+                continue
+            representatives[key] = record_id
+            out_handle.write(f">{title}\n{sequence}\n")
+    return duplicates
+
+
+def fan_out_files(directory: str, duplicates: typing.Dict[str, typing.List[str]], suffix: str = ".pssm") -> int:
+    """Copy the <id><suffix> file of every kept record to the names of its duplicates."""
+    copied = 0
+    for representative, duplicate_ids in duplicates.items():
+        source = Path(directory).joinpath(f"{representative}{suffix}")
+        if not source.exists():
+            continue
+        for duplicate_id in duplicate_ids:
+            shutil.copyfile(source, Path(directory).joinpath(f"{duplicate_id}{suffix}"))
+            copied += 1
+    return copied
+
+
+def fan_out_rows(table: str, duplicates: typing.Dict[str, typing.List[str]], out_log=None, global_log=None) -> int:
+    """Write a copy of the row of every kept record right after it for each of its duplicates, the ids in the first column.
+
+    The duplicates follow their kept record, so the rows are not in the order of the input fasta
+    when the duplicated records were not next to each other. CSV tables are always supported,
+    Excel tables need openpyxl.
+    """
+    def fanned(rows):
+        for row in rows:
+            yield row
+            if row and row[0] in duplicates:
+                yield from ([duplicate_id] + list(row[1:]) for duplicate_id in duplicates[row[0]])
+
+    added = 0
+    if Path(table).suffix == ".csv":
+        with open(table, newline="") as table_file:
+            rows = list(csv.reader(table_file))
+        new_rows = [rows[0]] + list(fanned(rows[1:])) if rows else []
+        with open(table, "w", newline="") as table_file:
+            csv.writer(table_file).writerows(new_rows)
+        added = len(new_rows) - len(rows)
+    elif Path(table).suffix == ".xlsx":
+        if openpyxl is None:
+            raise ImportError(f"openpyxl is needed to add the rows of the duplicated sequences to {table}")
+        workbook = openpyxl.load_workbook(table)
+        for sheet in workbook.worksheets:
+            rows = list(sheet.iter_rows(min_row=2, values_only=True))
+            new_rows = list(fanned(rows))
+            # The table only grows, every old cell is overwritten
+            for row_index, row in enumerate(new_rows, start=2):
+                for column_index, value in enumerate(row, start=1):
+                    sheet.cell(row=row_index, column=column_index, value=value)
+            added += len(new_rows) - len(rows)
+        workbook.save(table)
+    else:
+        raise ValueError(f"Can not add the rows of the duplicated sequences to {table}, only CSV and Excel tables are supported")
+    fu.log(f'Added {added} rows of duplicated sequences to {table}', out_log, global_log)
+    return added
+
+
+def log_savings(biobb_object, input_fasta: str, unique_fasta: str, duplicates: typing.Dict[str, typing.List[str]]) -> None:
+    """Log and keep in the dedup_report of the block how many sequences were skipped."""
+    removed = sum(len(duplicate_ids) for duplicate_ids in duplicates.values())
+    with open(unique_fasta) as unique_handle:
+        unique = sum(1 for _ in SimpleFastaParser(unique_handle))
+    biobb_object.dedup_report = {"sequences": unique + removed, "unique_sequences": unique, "skipped_sequences": removed,
+                                 "saved_fraction": round(removed / (unique + removed), 4) if unique + removed else 0.0}
+    fu.log(f'Deduplication of {input_fasta}: {unique} unique sequences out of {unique + removed}, '
+           f'{removed} runs saved', biobb_object.out_log, biobb_object.global_log)
+
+
+def stage_unique_fasta(biobb_object, file_ref: str = "input_fasta") -> typing.Dict[str, typing.List[str]]:
+    """Replace the staged fasta of a block by its distinct sequences and return the duplicates left out."""
+    staged_fasta = biobb_object.stage_io_dict["in"][file_ref]
+    unique_fasta = str(Path(staged_fasta).with_name(f"unique_{Path(staged_fasta).name}"))
+    duplicates = deduplicate_fasta(staged_fasta, unique_fasta)
+    log_savings(biobb_object, staged_fasta, unique_fasta, duplicates)
+    biobb_object.stage_io_dict["in"][file_ref] = unique_fasta
+    biobb_object.tmp_files.append(unique_fasta)
+    return duplicates
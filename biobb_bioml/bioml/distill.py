@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""Module containing the distillation of the ensemble of Generate_model into a single student model.
+
+The student is a logistic regression fitted with Newton's method on the soft votes of the ensemble
+(the share of the models voting positive) over the training features and any unlabeled features,
+so it learns the decision of the ensemble rather than the labels. It is a weight per feature, saved
+as an npz next to the ensemble, and scores a sample with one dot product. Predict uses it as a first
+pass: the samples it rejects with confidence skip the ensemble.
+"""
+import typing
+from pathlib import Path
+import numpy as np
+from biobb_common.tools import file_utils as fu
+from biobb_bioml.bioml import cascade
+
+STUDENT_NAME = "student.npz"
+
+
+class StudentModel:
+    """Logistic regression on the scaled features.
+
+    Args:
+        weights (np.ndarray): Weight of every feature.
+        bias (float): Intercept.
+        columns (list): Names of the features, in the order of the weights.
+    """
+
+    def __init__(self, weights: np.ndarray, bias: float, columns: typing.Sequence[str]) -> None:
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+        self.columns = list(columns)
+
+    def predict_proba(self, features: np.ndarray) -> np.ndarray:
+        """Probability of the positive class, the soft vote of the ensemble the student imitates."""
+        return 1.0 / (1.0 + np.exp(-(features @ self.weights + self.bias)))
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        return (self.predict_proba(features) >= 0.5).astype(int)
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as student_file:
+            np.savez(student_file, weights=self.weights, bias=np.array(self.bias), columns=np.array(self.columns, dtype=str))
+
+    @classmethod
+    def load(cls, path: str) -> "StudentModel":
+        with np.load(path, allow_pickle=False) as loaded:
+            return cls(loaded["weights"], float(loaded["bias"]), loaded["columns"].tolist())
+
+
+def soft_votes(models: typing.Dict[str, typing.Any], features: np.ndarray) -> np.ndarray:
+    """Share of the models voting positive for every sample, their positive probability when they have one."""
+    votes = np.zeros(len(features))
+    for model in models.values():
+        if hasattr(model, "predict_proba"):
+            votes += np.asarray(model.predict_proba(features))[:, -1]
+        else:
+            votes += np.asarray(model.predict(features)) == 1
+    return votes / len(models)
+
+
+def fit_student(features: np.ndarray, targets: np.ndarray, columns: typing.Sequence[str], l2: float = 1e-3,
+                max_iter: int = 50, tol: float = 1e-8) -> StudentModel:
+    """Logistic regression with soft targets and an L2 penalty (the intercept is not penalized), fitted with Newton's method."""
+    design = np.hstack([np.asarray(features, dtype=np.float64), np.ones((len(features), 1))])
+    params = np.zeros(design.shape[1])
+    penalty = np.full(design.shape[1], l2 * len(features))
+    penalty[-1] = 0.0
+    for _ in range(max_iter):
+        probabilities = 1.0 / (1.0 + np.exp(-(design @ params)))
+        gradient = design.T @ (probabilities - targets) + penalty * params
+        curvature = np.maximum(probabilities * (1 - probabilities), 1e-9)
+        hessian = (design * curvature[:, None]).T @ design + np.diag(penalty) + 1e-9 * np.eye(len(params))
+        step = np.linalg.solve(hessian, gradient)
+        params -= step
+        if np.abs(step).max() < tol:
+            break
+    return StudentModel(params[:-1], params[-1], columns)
+
+
+def agreement(student: np.ndarray, ensemble: np.ndarray, threshold: float = 0.5) -> typing.Dict[str, float]:
+    """How often the student and the ensemble agree, both called positive at threshold, and their mean probability gap."""
+    student_positive, ensemble_positive = student >= threshold, ensemble >= threshold
+    return {"agreement": round(float(np.mean(student_positive == ensemble_positive)) if len(student) else 1.0, 4),
+            "missed_positives": int(np.sum(ensemble_positive & ~student_positive)),
+            "mean_abs_diff": round(float(np.mean(np.abs(student - ensemble))) if len(student) else 0.0, 4)}
+
+
+def first_pass(student_path: str, student_threshold: float) -> typing.Callable[[np.ndarray, typing.List[str]], typing.Tuple[np.ndarray, np.ndarray]]:
+    """First pass of the cascade of Predict: the student scores and the samples scored below student_threshold."""
+    student = StudentModel.load(student_path)
+
+    def screen(features: np.ndarray, columns: typing.List[str]) -> typing.Tuple[np.ndarray, np.ndarray]:
+        missing = [column for column in student.columns if column not in columns]
+        if missing:
+            raise ValueError(f"The student {student_path} uses features missing from the prediction: {missing[:10]}")
+        scores = student.predict_proba(features[:, [columns.index(column) for column in student.columns]])
+        return scores, scores < student_threshold
+    return screen
+
+
+def run(biobb_object) -> None:
+    """Distill the models of a Generate_model block into model_output/student.npz and its output_student.
+
+    The ensemble is evaluated like the cascade of Predict, every model on the columns of its sheet:
+    the features of the sheets of input_excel and the same columns of unlabeled_features, scaled
+    with the scaler saved with the models or fitted on every sheet. The student reads the columns of
+    every sheet side by side.
+    """
+    model_dir = biobb_object.stage_io_dict["out"]["output_model"].rstrip('.zip')
+    models = cascade.load_models(model_dir)
+    excel = biobb_object.stage_io_dict["in"]["input_excel"]
+    columns = cascade.sheet_columns(excel, biobb_object.stage_io_dict["in"].get("sheets"))
+    unlabeled = None
+    unlabeled_features = biobb_object.stage_io_dict["in"].get("unlabeled_features")
+    if unlabeled_features:
+        _, unlabeled_columns, unlabeled_values = cascade.read_table(unlabeled_features)
+        unlabeled = {column: index for index, column in enumerate(unlabeled_columns)}
+    saved = cascade.saved_scaler(str(Path(model_dir).joinpath(cascade.SCALER_NAME)))
+    if (biobb_object.scaler or "robust") != "robust":
+        saved = None
+    samples = {}
+
+    def scale(sheet: typing.Optional[str], sheet_columns: typing.List[str]) -> np.ndarray:
+        _, training_columns, training = cascade.read_table(excel, sheet)
+        training = training[:, [training_columns.index(column) for column in sheet_columns]]
+        values = [training]
+        if unlabeled is not None:
+            missing = [column for column in sheet_columns if column not in unlabeled]
+            if missing:
+                raise ValueError(f"{len(missing)} features of the sheet {sheet} are not in {biobb_object.unlabeled_features}: {missing[:10]}")
+            values.append(unlabeled_values[:, [unlabeled[column] for column in sheet_columns]])
+        if saved is not None and all(column in saved.columns for column in sheet_columns):
+            scaler = saved.select(sheet_columns)
+        else:
+            scaler = cascade.fit_scaler(biobb_object.scaler, training)
+        samples["training"] = len(training)
+        return scaler.transform(np.vstack(values))
+
+    features, feature_columns, models = cascade.sheet_features(columns, models, scale)
+    targets = soft_votes(models, features)
+    student = fit_student(features, targets, feature_columns)
+    student.save(str(Path(model_dir).joinpath(STUDENT_NAME)))
+    if biobb_object.io_dict["out"].get("output_student"):
+        Path(biobb_object.io_dict["out"]["output_student"]).parent.mkdir(parents=True, exist_ok=True)
+        student.save(biobb_object.io_dict["out"]["output_student"])
+    biobb_object.distill_report = {"models": len(models), "samples": len(features), "unlabeled": len(features) - samples["training"],
+                                   **agreement(student.predict_proba(features), targets)}
+    fu.log(f'Distilled {len(models)} models into a student on {len(features)} samples, agreement with the ensemble '
+           f'{biobb_object.distill_report["agreement"]}', biobb_object.out_log, biobb_object.global_log)
@@ -7,6 +7,8 @@ from biobb_common.configuration import settings
 from biobb_common.tools import file_utils as fu
 from biobb_common.tools.file_utils import launchlogger
 from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import telemetry
 import os
 
 
@@ -22,6 +24,7 @@ class Ensemble(BiobbObject):
         sheets (str): Names or index of the selected sheets for both features and hyperparameters. File type: input. Accepted formats: text (edam:format_1964).
         ensemble_output (str): The zip file to the output for the ensemble results. File type: output. Accepted formats: ZIP (edam:format_3987).
         label (str): The path to the labels of the training set in a csv format. File type: input. Accepted formats: CSV (edam:format_3752).
+        output_metrics (str) (Optional): The train and test metrics of every scored combination, one row per combination, that can be ranked again with new weights by Rerank. File type: output. Accepted formats: CSV (edam:format_3752).
         properties (dict):
             * **prediction_threshold** (*float*) - (1.0) Between 0.5 and 1 and determines what considers to be a positive prediction, if 1 only those predictions where all models agrees are considered to be positive.
             * **num_thread** (*int*) - (10) The number of threads to use for the parallelization of outlier detection.
@@ -34,7 +37,15 @@ class Ensemble(BiobbObject):
             * **label** (*str*) - (None) The path to the labels of the training set in a csv format.
             * **scaler** (*str*) - ("robust") Choose one of the scaler available in scikit-learn, defaults to RobustScaler.
             * **outliers** (*str*) - (None) A list of outliers if any, the name should be the same as in the excel file with the filtered features, you can also specify the path to a file in plain text format, each record should be in a new line.
-           
+            * **search** (*str*) - ("exhaustive") How the combinations of sheets and kfold models are explored, "greedy" grows the best combination one model at a time and "branch_bound" skips the combinations whose upper bound cannot beat the current best, ("exhaustive", "greedy", "branch_bound").
+            * **prediction_cache** (*str*) - (None) Path to the file where the out-of-fold predictions of every (sheet, kfold) model are memoized, it is reused by later runs with the same features and hyperparameters.
+            * **dtype** (*str*) - ("float64") Floating point precision of the feature matrices from extraction to prediction, "float32" halves their memory, ("float32", "float64").
+            * **backend** (*str*) - ("subprocess") Run BioML in a new python process or inside the current interpreter, importing it only once when several blocks are chained from Python. The inprocess backend can not be combined with chdir_sandbox, container_path or dev, ("subprocess", "inprocess").
+            * **cache_dir** (*str*) - (None) Directory of the content addressed cache, the outputs are reused when the contents of the inputs and the properties match a previous run. If None the cache is disabled.
+            * **staging** (*str*) - ("copy") How the inputs are staged in the unique directory and the outputs brought back, "link" reflinks the inputs, hardlinks the read-only ones when reflinks are not supported and copies the rest, and moves the outputs, "symlink" uses symbolic links for the inputs, ("copy", "link", "symlink").
+            * **telemetry_dir** (*str*) - (None) Directory where a JSON telemetry record of every launch is written: wall time of the staging, command, outputs, zipping and cleanup phases, peak RSS, CPU time and io of the command process tree and the input and output sizes. If None no record is written.
+            * **memory_budget** (*float*) - (None) Megabytes shared by the num_thread workers, each of them holding its own copy of the features. num_thread is capped to the workers that fit, with the footprint of a worker taken from the largest process measured with psutil in the previous runs of the telemetry_dir, scaled to the size of the inputs, and BioML queues the rest of the tasks on the smaller pool. It only caps the pool, the tasks are not admitted one by one. Without previous runs num_thread is not capped and a warning is logged. If None num_thread is not capped.
+
     Examples:
         This is a use example of how to use the building block from Python::
 
@@ -47,12 +58,15 @@ class Ensemble(BiobbObject):
                     'report_weight': '0.25',
                     'difference_weight': '1.1',
                     'kfold_parameters': '5:0.2',
-                    'scaler': 'robust'
+                    'scaler': 'robust',
+                    'search': 'branch_bound',
+                    'prediction_cache': 'training_features/ensemble_predictions.npz'
                      }
             ensemble(input_excel='training_features/selected_features.xlsx',
                    input_hyperparameter='training_features/hyperparameters.xlsx',
                    sheets='0,1,2,3,4,5,6,7,8,9,10,11,12,13,14,15',
                    ensemble_output='ensemble.zip',
+                   output_metrics='ensemble_metrics.csv',
                    properties=prop)
 
     Info:
@@ -64,7 +78,11 @@ class Ensemble(BiobbObject):
             * name: EDAM
             * schema: http://edamontology.org/EDAM.owl
     """
-    def __init__(self, input_excel: str, input_hyperparameter: str, sheets: str, label: str, output_ensemble: str, properties: dict = None, **kwargs) -> None:
+    # Properties holding paths, hashed by content in the cache key
+    FILE_PROPERTIES = ("label", "outliers")
+
+    def __init__(self, input_excel: str, input_hyperparameter: str, sheets: str, label: str, output_ensemble: str, output_metrics: str = None,
+                 properties: dict = None, **kwargs) -> None:
         properties = properties or {}
 
         # Call parent class constructor
@@ -73,11 +91,11 @@ class Ensemble(BiobbObject):
         # Input/Output files
         self.io_dict = {
             "in": {"input_excel": input_excel, "input_hyperparameter": input_hyperparameter, "sheets": sheets, "label": label},
-            "out": {"output_ensemble": output_ensemble}
+            "out": {"output_ensemble": output_ensemble, "output_metrics": output_metrics}
         }
 
         # Properties specific for BB
-        self.prediction_threshold = properties.get('rediction_threshold', None)
+        self.prediction_threshold = properties.get('prediction_threshold', None)
         self.num_thread = properties.get('num_thread', None)
         self.precision_weight = properties.get('precision_weight', None)
         self.recall_weight = properties.get('recall_weight', None)
@@ -88,6 +106,14 @@ class Ensemble(BiobbObject):
         self.label = properties.get('label', None)
         self.scaler = properties.get('scaler', None)
         self.outliers = properties.get('outliers', None)
+        self.search = properties.get('search', None)
+        self.prediction_cache = properties.get('prediction_cache', None)
+        self.dtype = properties.get('dtype', None)
+        self.backend = properties.get('backend', None)
+        self.cache_dir = properties.get('cache_dir', None)
+        self.staging = properties.get('staging', None)
+        self.telemetry_dir = properties.get('telemetry_dir', None)
+        self.memory_budget = properties.get('memory_budget', None)
 
         # Properties common in all BB
 
@@ -100,8 +126,10 @@ class Ensemble(BiobbObject):
         """Execute the :class:`Ensemble <bioml.ensemble.Ensemble>` object."""
 
         # Setup Biobb
-        if self.check_restart(): return 0
-        self.stage_files()
+        if self.check_restart() or com.check_cache(self): return 0
+        com.stage_files(self)
+        # Every worker holds its own copy of the features, only the ones that fit in the memory budget are started
+        self.num_thread = com.apply_memory_budget(self, self.num_thread)
 
         # This is a placeholder
         fu.log('Creating command line with parameters', self.out_log, self.global_log)
@@ -143,30 +171,53 @@ class Ensemble(BiobbObject):
             self.cmd.append('--outliers')
             for outlier in self.outliers.split(','):
                 self.cmd.append(f'"{outlier}"')
-            
+        if self.search:
+            self.cmd.append('--search')
+            self.cmd.append(self.search)
+        if self.prediction_cache:
+            # Kept outside the staging directory so the memoized predictions survive the cleanup
+            self.cmd.append('--prediction_cache')
+            self.cmd.append(os.path.abspath(self.prediction_cache))
+        if self.io_dict["out"]["output_metrics"]:
+            self.cmd.append('--metrics_table')
+            self.cmd.append(self.stage_io_dict["out"]["output_metrics"])
+
+        if self.dtype:
+            self.cmd.append('--dtype')
+            self.cmd.append(self.dtype)
+
         # Run Biobb block
-        self.run_biobb()
+        com.apply_thread_budget(self, self.num_thread)
+        com.run_block(self)
 
         # Zip the output
         results_path = os.path.join(os.path.dirname(os.path.dirname(self.stage_io_dict['out']['output_ensemble'])), os.path.basename(self.stage_io_dict["out"]["output_ensemble"]))
         to_zip = []
         to_zip.append(os.path.basename(self.stage_io_dict["unique_dir"]))
         print(f"Zipping {to_zip} to {results_path}")
-        com.zip_list(results_path, to_zip)
+        com.zip_list(results_path, to_zip, biobb_object=self)
+
+        # Copy the metrics table to host
+        com.copy_to_host(self, ["output_metrics"])
 
         # Remove temporal files
         self.tmp_files.extend([self.stage_io_dict.get("unique_dir"), ""])
-        self.remove_tmp_files()
+        com.remove_tmp_files(self)
+
+        # Cache the outputs for identical runs and write the telemetry record
+        com.store_cache(self)
+        telemetry.write_record(self)
 
         return self.return_code
 
 
 def ensemble(input_excel: str, input_hyperparameter: str, sheets:str, label: str, output_ensemble: str,
-            properties: dict = None, **kwargs) -> int:
+            output_metrics: str = None, properties: dict = None, **kwargs) -> int:
     """Create :class:`Ensemble <bioml.ensemble.Ensemble>` class and
         execute the :meth:`launch() <bioml.ensemble.Ensemble.launch>` method."""
     return Ensemble(input_excel=input_excel, input_hyperparameter=input_hyperparameter,
-                    sheets=sheets, label=label, output_ensemble=output_ensemble, properties=properties, **kwargs).launch()
+                    sheets=sheets, label=label, output_ensemble=output_ensemble, output_metrics=output_metrics,
+                    properties=properties, **kwargs).launch()
 
 
 def main():
@@ -182,14 +233,19 @@ def main():
     required_args.add_argument('--sheets', required=False)
     required_args.add_argument('--label', required=True)
     required_args.add_argument('--ensemble_output', required=True)
+    parser.add_argument('--output_metrics', required=False)
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of the run, calibrated with the records of telemetry_dir, instead of running it")
 
     args = parser.parse_args()
     config = args.config if args.config else None
     properties = settings.ConfReader(config=config).get_prop_dic()
+    if args.plan:
+        planner.print_plan("Ensemble", {"input_excel": args.input_excel, "input_hyperparameter": args.input_hyperparameter, "sheets": args.sheets, "label": args.label}, properties)
+        return
 
     # Specific call of each building block
     ensemble(input_excel=args.input_excel, input_hyperparameter=args.input_hyperparameter, sheets=args.sheets, label=args.label, output_ensemble=args.ensemble_output,
-            properties=properties)
+            output_metrics=args.output_metrics, properties=properties)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+"""Module containing the on-disk FASTA index and its random access reader.
+
+The index is a text file next to the fasta (``<fasta>.idx``) like the ``.fai`` of samtools, one
+``id<TAB>offset<TAB>length`` line per record sorted by id, where offset and length are the bytes of
+the whole record, header included. The first line keeps the size and modification time of the
+fasta to rebuild a stale index. Records are looked up with a binary search over the index file,
+so fetching k records costs O(k log n) seeks and never loads the whole index.
+"""
+import os
+import typing
+from pathlib import Path
+from biobb_common.tools import file_utils as fu
+
+
+def index_path(fasta: str) -> str:
+    return f"{fasta}.idx"
+
+
+def _signature(fasta: str) -> bytes:
+    stat = Path(fasta).stat()
+    return f"#{stat.st_size}\t{stat.st_mtime_ns}\n".encode()
+
+
+def build_index(fasta: str, index: str = None) -> str:
+    """Write the index of every record of fasta, the first record wins when an id is repeated."""
+    index = index or index_path(fasta)
+    entries: typing.Dict[bytes, typing.Tuple[int, int]] = {}
+    name, start, offset = None, 0, 0
+    with open(fasta, "rb") as fasta_file:
+        for line in fasta_file:
+            if line.startswith(b">"):
+                if name is not None and name not in entries:
+                    entries[name] = (start, offset - start)
+                name, start = line[1:].split(None, 1)[0] if line[1:].strip() else b"", offset
+            offset += len(line)
+    if name is not None and name not in entries:
+        entries[name] = (start, offset - start)
+    tmp_index = f"{index}.{os.getpid()}.tmp"
+    with open(tmp_index, "wb") as index_file:
+        index_file.write(_signature(fasta))
+        for record_id in sorted(entries):
+            record_offset, length = entries[record_id]
+            index_file.write(b"%s\t%d\t%d\n" % (record_id, record_offset, length))
+    os.replace(tmp_index, index)
+    return index
+
+
+class FastaIndex:
+    """Random access to the records of a fasta by id, building or refreshing its index when needed.
+
+    Args:
+        fasta (str): Path to the fasta file.
+        index (str): (``<fasta>.idx``) Path to the index, it is written next to the fasta by default.
+    """
+
+    def __init__(self, fasta: str, index: str = None) -> None:
+        self.fasta = fasta
+        self.index = index or index_path(fasta)
+        if not self._is_fresh():
+            build_index(fasta, self.index)
+        self._index_file = open(self.index, "rb")
+        self._data_start = len(self._index_file.readline())
+        self._size = Path(self.index).stat().st_size
+        self._fasta_file = open(fasta, "rb")
+
+    def _is_fresh(self) -> bool:
+        try:
+            with open(self.index, "rb") as index_file:
+                return index_file.readline() == _signature(self.fasta)
+        except OSError:
+            return False
+
+    def close(self) -> None:
+        self._index_file.close()
+        self._fasta_file.close()
+
+    def __enter__(self) -> "FastaIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _line_start(self, position: int) -> int:
+        """Start of the first index line at or after position."""
+        if position <= self._data_start:
+            return self._data_start
+        self._index_file.seek(position - 1)
+        self._index_file.readline()
+        return self._index_file.tell()
+
+    def locate(self, record_id: str) -> typing.Optional[typing.Tuple[int, int]]:
+        """Offset and length in bytes of the record, None if the id is not in the fasta."""
+        key = record_id.encode()
+        low, high = self._data_start, self._size
+        while low < high:
+            middle = (low + high) // 2
+            start = self._line_start(middle)
+            if start >= high:
+                high = middle
+                continue
+            self._index_file.seek(start)
+            line = self._index_file.readline()
+            name, offset, length = line.rstrip(b"\n").split(b"\t")
+            if name == key:
+                return int(offset), int(length)
+            if name < key:
+                low = start + len(line)
+            else:
+                high = start
+        return None
+
+    def __contains__(self, record_id: str) -> bool:
+        return self.locate(record_id) is not None
+
+    def fetch(self, record_id: str) -> bytes:
+        """The record as written in the fasta, header line included."""
+        location = self.locate(record_id)
+        if location is None:
+            raise KeyError(record_id)
+        self._fasta_file.seek(location[0])
+        return self._fasta_file.read(location[1])
+
+    def ids(self) -> typing.Iterator[str]:
+        """Every id of the fasta, in sorted order."""
+        self._index_file.seek(self._data_start)
+        for line in self._index_file:
+            yield line.split(b"\t", 1)[0].decode()
+
+    def write_subset(self, record_ids: typing.Iterable[str], output_fasta: str) -> typing.List[str]:
+        """Write the records of record_ids in the given order and return the ids that were not found."""
+        missing = []
+        with open(output_fasta, "wb") as output_file:
+            for record_id in record_ids:
+                location = self.locate(record_id)
+                if location is None:
+                    missing.append(record_id)
+                    continue
+                self._fasta_file.seek(location[0])
+                record = self._fasta_file.read(location[1])
+                output_file.write(record if record.endswith(b"\n") else record + b"\n")
+        return missing
+
+
+def read_ids(sequence_ids: typing.Union[str, typing.Iterable[str]]) -> typing.List[str]:
+    """The ids of a sequence_ids property, a list of ids, a comma separated string or a file with one id per line."""
+    if isinstance(sequence_ids, str):
+        if Path(sequence_ids).is_file():
+            with open(sequence_ids) as ids_file:
+                return [line.split()[0].lstrip(">") for line in ids_file if line.strip()]
+        return [record_id.strip() for record_id in sequence_ids.split(",") if record_id.strip()]
+    return [str(record_id) for record_id in sequence_ids]
+
+
+def stage_subset(biobb_object, sequence_ids, file_ref: str = "input_fasta") -> None:
+    """Write the records of sequence_ids as the staged fasta of a block, read through the index of the host fasta.
+
+    The fasta must have been skipped by com.stage_files, so the whole file is never copied. The
+    index is kept next to the host fasta to be reused by the next runs, or in the unique directory
+    when that folder is not writable.
+    """
+    host_fasta = biobb_object.io_dict["in"][file_ref]
+    index = index_path(host_fasta)
+    if not os.access(Path(host_fasta).resolve().parent, os.W_OK):
+        index = str(Path(biobb_object.stage_io_dict["unique_dir"]).joinpath(Path(index).name))
+    record_ids = read_ids(sequence_ids)
+    subset_fasta = biobb_object.stage_io_dict["in"][file_ref]
+    if biobb_object.disable_sandbox:
+        biobb_object.tmp_files.append(subset_fasta)
+    else:
+        # The staged path can be relative to the sandbox or inside the container
+        subset_fasta = str(Path(biobb_object.stage_io_dict["unique_dir"]).joinpath(Path(subset_fasta).name))
+    with FastaIndex(host_fasta, index) as fasta_index:
+        missing = fasta_index.write_subset(record_ids, subset_fasta)
+    if missing:
+        fu.log(f'{len(missing)} of the sequence_ids are not in {host_fasta}: {missing[:10]}', biobb_object.out_log, biobb_object.global_log)
+    fu.log(f'Selected {len(record_ids) - len(missing)} records of {host_fasta} with its index {index}',
+           biobb_object.out_log, biobb_object.global_log)
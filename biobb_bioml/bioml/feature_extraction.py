@@ -11,6 +11,12 @@ from biobb_common.tools import file_utils as fu
 from biobb_common.tools.file_utils import launchlogger
 import zipfile
 from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import fasta_index
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import projection
+from biobb_bioml.bioml import sparse
+from biobb_bioml.bioml import dedup
+from biobb_bioml.bioml import telemetry
 
 
 class Feature_extraction(BiobbObject):
@@ -24,6 +30,7 @@ class Feature_extraction(BiobbObject):
         pssm (str): The zip file with all the pssm files. File type: input. Accepted formats: ZIP (edam:format_3989).
         every_features (str): Csv file with all the features. File type: output. Accepted formats: CSV (edam:format_3752).
         new_features (str): Excel file with the new features. File type: output. Accepted formats: XLSX (edam:format_3754).
+        output_sparse (str) (Optional): Sparse CSR export of every_features, converted from its CSV after the extraction, with the sequence ids and the feature names. every_features is still written dense, the export is smaller to keep and is read without densifying by the out_of_core prefilter of Feature_selection and as the stored_features of a later extraction, for the mostly zero families (tpc, tri_gram_pssm, GTPC, KSCtriad, k_separated_bigrams_pssm...). File type: output. Accepted formats: NPZ (edam:format_4003).
         properties (dict):
             * **ifeature_dir** (*str*) - ("iFeature") Path to the iFeature programme folder.
             * **possum_dir** (*str*) - ("POSSUM_Toolkit") A path to the possum programme.
@@ -38,6 +45,14 @@ class Feature_extraction(BiobbObject):
             * **type** (*str*) - ("all") A list of the features to extract, ("all", "APAAC", "PAAC", "CKSAAGP","Moran", "Geary", "NMBroto", "CTDC", "CTDT", "CTDD", "CTriad", "GDPC", "GTPC", "QSOrder", "SOCNumber", "GAAC", "KSCtriad", "aac_pssm", "ab_pssm", "d_fpssm", "dp_pssm", "dpc_pssm", "edp", "eedp", "rpm_pssm", "k_separated_bigrams_pssm", "pssm_ac", "pssm_cc", "pssm_composition", "rpssm", "s_fpssm", "smoothed_pssm:5", "smoothed_pssm:7", "smoothed_pssm:9", "tpc", "tri_gram_pssm", "pse_pssm:1", "pse_pssm:2", "pse_pssm:3").
             * **type_file** (*str*) - (None) The path to the type file with the feature names.
             * **sheets** (*str*) - (None) Names or index of the selected sheets from the features and the index of the models in this format-> sheet (name, index):index model1,index model2 without the spaces. If only index or name of the sheets, it is assumed that all kfold models are selected. It is possible to have one sheet with kfold indices but in another ones without.
+            * **stored_features** (*str*) - (None) Feature table (CSV or the NPZ of output_sparse) already extracted for the same sequences. With the "filter" purpose only the selected columns, and the rows of sequence_ids when given, are read from it into every_features and new_features and nothing is computed. The run fails when a selected column or one of the sequence_ids is missing from it.
+            * **deduplicate** (*bool*) - (False) Extract the features of every distinct sequence only once, the rows of the first record of a sequence are repeated right after it for the ids of its duplicates in the feature tables, so they are not in the order of input_fasta when the duplicates are not next to each other. Excel tables need openpyxl.
+            * **sequence_ids** (*str*) - (None) Only use these records of input_fasta: a file with one id per line, a comma separated list of ids or a Python list. They are read through an index of the fasta (<input_fasta>.idx, built once and reused) instead of parsing the whole file. If None every record is used.
+            * **dtype** (*str*) - ("float64") Floating point precision of the feature matrices from extraction to prediction, "float32" halves their memory, ("float32", "float64").
+            * **backend** (*str*) - ("subprocess") Run BioML in a new python process or inside the current interpreter, importing it only once when several blocks are chained from Python. The inprocess backend can not be combined with chdir_sandbox, container_path or dev, ("subprocess", "inprocess").
+            * **cache_dir** (*str*) - (None) Directory of the content addressed cache, the outputs are reused when the contents of the inputs and the properties match a previous run. If None the cache is disabled.
+            * **staging** (*str*) - ("copy") How the inputs are staged in the unique directory and the outputs brought back, "link" reflinks the inputs, hardlinks the read-only ones when reflinks are not supported and copies the rest, and moves the outputs, "symlink" uses symbolic links for the inputs, ("copy", "link", "symlink").
+            * **telemetry_dir** (*str*) - (None) Directory where a JSON telemetry record of every launch is written: wall time of the staging, command, outputs and cleanup phases, peak RSS, CPU time and io of the command process tree and the input and output sizes. If None no record is written.
 
     Examples:
         This is a use example of how to use the building block from Python::
@@ -72,8 +87,11 @@ class Feature_extraction(BiobbObject):
             * name: EDAM
             * schema: http://edamontology.org/EDAM.owl
     """
+    # Properties holding paths, hashed by content in the cache key
+    FILE_PROPERTIES = ("excel", "type_file", "stored_features", "sequence_ids")
 
-    def __init__(self, input_fasta: str, every_features: str, new_features: str, pssm: str, properties: dict = None, **kwargs) -> None:
+    def __init__(self, input_fasta: str, every_features: str, new_features: str, pssm: str, output_sparse: str = None,
+                 properties: dict = None, **kwargs) -> None:
         properties = properties or {}
 
         # Call parent class constructor
@@ -87,7 +105,8 @@ class Feature_extraction(BiobbObject):
         self.io_dict = {
             "in": {"input_fasta": input_fasta, "pssm": pssm},
             "out": {"every_features": f"{self.extracted_out}/{every_features}",
-                    "new_features": f"{self.extracted_out}/{new_features}"}
+                    "new_features": f"{self.extracted_out}/{new_features}",
+                    "output_sparse": output_sparse}
         }
 
         if zipfile.is_zipfile(Path(self.io_dict['in']['pssm'])):
@@ -108,7 +127,15 @@ class Feature_extraction(BiobbObject):
         self.num_thread = properties.get('num_thread', None)
         self.type = properties.get('type', None)
         self.type_file = properties.get('type_file', None)
-        self.sheets = properties.get('selected', None)
+        self.sheets = properties.get('sheets', None)
+        self.stored_features = properties.get('stored_features', None)
+        self.deduplicate = properties.get('deduplicate', False)
+        self.sequence_ids = properties.get('sequence_ids', None)
+        self.dtype = properties.get('dtype', None)
+        self.backend = properties.get('backend', None)
+        self.cache_dir = properties.get('cache_dir', None)
+        self.staging = properties.get('staging', None)
+        self.telemetry_dir = properties.get('telemetry_dir', None)
 
         # Properties common in all BB
 
@@ -120,8 +147,14 @@ class Feature_extraction(BiobbObject):
         """Execute the :class:`Feature_extraction <bioml.feature_extraction.Feature_extraction>` object."""
 
         # Setup Biobb
-        if self.check_restart(): return 0
-        self.stage_files()
+        if self.check_restart() or com.check_cache(self): return 0
+        com.stage_files(self, skip=("input_fasta",) if self.sequence_ids else ())
+        if self.sequence_ids:
+            fasta_index.stage_subset(self, self.sequence_ids)
+        duplicates = dedup.stage_unique_fasta(self) if self.deduplicate else {}
+
+        # Only the families of the features selected at training time are computed
+        selected = projection.plan_filter(self) if self.purpose == "filter" and self.excel else None
 
         # This is a placeholder
         fu.log('Creating command line with parameters', self.out_log, self.global_log)
@@ -181,25 +214,68 @@ class Feature_extraction(BiobbObject):
             self.cmd.append('--sheets')
             self.cmd.append(self.sheets)
 
+        if self.dtype:
+            self.cmd.append('--dtype')
+            self.cmd.append(self.dtype)
+
         print(self.cmd)
+
         # Run Biobb block
-        self.run_biobb()
+        if selected is not None and self.stored_features:
+            # Read the selected columns of the stored features instead of computing them
+            rows = fasta_index.read_ids(self.sequence_ids) if self.sequence_ids else None
+            missing, missing_rows = projection.project_columns(self.stored_features, selected, self.stage_io_dict["out"]["every_features"], rows)
+            fu.log(f'Read {len(selected) - len(missing)} columns of {self.stored_features}', self.out_log, self.global_log)
+            duplicates = {}
+            self.return_code = 0
+            if missing:
+                fu.log(f'ERROR: {len(missing)} selected features are not in {self.stored_features}: {missing[:10]}', self.out_log, self.global_log)
+                self.return_code = 1
+            if missing_rows:
+                fu.log(f'ERROR: {len(missing_rows)} of the sequence_ids are not in {self.stored_features}: {missing_rows[:10]}', self.out_log, self.global_log)
+                self.return_code = 1
+            if not missing:
+                # The selected features of every sheet, like BioML writes them for the filter purpose
+                projection.write_new_features(self.stage_io_dict["out"]["every_features"], projection.sheet_headers(self.excel, self.sheets),
+                                              self.stage_io_dict["out"]["new_features"])
+        else:
+            com.apply_thread_budget(self, self.num_thread)
+            com.run_block(self)
+
+        # Give the duplicated sequences the features of the record that was extracted
+        if duplicates:
+            for file_ref in ("every_features", "new_features"):
+                if Path(self.stage_io_dict["out"][file_ref]).exists():
+                    dedup.fan_out_rows(self.stage_io_dict["out"][file_ref], duplicates, self.out_log, self.global_log)
+
+        # Sparse copy of every feature, written row by row from the csv
+        if self.stage_io_dict["out"].get("output_sparse") and Path(self.stage_io_dict["out"]["every_features"]).exists():
+            stats = sparse.csv_to_csr(self.stage_io_dict["out"]["every_features"], self.stage_io_dict["out"]["output_sparse"],
+                                      dtype=self.dtype or "float64")
+            fu.log(f'Sparse features: {stats["rows"]}x{stats["columns"]}, density {stats["density"]}, '
+                   f'{stats["sparse_bytes"]} bytes instead of {stats["dense_bytes"]} dense', self.out_log, self.global_log)
 
         # Copy to host
-        self.copy_to_host()
+        com.copy_to_host(self)
 
         # Remove temporal files
         self.tmp_files.extend([self.stage_io_dict.get("unique_dir"), ""])
         self.tmp_files.extend(self.pssm_directory+'/pssm')
-        self.remove_tmp_files()
+        com.remove_tmp_files(self)
+
+        # Cache the outputs for identical runs and write the telemetry record
+        com.store_cache(self)
+        telemetry.write_record(self)
 
         return self.return_code
 
 
-def feature_extraction(input_fasta: str, pssm: str, new_features: str, every_features: str, properties: dict = None, **kwargs) -> int:
+def feature_extraction(input_fasta: str, pssm: str, new_features: str, every_features: str, output_sparse: str = None,
+                       properties: dict = None, **kwargs) -> int:
     """Create :class:`Feature_extraction <bioml.feature_extraction.Feature_extraction>` class and
         execute the :meth:`launch() <bioml.feature_extraction.Feature_extraction.launch>` method."""
-    return Feature_extraction(input_fasta=input_fasta, pssm=pssm, new_features=new_features, every_features=every_features, properties=properties, **kwargs).launch()
+    return Feature_extraction(input_fasta=input_fasta, pssm=pssm, new_features=new_features, every_features=every_features,
+                              output_sparse=output_sparse, properties=properties, **kwargs).launch()
 
 
 def main():
@@ -214,13 +290,19 @@ def main():
     required_args.add_argument('--pssm', required=True)
     required_args.add_argument('--new_features', required=False)
     required_args.add_argument('--every_features', required=False)
+    parser.add_argument('--output_sparse', required=False)
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of the run, calibrated with the records of telemetry_dir, instead of running it")
 
     args = parser.parse_args()
     config = args.config if args.config else None
     properties = settings.ConfReader(config=config).get_prop_dic()
+    if args.plan:
+        planner.print_plan("Feature_extraction", {"input_fasta": args.input_fasta, "pssm": args.pssm}, properties)
+        return
 
     # Specific call of each building block
-    feature_extraction(input_fasta=args.input_fasta, pssm=args.pssm, new_features=args.new_features, every_features=args.every_features, properties=properties)
+    feature_extraction(input_fasta=args.input_fasta, pssm=args.pssm, new_features=args.new_features, every_features=args.every_features,
+                       output_sparse=args.output_sparse, properties=properties)
 
 
 if __name__ == '__main__':
@@ -10,6 +10,10 @@ from biobb_common.configuration import settings
 from biobb_common.tools import file_utils as fu
 from biobb_common.tools.file_utils import launchlogger
 from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import prefilter
+from biobb_bioml.bioml import sparse
+from biobb_bioml.bioml import telemetry
 
 
 
@@ -21,7 +25,7 @@ class Feature_selection(BiobbObject):
     | Preprocess and Select the best features.
 
     Args:
-        input_features (str): The path to the training features that contains both ifeature and possum in csv format. File type: input. Accepted formats: CSV (edam:format_3752).
+        input_features (str): The path to the training features that contains both ifeature and possum in csv format, or the sparse output_sparse of Feature_extraction, read without densifying by the out_of_core prefilter and otherwise written as a dense CSV for BioML. File type: input. Accepted formats: CSV (edam:format_3752), NPZ (edam:format_4003).
         label (str): The path to the labels of the training set in a csv format if not in the features, if present in the features csv use the flag to specify the label column name. File type: input. Accepted formats: CSV (edam:format_3752).
         output_excel (str): The file path to where the selected features will be saved in excel format. File type: output. Accepted formats: XLSX (edam:format_3620).
         output_zip (str): A zip file with the extra parameters. File type: output. Accepted formats: ZIP (edam:format_3987).
@@ -35,6 +39,14 @@ class Feature_selection(BiobbObject):
             * **plot** (*bool*) - (True) Default to true, plot the feature importance using shap.
             * **plot_num_features** (*int*) - (20) How many features to include in the plot.
             * **num_filters** (*int*) - (10) The number univariate filters to use maximum 10".
+            * **out_of_core** (*bool*) - (False) Stream input_features in chunks of rows to compute the variance and univariate F score of every feature within prefilter_memory_mb, so BioML only loads the candidate_features best features for its filters and RFE. For tables larger than the memory of the node. The F score ranking runs before the univariate filters of BioML and can drop features they would have selected, the selection may differ from an in-memory run.
+            * **prefilter_memory_mb** (*float*) - (4096) Megabytes of rows held at once by the out_of_core prefilter.
+            * **candidate_features** (*int*) - (2000) Features kept by the out_of_core prefilter, the highest F scores among the non constant features. If 0 every non constant feature is kept and BioML filters them all.
+            * **dtype** (*str*) - ("float64") Floating point precision of the feature matrices from extraction to prediction, "float32" halves their memory, ("float32", "float64").
+            * **backend** (*str*) - ("subprocess") Run BioML in a new python process or inside the current interpreter, importing it only once when several blocks are chained from Python. The inprocess backend can not be combined with chdir_sandbox, container_path or dev, ("subprocess", "inprocess").
+            * **cache_dir** (*str*) - (None) Directory of the content addressed cache, the outputs are reused when the contents of the inputs and the properties match a previous run. If None the cache is disabled.
+            * **staging** (*str*) - ("copy") How the inputs are staged in the unique directory and the outputs brought back, "link" reflinks the inputs, hardlinks the read-only ones when reflinks are not supported and copies the rest, and moves the outputs, "symlink" uses symbolic links for the inputs, ("copy", "link", "symlink").
+            * **telemetry_dir** (*str*) - (None) Directory where a JSON telemetry record of every launch is written: wall time of the staging, command, outputs, zipping and cleanup phases, peak RSS, CPU time and io of the command process tree and the input and output sizes. If None no record is written.
 
     Examples:
         This is a use example of how to use the building block from Python::
@@ -87,6 +99,14 @@ class Feature_selection(BiobbObject):
         self.plot = properties.get('plot', None)
         self.plot_num_features = properties.get('plot_num_features', None)
         self.num_filters = properties.get('num_filters', None)
+        self.out_of_core = properties.get('out_of_core', False)
+        self.prefilter_memory_mb = properties.get('prefilter_memory_mb', 4096)
+        self.candidate_features = properties.get('candidate_features', 2000)
+        self.dtype = properties.get('dtype', None)
+        self.backend = properties.get('backend', None)
+        self.cache_dir = properties.get('cache_dir', None)
+        self.staging = properties.get('staging', None)
+        self.telemetry_dir = properties.get('telemetry_dir', None)
 
         # Properties common in all BB
 
@@ -98,8 +118,18 @@ class Feature_selection(BiobbObject):
         """Execute the :class:`feature_selection <bioml.feature_selection.feature_selection>` object."""
 
         # Setup Biobb
-        if self.check_restart(): return 0
-        self.stage_files()
+        if self.check_restart() or com.check_cache(self): return 0
+        com.stage_files(self)
+
+        # Reduce the features out of core before BioML loads them
+        if self.out_of_core:
+            features = self.stage_io_dict["in"]["input_features"]
+            reduced = str(Path(features).with_name(f"candidates_{Path(features).name}"))
+            prefilter.prefilter(features, self.stage_io_dict["in"]["label"], reduced, int(self.candidate_features),
+                                float(self.prefilter_memory_mb), self.out_log, self.global_log)
+            self.stage_io_dict["in"]["input_features"] = reduced
+            self.tmp_files.append(reduced)
+        sparse.stage_dense(self, "input_features")
 
         # This is a placeholder
         fu.log('Creating command line with parameters', self.out_log, self.global_log)
@@ -127,8 +157,12 @@ class Feature_selection(BiobbObject):
         if self.num_filters:
             self.cmd.append(f"--num_filters {self.num_filters}")
 
+        if self.dtype:
+            self.cmd.append(f"--dtype {self.dtype}")
+
         # Run Biobb block
-        self.run_biobb()
+        com.apply_thread_budget(self, self.num_thread)
+        com.run_block(self)
 
         # Zip output
         results_path = os.path.join(os.path.dirname(os.path.dirname(self.stage_io_dict['out']['output_zip'])), os.path.basename(self.stage_io_dict["out"]["output_zip"]))
@@ -136,12 +170,16 @@ class Feature_selection(BiobbObject):
         unique= os.path.basename(self.stage_io_dict["unique_dir"])
         to_zip.append(f"{unique}/shap_features")
         print(f"Zipping {to_zip} to {results_path}")
-        com.zip_list(results_path, to_zip)
+        com.zip_list(results_path, to_zip, biobb_object=self)
 
 
         # Remove temporal files
         self.tmp_files.extend([self.stage_io_dict.get("unique_dir"), ""])
-        self.remove_tmp_files()
+        com.remove_tmp_files(self)
+
+        # Cache the outputs for identical runs and write the telemetry record
+        com.store_cache(self)
+        telemetry.write_record(self)
 
         return self.return_code
 
@@ -164,10 +202,14 @@ def main():
     required_args.add_argument('--label', required=True)
     required_args.add_argument('--output_excel', required=True)
     required_args.add_argument('--output_zip', required=False)
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of the run, calibrated with the records of telemetry_dir, instead of running it")
 
     args = parser.parse_args()
     config = args.config if args.config else None
     properties = settings.ConfReader(config=config).get_prop_dic()
+    if args.plan:
+        planner.print_plan("Feature_selection", {"input_features": args.input_features, "label": args.label}, properties)
+        return
 
     # Specific call of each building block
     feature_selection(input_features=args.input_features, label=args.label, output_excel=args.output_excel, output_zip=args.output_zip, properties=properties)
@@ -2,6 +2,7 @@
 
 """Module containing the Generate model class and the command line interface."""
 import os
+import csv
 import shutil
 import argparse
 from pathlib import Path
@@ -9,7 +10,12 @@ from biobb_common.generic.biobb_object import BiobbObject
 from biobb_common.configuration import settings
 from biobb_common.tools import file_utils as fu
 from biobb_common.tools.file_utils import launchlogger
+from biobb_bioml.bioml import cascade
 from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import distill
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import sketch
+from biobb_bioml.bioml import telemetry
 
 
 
@@ -25,11 +31,23 @@ class Generate_model(BiobbObject):
         sheets (str): Names or index of the selected sheets for both features and hyperparameters and the index of the models in this format-> sheet (name, index):index model1,index model2 without the spaces. If only index or name of the sheets, it is assumed that all kfold models are selected. It is possible to have kfold indices in one sheet and in another ones without. File type: input. Accepted formats: STRING (edam:format_2560).
         label (str): The path to the labels of the training set in a csv format. File type: input. Accepted formats: CSV (edam:format_3752).
         output_model (str): The directory for the generated models. File type: output. Accepted formats: ZIP (edam:format_3987).
+        output_scaler (str) (Optional): The robust scaler of the features of input_excel, only written when scaler is robust, fitted with streaming quantile sketches (num_thread workers merging their sketches) and also saved as scaler.npz among the models, so Predict scales new samples without the training features. File type: output. Accepted formats: NPZ (edam:format_4003).
+        output_student (str) (Optional): The student model distilled from the ensemble when distill is set, also saved as student.npz among the models. It can be given to Predict as student. File type: output. Accepted formats: NPZ (edam:format_4003).
         properties (dict):
             * **num_thread** (*int*) - (10) The number of threads to use for the parallelization of outlier detection.
             * **scaler** (*str*) - ("robust") Choose one of the scaler available in scikit-learn, defaults to RobustScaler.
             * **label** (*str*) - (None) The path to the labels of the training set in a csv format.
             * **outliers** (*str*) - (None) A list of outliers if any, the name should be the same as in the excel file with the filtered features, you can also specify the path to a file in plain text format, each record should be in a new line.
+            * **parallel_jobs** (*int*) - (None) Fit the (sheet, kfold) models as this many parallel jobs, num_thread is split between them so the jobs and their BLAS/OpenMP threads do not oversubscribe the cores. If None all the models are fitted by a single process.
+            * **jobs_report** (*str*) - (None) Path to a csv file where the fit time and peak memory of every parallel job are reported.
+            * **memory_budget** (*float*) - (None) Megabytes shared by the parallel_jobs. The first job runs alone to measure its peak memory with psutil, then only as many jobs as fit in the budget with the largest peak measured run at the same time and the rest wait. If None the jobs are not limited by memory.
+            * **distill** (*bool*) - (False) Train a single student model, a logistic regression, on the soft votes of the generated models over the training features and unlabeled_features. The agreement of the student with the ensemble is logged and added to the telemetry record.
+            * **unlabeled_features** (*str*) - (None) Feature table (CSV or Excel) of unlabeled sequences with the columns of input_excel, used with the training features to distill the student.
+            * **dtype** (*str*) - ("float64") Floating point precision of the feature matrices from extraction to prediction, "float32" halves their memory, ("float32", "float64").
+            * **backend** (*str*) - ("subprocess") Run BioML in a new python process or inside the current interpreter, importing it only once when several blocks are chained from Python. The inprocess backend can not be combined with chdir_sandbox, container_path or dev, ("subprocess", "inprocess").
+            * **cache_dir** (*str*) - (None) Directory of the content addressed cache, the outputs are reused when the contents of the inputs and the properties match a previous run. If None the cache is disabled.
+            * **staging** (*str*) - ("copy") How the inputs are staged in the unique directory and the outputs brought back, "link" reflinks the inputs, hardlinks the read-only ones when reflinks are not supported and copies the rest, and moves the outputs, "symlink" uses symbolic links for the inputs, ("copy", "link", "symlink").
+            * **telemetry_dir** (*str*) - (None) Directory where a JSON telemetry record of every launch is written: wall time of the staging, command, outputs, zipping and cleanup phases, peak RSS, CPU time and io of the command process tree and the input and output sizes. If None no record is written.
 
     Examples:
         This is a use example of how to use the building block from Python::
@@ -37,7 +55,9 @@ class Generate_model(BiobbObject):
             from biobb_bioml.generate_model import generate_model
             prop = { num_thread: 10,
                     scaler: 'robust',
-                    outliers: 'training_features/outliers.csv'}
+                    outliers: 'training_features/outliers.csv',
+                    parallel_jobs: 5,
+                    jobs_report: 'generate_model_jobs.csv'}
                     
             generate_model(input_excel='training_features/selected_features.xlsx',
                             input_hyperparameter='training_features/hyperparameters.xlsx',
@@ -55,7 +75,11 @@ class Generate_model(BiobbObject):
             * name: EDAM
             * schema: http://edamontology.org/EDAM.owl
     """
-    def __init__(self, input_excel: str, input_hyperparameter: str, sheets: str, label: str, output_model: str, properties: dict = None, **kwargs) -> None:
+    # Properties holding paths, hashed by content in the cache key
+    FILE_PROPERTIES = ("outliers",)
+
+    def __init__(self, input_excel: str, input_hyperparameter: str, sheets: str, label: str, output_model: str, output_scaler: str = None,
+                 output_student: str = None, properties: dict = None, **kwargs) -> None:
         properties = properties or {}
 
         # Call parent class constructor
@@ -67,13 +91,26 @@ class Generate_model(BiobbObject):
         # Input/Output files
         self.io_dict = {
             "in": {"input_excel": input_excel, "input_hyperparameter": input_hyperparameter, "sheets": sheets, "label": label},
-            "out": {"output_model": output_model}
+            "out": {"output_model": output_model, "output_scaler": output_scaler, "output_student": output_student}
         }
 
         # Properties specific for BB
         self.num_thread = properties.get('num_thread', None)
         self.scaler = properties.get('scaler', None)
         self.outliers = properties.get('outliers', None)
+        self.parallel_jobs = properties.get('parallel_jobs', None)
+        self.jobs_report = properties.get('jobs_report', None)
+        self.memory_budget = properties.get('memory_budget', None)
+        self.distill = properties.get('distill', False)
+        self.unlabeled_features = properties.get('unlabeled_features', None)
+        # Staged like the other inputs and outputs
+        self.io_dict["in"]["unlabeled_features"] = self.unlabeled_features
+        self.io_dict["out"]["jobs_report"] = self.jobs_report
+        self.dtype = properties.get('dtype', None)
+        self.backend = properties.get('backend', None)
+        self.cache_dir = properties.get('cache_dir', None)
+        self.staging = properties.get('staging', None)
+        self.telemetry_dir = properties.get('telemetry_dir', None)
 
         # Properties common in all BB
 
@@ -85,8 +122,8 @@ class Generate_model(BiobbObject):
         """Execute the :class:`generate_model <bioml.generate_model.generate_model>` object."""
 
         # Setup Biobb
-        if self.check_restart(): return 0
-        self.stage_files()
+        if self.check_restart() or com.check_cache(self): return 0
+        com.stage_files(self)
 
         # This is a placeholder
         fu.log('Creating command line with parameters', self.out_log, self.global_log)
@@ -107,27 +144,103 @@ class Generate_model(BiobbObject):
             self.cmd.append('--outliers')
             self.cmd.append(str(self.outliers))
 
+        if self.dtype:
+            self.cmd.append('--dtype')
+            self.cmd.append(self.dtype)
+
         # Run Biobb block
-        self.run_biobb()
+        if self.parallel_jobs and int(self.parallel_jobs) > 1:
+            com.run_block(self, run=self.run_parallel_jobs)
+        else:
+            com.apply_thread_budget(self, self.num_thread)
+            com.run_block(self)
+
+        # Save the scaler and distill the ensemble into the student, with the models before zipping them
+        if self.io_dict["out"]["output_scaler"] and not self.return_code:
+            self.save_scaler()
+        if self.distill and not self.return_code:
+            distill.run(self)
 
         # Zip output
         results_path = os.path.join(os.path.dirname(os.path.dirname(self.stage_io_dict['out']['output_model'])), os.path.basename(self.stage_io_dict["out"]["output_model"]))
         to_zip = []
         to_zip.append(os.path.basename(self.stage_io_dict["out"]["output_model"]).rstrip('.zip'))
         print(f"Zipping {to_zip} to {results_path}")
-        com.zip_list(results_path, to_zip)
+        com.zip_list(results_path, to_zip, biobb_object=self)
 
         # Remove temporal files
         self.tmp_files.extend([self.stage_io_dict.get("unique_dir"), ""])
-        self.remove_tmp_files()
+        com.remove_tmp_files(self)
+
+        # Cache the outputs for identical runs and write the telemetry record
+        com.store_cache(self)
+        telemetry.write_record(self)
 
         return self.return_code
 
+    def save_scaler(self) -> None:
+        """Fit the robust scaler of input_excel with quantile sketches and save it to output_scaler and among the models.
+
+        Nothing is saved when the scaler property is not robust, the models were not fitted on robust scaled features.
+        """
+        if (self.scaler or "robust") != "robust":
+            fu.log(f'The scaler is {self.scaler}, not robust: output_scaler is not written and Predict fits the {self.scaler} scaler on input_excel',
+                   self.out_log, self.global_log)
+            return
+        scaler = sketch.StreamingRobustScaler().fit_table(self.stage_io_dict["in"]["input_excel"], workers=int(self.num_thread or 1))
+        model_dir = self.stage_io_dict["out"]["output_model"].rstrip('.zip')
+        os.makedirs(model_dir, exist_ok=True)
+        scaler.save(os.path.join(model_dir, cascade.SCALER_NAME))
+        os.makedirs(os.path.dirname(os.path.abspath(self.io_dict["out"]["output_scaler"])), exist_ok=True)
+        scaler.save(self.io_dict["out"]["output_scaler"])
+        fu.log(f'Robust scaler of {len(scaler.columns)} features fitted on {scaler.sketch.count} samples with quantile sketches',
+               self.out_log, self.global_log)
+
+    def run_parallel_jobs(self) -> None:
+        """Fit every (sheet, kfold) model in its own child process sharing the num_thread budget."""
+        jobs = com.parse_sheets(self.stage_io_dict["in"]["sheets"])
+        cores = min(com.host_cores(), int(self.num_thread)) if self.num_thread else None
+        workers, threads_per_job = com.thread_budget(min(int(self.parallel_jobs), len(jobs)), cores=cores)
+        fu.log(f'Fitting {len(jobs)} jobs with {workers} workers and {threads_per_job} threads per job', self.out_log, self.global_log)
+
+        sheets_index = self.cmd.index('--sheets') + 1
+        job_cmds = []
+        for sheet, fold in jobs:
+            job_cmd = list(self.cmd)
+            job_cmd[sheets_index] = f"{sheet}:{fold}" if fold is not None else sheet
+            if '--num_thread' in job_cmd:
+                job_cmd[job_cmd.index('--num_thread') + 1] = str(threads_per_job)
+            else:
+                job_cmd.extend(['--num_thread', str(threads_per_job)])
+            job_cmds.append((f"{sheet}_{fold}" if fold is not None else str(sheet), com.job_cmd_line(self, job_cmd)))
+
+        admission = com.AdmissionController(float(self.memory_budget), workers) if self.memory_budget else None
+        records = com.run_jobs(job_cmds, max_workers=workers, threads_per_job=threads_per_job,
+                               log_dir=self.stage_io_dict["unique_dir"], out_log=self.out_log, global_log=self.global_log,
+                               admission=admission, env=self.env_vars_dict)
+        if admission:
+            self.admission_report = admission.report()
+            fu.log(f'Memory budget: at most {admission.peak_running} of {workers} jobs ran at the same time with {admission.footprint} MB each, '
+                   f'{admission.queued} jobs waited for memory', self.out_log, self.global_log)
+        failed = [record["job"] for record in records if record["return_code"] != 0]
+        if failed:
+            fu.log(f'The jobs {failed} failed, check their logs in {self.stage_io_dict["unique_dir"]}', self.out_log, self.global_log)
+        self.return_code = 1 if failed else 0
+
+        if self.jobs_report:
+            with open(self.stage_io_dict["out"]["jobs_report"], 'w', newline='') as report:
+                writer = csv.DictWriter(report, fieldnames=["job", "return_code", "wall_time", "peak_rss_mb"])
+                writer.writeheader()
+                writer.writerows(records)
+            com.copy_to_host(self, ["jobs_report"])
+
 
-def generate_model(input_excel: str, input_hyperparameter: str, sheets: str, label: str, output_model: str, properties: dict = None, **kwargs) -> int:
+def generate_model(input_excel: str, input_hyperparameter: str, sheets: str, label: str, output_model: str, output_scaler: str = None,
+                   output_student: str = None, properties: dict = None, **kwargs) -> int:
     """Create :class:`generate_model <bioml.generate_model.Generate_model>` class and
         execute the :meth:`launch() <bioml.generate_model.generate_model.launch>` method."""
-    return Generate_model(input_excel=input_excel, input_hyperparameter=input_hyperparameter, sheets=sheets, label=label, output_model=output_model, properties=properties, **kwargs).launch()
+    return Generate_model(input_excel=input_excel, input_hyperparameter=input_hyperparameter, sheets=sheets, label=label, output_model=output_model,
+                          output_scaler=output_scaler, output_student=output_student, properties=properties, **kwargs).launch()
 
 
 def main():
@@ -143,13 +256,20 @@ def main():
     required_args.add_argument('--sheets', required=True)
     required_args.add_argument('--label', required=True)
     required_args.add_argument('--output_model', required=True)
+    parser.add_argument('--output_scaler', required=False)
+    parser.add_argument('--output_student', required=False)
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of the run, calibrated with the records of telemetry_dir, instead of running it")
 
     args = parser.parse_args()
     config = args.config if args.config else None
     properties = settings.ConfReader(config=config).get_prop_dic()
+    if args.plan:
+        planner.print_plan("Generate_model", {"input_excel": args.input_excel, "input_hyperparameter": args.input_hyperparameter, "sheets": args.sheets, "label": args.label}, properties)
+        return
 
     # Specific call of each building block
-    generate_model(input_excel=args.input_excel, input_hyperparameter=args.input_hyperparameter, sheets=args.sheets, label=args.label, output_model=args.output_model, properties=properties)
+    generate_model(input_excel=args.input_excel, input_hyperparameter=args.input_hyperparameter, sheets=args.sheets, label=args.label, output_model=args.output_model,
+                   output_scaler=args.output_scaler, output_student=args.output_student, properties=properties)
 
 
 if __name__ == '__main__':
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
 
 """Module containing the Generate pssm class and the command line interface."""
+import os
 import argparse
+from contextlib import nullcontext
 from biobb_common.generic.biobb_object import BiobbObject
 from biobb_common.configuration import settings
 from biobb_common.tools import file_utils as fu
 from biobb_common.tools.file_utils import launchlogger
+from biobb_bioml.bioml import blastdb
 from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import fasta_index
+from biobb_bioml.bioml import dedup
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import pseudo_pssm
+from biobb_bioml.bioml import streaming
+from biobb_bioml.bioml import telemetry
 
 
 class Generate_pssm(BiobbObject):
@@ -18,13 +27,26 @@ class Generate_pssm(BiobbObject):
     Args:
         input_fasta (str): The fasta file.  File type: input. Accepted formats: FASTA (edam:format_1929).
         output_pssm (str): A zip file containing the pssm files. File type: output. Accepted formats: ZIP (edam:format_3989).
+        output_features (str) (Optional): The POSSUM descriptors of stream_descriptors of every sequence, computed by feature workers while PSI-BLAST is still profiling the next sequences. It can be given to Feature_extraction as stored_features. File type: output. Accepted formats: CSV (edam:format_3752).
         properties (dict - Python dictionary object containing the tool parameters, not input/output files):
-            * **dbinp** (*str*) - (None) The path to the fasta files to create the database.
+            * **mode** (*str*) - ("psiblast") How the profiles are made, "pseudo" skips PSI-BLAST and uses the BLOSUM62 row of every residue, biased by the composition of profile_db, as a quick first-pass profile in the same pssm format, ("psiblast", "pseudo").
+            * **profile_db** (*str*) - (None) Fasta of sequences related to the input ones whose amino acid composition biases the pseudo profiles. Only used by the "pseudo" mode.
+            * **dbinp** (*str*) - (None) The path to the fasta files to create the database. The database is only built when it is missing or dbinp changed since the last build (size, modification time and hash of the headers in <dbout>.fingerprint.json), concurrent runs sharing dbout wait for a single build.
+            * **makeblastdb_path** (*str*) - ("makeblastdb") Path to the makeblastdb executable used to build the database from dbinp.
             * **dbout** (*str*) - ("database/uniref50") The name for the created database.
             * **num_thread** (*int*) - (100) The number of threads to use for the generation of pssm profiles.
             * **number** (*str*) - ("*") A number for the files.
             * **iterations** (*int*) - (3) The number of iterations in PSIBlast.
             * **possum_dir** (*str*) - ("POSSUM_Toolkit") A path to the possum programme.
+            * **stream_descriptors** (*str*) - ("aac_pssm dpc_pssm pssm_ac") The POSSUM descriptors written to output_features, ("aac_pssm", "dpc_pssm", "pssm_ac").
+            * **stream_batch_size** (*int*) - (16) The number of finished pssm files handed at once to a feature worker.
+            * **stream_workers** (*int*) - (2) The number of feature workers running next to PSI-BLAST.
+            * **deduplicate** (*bool*) - (False) Profile every distinct sequence only once, the pssm of the first record of a sequence is copied to the ids of its duplicates in the output zip.
+            * **sequence_ids** (*str*) - (None) Only use these records of input_fasta: a file with one id per line, a comma separated list of ids or a Python list. They are read through an index of the fasta (<input_fasta>.idx, built once and reused) instead of parsing the whole file. If None every record is used.
+            * **backend** (*str*) - ("subprocess") Run BioML in a new python process or inside the current interpreter, importing it only once when several blocks are chained from Python. The inprocess backend can not be combined with chdir_sandbox, container_path or dev, ("subprocess", "inprocess").
+            * **cache_dir** (*str*) - (None) Directory of the content addressed cache, the outputs are reused when the contents of the inputs and the properties match a previous run. If None the cache is disabled.
+            * **staging** (*str*) - ("copy") How the inputs are staged in the unique directory and the outputs brought back, "link" reflinks the inputs, hardlinks the read-only ones when reflinks are not supported and copies the rest, and moves the outputs, "symlink" uses symbolic links for the inputs, ("copy", "link", "symlink").
+            * **telemetry_dir** (*str*) - (None) Directory where a JSON telemetry record of every launch is written: wall time of the staging, command, outputs, zipping and cleanup phases, peak RSS, CPU time and io of the command process tree and the input and output sizes. If None no record is written.
 
     Examples:
         This is a use example of how to use the building block from Python::
@@ -49,8 +71,12 @@ class Generate_pssm(BiobbObject):
             * name: EDAM
             * schema: http://edamontology.org/EDAM.owl
     """
+    # Properties holding paths, hashed by content in the cache key
+    FILE_PROPERTIES = ("profile_db", "sequence_ids")
+    # Database fasta, keyed by its path, size and modification time like the blastdb fingerprint
+    FINGERPRINT_PROPERTIES = ("dbinp",)
 
-    def __init__(self, input_fasta: str, output_pssm: str, properties: dict = None, **kwargs) -> None:
+    def __init__(self, input_fasta: str, output_pssm: str, output_features: str = None, properties: dict = None, **kwargs) -> None:
         properties = properties or {}
 
         # Call parent class constructor
@@ -59,16 +85,28 @@ class Generate_pssm(BiobbObject):
         # Input/Output files
         self.io_dict = {
             "in": {"input_fasta": input_fasta},
-            "out": {"output_pssm": output_pssm}
+            "out": {"output_pssm": output_pssm, "output_features": output_features}
         }
 
         # Properties specific for BB
+        self.mode = properties.get('mode', "psiblast")
+        self.profile_db = properties.get('profile_db', None)
         self.dbinp = properties.get('dbinp', None)
         self.dbout = properties.get('dbout', None)
+        self.makeblastdb_path = properties.get('makeblastdb_path', 'makeblastdb')
         self.num_thread = properties.get('num_thread', None)
         self.number = properties.get('number', None)
         self.iterations = properties.get('iterations', None)
         self.possum_dir = properties.get('possum_dir', None)
+        self.stream_descriptors = properties.get('stream_descriptors', "aac_pssm dpc_pssm pssm_ac")
+        self.stream_batch_size = properties.get('stream_batch_size', 16)
+        self.stream_workers = properties.get('stream_workers', 2)
+        self.deduplicate = properties.get('deduplicate', False)
+        self.sequence_ids = properties.get('sequence_ids', None)
+        self.backend = properties.get('backend', None)
+        self.cache_dir = properties.get('cache_dir', None)
+        self.staging = properties.get('staging', None)
+        self.telemetry_dir = properties.get('telemetry_dir', None)
 
         # Properties common in all BB
 
@@ -80,21 +118,23 @@ class Generate_pssm(BiobbObject):
         """Execute the :class:`generate_pssm <bioml.generate_pssm.generate_pssm>` object."""
 
         # Setup Biobb
-        if self.check_restart(): return 0
-        self.stage_files()
+        if self.check_restart() or com.check_cache(self): return 0
+        com.stage_files(self, skip=("input_fasta",) if self.sequence_ids else ())
+        if self.sequence_ids:
+            fasta_index.stage_subset(self, self.sequence_ids)
+        order = streaming.fasta_ids(self.stage_io_dict["in"]["input_fasta"]) if self.io_dict["out"]["output_features"] else None
+        duplicates = dedup.stage_unique_fasta(self) if self.deduplicate else {}
 
         # This is a placeholder
         fu.log('Creating command line with parameters', self.out_log, self.global_log)
         self.cmd = ['python -m BioML.generate_pssm',
                     '--i', self.stage_io_dict["in"]["input_fasta"]]
 
-        if self.dbinp:
-            self.cmd.append('--dbinp')
-            self.cmd.append(self.dbinp)
-
-        if self.dbout:
+        # The database is built here, only when stale, so BioML just searches it
+        dbout = self.dbout or ("database/uniref50" if self.dbinp else None)
+        if dbout:
             self.cmd.append('--dbout')
-            self.cmd.append(self.dbout)
+            self.cmd.append(dbout)
 
         if self.num_thread:
             self.cmd.append('--num_thread')
@@ -113,26 +153,61 @@ class Generate_pssm(BiobbObject):
             self.cmd.append(self.possum_dir)
 
         # Run Biobb block
-        self.run_biobb()
+        com.apply_thread_budget(self, self.num_thread)
+        pssm_dir = self.stage_io_dict["out"]["output_pssm"].rstrip('.zip')
+        stream = nullcontext()
+        if self.io_dict["out"]["output_features"]:
+            # The features of every pssm are computed as soon as PSI-BLAST finishes writing it
+            stream = streaming.PssmStream(pssm_dir, os.path.join(self.stage_io_dict["unique_dir"], "streamed_features"),
+                                          str(self.stream_descriptors).split(), self.stream_batch_size, self.stream_workers,
+                                          out_log=self.out_log, global_log=self.global_log)
+        if self.mode == "pseudo":
+            # No PSI-BLAST, the profiles are written in this process
+            self.cmd = []
+            with stream:
+                com.run_block(self, run=lambda: self.run_pseudo(pssm_dir))
+        else:
+            with blastdb.database(self.dbinp, dbout, self.makeblastdb_path, self.out_log, self.global_log) if self.dbinp else nullcontext(), stream:
+                com.run_block(self)
+        if self.io_dict["out"]["output_features"] and not self.return_code:
+            self.stream_report = stream.write(self.stage_io_dict["out"]["output_features"], order, duplicates)
+
+        # Give the duplicated sequences the pssm of the record that was profiled
+        if duplicates:
+            copied = dedup.fan_out_files(pssm_dir, duplicates, ".pssm")
+            fu.log(f'Copied {copied} pssm files to the duplicated sequences', self.out_log, self.global_log)
 
         # Zip output
         results_path = os.path.join(os.path.dirname(os.path.dirname(self.stage_io_dict['out']['output_pssm'])), os.path.basename(self.stage_io_dict["out"]["output_pssm"]))
         to_zip = []
-        to_zip.append(self.stage_io_dict["out"]["output_pssm"].rstrip('.zip'))
+        to_zip.append(pssm_dir)
         print(f"Zipping {to_zip} to {results_path}")
-        com.zip_list(results_path, to_zip)
+        com.zip_list(results_path, to_zip, biobb_object=self)
+
+        # Copy files to host
+        com.copy_to_host(self)
 
         # Remove temporal files
         self.tmp_files.extend([self.stage_io_dict.get("unique_dir"), ""])
-        self.remove_tmp_files()
+        com.remove_tmp_files(self)
+
+        # Cache the outputs for identical runs and write the telemetry record
+        com.store_cache(self)
+        telemetry.write_record(self)
 
         return self.return_code
 
+    def run_pseudo(self, pssm_dir: str) -> None:
+        """Write the BLOSUM62 pseudo profiles of the staged fasta to pssm_dir."""
+        pseudo_pssm.generate(self.stage_io_dict["in"]["input_fasta"], pssm_dir, self.profile_db, self.out_log, self.global_log)
+        self.return_code = 0
+
 
-def generate_pssm(input_fasta: str, output_pssm: str, properties: dict = None, **kwargs) -> int:
+def generate_pssm(input_fasta: str, output_pssm: str, output_features: str = None, properties: dict = None, **kwargs) -> int:
     """Create :class:`generate_pssm <bioml.generate_pssm.Generate_pssm>` class and
         execute the :meth:`launch() <bioml.generate_pssm.generate_pssm.launch>` method."""
-    return Generate_pssm(input_fasta=input_fasta, output_pssm=output_pssm, properties=properties, **kwargs).launch()
+    return Generate_pssm(input_fasta=input_fasta, output_pssm=output_pssm, output_features=output_features,
+                         properties=properties, **kwargs).launch()
 
 
 def main():
@@ -145,13 +220,19 @@ def main():
     required_args = parser.add_argument_group('required arguments')
     required_args.add_argument('--input_fasta', required=True)
     required_args.add_argument('--output_pssm', required=True)
+    parser.add_argument('--output_features', required=False)
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of the run, calibrated with the records of telemetry_dir, instead of running it")
 
     args = parser.parse_args()
     config = args.config if args.config else None
     properties = settings.ConfReader(config=config).get_prop_dic()
+    if args.plan:
+        planner.print_plan("Generate_pssm", {"input_fasta": args.input_fasta}, properties)
+        return
 
     # Specific call of each building block
-    generate_pssm(input_fasta=args.input_fasta, output_pssm=args.output_pssm, properties=properties)
+    generate_pssm(input_fasta=args.input_fasta, output_pssm=args.output_pssm, output_features=args.output_features,
+                  properties=properties)
 
 
 if __name__ == '__main__':
@@ -7,6 +7,8 @@ from biobb_common.configuration import settings
 from biobb_common.tools import file_utils as fu
 from biobb_common.tools.file_utils import launchlogger
 from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import telemetry
 import os
 
 
@@ -22,6 +24,7 @@ class Model_training(BiobbObject):
         label (str): The path to the labels of the training set in a csv format. File type: input. Accepted formats: csv (edam:format_3752).
         hyperparameters (str): The path to the hyperparameters of the training set in a csv format. File type: output. Accepted formats: xlsx (edam:format_3620).
         training_output (str): ("training_results") The zip where to save the models training results. File type: output. Accepted formats: ZIP (edam:format_3989).
+        output_metrics (str) (Optional): The train and test metrics of every candidate, one row per candidate, that can be ranked again with new weights by Rerank. File type: output. Accepted formats: CSV (edam:format_3752).
         properties (dict):
             * **num_thread** (*int*) - (50) The number of threads to search for the hyperparameter space.
             * **scaler** (*str*) - ("robust") "Choose one of the scaler available in scikit-learn, defaults to RobustScaler. Option: ("robust", "standard", "minmax").
@@ -33,6 +36,12 @@ class Model_training(BiobbObject):
             * **report_weight** (*float*) - (0.25) Weights to specify how relevant is the f1, precision and recall for the ranking of the different features with respect to MCC which is a more general measures of the performance of a model.
             * **difference_weight** (*float*) - (1.1) How important is to have similar training and test metrics.
             * **small** (*str*) - (None) Default to true, if the number of samples is < 300 or if you machine is slow. The hyperparameters tuning will fail if you set trial time short and your machine is slow.
+            * **dtype** (*str*) - ("float64") Floating point precision of the feature matrices from extraction to prediction, "float32" halves their memory, ("float32", "float64").
+            * **backend** (*str*) - ("subprocess") Run BioML in a new python process or inside the current interpreter, importing it only once when several blocks are chained from Python. The inprocess backend can not be combined with chdir_sandbox, container_path or dev, ("subprocess", "inprocess").
+            * **cache_dir** (*str*) - (None) Directory of the content addressed cache, the outputs are reused when the contents of the inputs and the properties match a previous run. If None the cache is disabled.
+            * **staging** (*str*) - ("copy") How the inputs are staged in the unique directory and the outputs brought back, "link" reflinks the inputs, hardlinks the read-only ones when reflinks are not supported and copies the rest, and moves the outputs, "symlink" uses symbolic links for the inputs, ("copy", "link", "symlink").
+            * **telemetry_dir** (*str*) - (None) Directory where a JSON telemetry record of every launch is written: wall time of the staging, command, outputs, zipping and cleanup phases, peak RSS, CPU time and io of the command process tree and the input and output sizes. If None no record is written.
+            * **memory_budget** (*float*) - (None) Megabytes shared by the num_thread workers, each of them holding its own copy of the features. num_thread is capped to the workers that fit, with the footprint of a worker taken from the largest process measured with psutil in the previous runs of the telemetry_dir, scaled to the size of the inputs, and BioML queues the rest of the tasks on the smaller pool. It only caps the pool, the tasks are not admitted one by one. Without previous runs num_thread is not capped and a warning is logged. If None num_thread is not capped.
 
     Examples:
         This is a use example of how to use the building block from Python::
@@ -50,6 +59,7 @@ class Model_training(BiobbObject):
             model_training(input_excel='training_features/selected_features.xlsx',
                             label='training_features/labels.csv',
                             training_output: 'training_results.zip',
+                            output_metrics: 'training_results/metrics.csv',
                             properties=prop)
 
     Info:
@@ -61,7 +71,11 @@ class Model_training(BiobbObject):
             * name: EDAM
             * schema: http://edamontology.org/EDAM.owl
     """
-    def __init__(self, input_excel: str, label: str, hyperparameters: str, training_output: str, properties: dict = None, **kwargs) -> None:
+    # Properties holding paths, hashed by content in the cache key
+    FILE_PROPERTIES = ("outliers",)
+
+    def __init__(self, input_excel: str, label: str, hyperparameters: str, training_output: str, output_metrics: str = None,
+                 properties: dict = None, **kwargs) -> None:
         properties = properties or {}
 
         # Call parent class constructor
@@ -72,7 +86,7 @@ class Model_training(BiobbObject):
         # Input/Output files
         self.io_dict = {
             "in": {"input_excel": input_excel, "label": label},
-            "out": {"training_output": training_output, "hyperparameters": hyperparameters}
+            "out": {"training_output": training_output, "hyperparameters": hyperparameters, "output_metrics": output_metrics}
         }
 
         # Properties specific for BB
@@ -86,6 +100,12 @@ class Model_training(BiobbObject):
         self.report_weight = properties.get('report_weight', None)
         self.difference_weight = properties.get('difference_weight', None)
         self.small = properties.get('small', None)
+        self.dtype = properties.get('dtype', None)
+        self.backend = properties.get('backend', None)
+        self.cache_dir = properties.get('cache_dir', None)
+        self.staging = properties.get('staging', None)
+        self.telemetry_dir = properties.get('telemetry_dir', None)
+        self.memory_budget = properties.get('memory_budget', None)
 
         # Properties common in all BB
 
@@ -97,8 +117,10 @@ class Model_training(BiobbObject):
         """Execute the :class:`model_training <bioml.model_training.model_training>` object."""
 
         # Setup Biobb
-        if self.check_restart(): return 0
-        self.stage_files()
+        if self.check_restart() or com.check_cache(self): return 0
+        com.stage_files(self)
+        # Every worker holds its own copy of the features, only the ones that fit in the memory budget are started
+        self.num_thread = com.apply_memory_budget(self, self.num_thread)
 
         # This is a placeholder
         fu.log('Creating command line with parameters', self.out_log, self.global_log)
@@ -137,12 +159,20 @@ class Model_training(BiobbObject):
         if self.small:
             self.cmd.append('--small')
             self.cmd.append(self.small)
+        if self.stage_io_dict["out"].get("output_metrics"):
+            self.cmd.append('--metrics_table')
+            self.cmd.append(self.stage_io_dict["out"]["output_metrics"])
+
+        if self.dtype:
+            self.cmd.append('--dtype')
+            self.cmd.append(self.dtype)
 
         # Run Biobb block
-        self.run_biobb()
+        com.apply_thread_budget(self, self.num_thread)
+        com.run_block(self)
 
         # Copy files to host
-        self.copy_to_host()
+        com.copy_to_host(self)
 
         # Zip output
         results_path = os.path.join(os.path.dirname(os.path.dirname(self.stage_io_dict['out']['training_output'])), os.path.basename(self.stage_io_dict["out"]["training_output"]))
@@ -151,19 +181,25 @@ class Model_training(BiobbObject):
         res1 = os.path.basename(self.stage_io_dict["out"]["training_output"]).rstrip('.zip')
         to_zip.append(f"{unique}/{res1}")
         print(f"Zipping {to_zip} to {results_path}")
-        com.zip_list(results_path, to_zip)
+        com.zip_list(results_path, to_zip, biobb_object=self)
 
         # Remove temporal files
         self.tmp_files.extend([self.stage_io_dict.get("unique_dir"), ""])
-        self.remove_tmp_files()
+        com.remove_tmp_files(self)
+
+        # Cache the outputs for identical runs and write the telemetry record
+        com.store_cache(self)
+        telemetry.write_record(self)
 
         return self.return_code
 
 
-def model_training(input_excel: str, label: str, hyperparameters: str, training_output: str, properties: dict = None, **kwargs) -> int:
+def model_training(input_excel: str, label: str, hyperparameters: str, training_output: str, output_metrics: str = None,
+                   properties: dict = None, **kwargs) -> int:
     """Create :class:`model_training <bioml.model_training.Model_training>` class and
         execute the :meth:`launch() <bioml.model_training.model_training.launch>` method."""
-    return Model_training(input_excel=input_excel, label=label, hyperparameters=hyperparameters, training_output=training_output, properties=properties, **kwargs).launch()
+    return Model_training(input_excel=input_excel, label=label, hyperparameters=hyperparameters, training_output=training_output,
+                          output_metrics=output_metrics, properties=properties, **kwargs).launch()
 
 
 def main():
@@ -178,13 +214,19 @@ def main():
     required_args.add_argument('--label', required=True)
     required_args.add_argument('--hyperparameters', required=False)
     required_args.add_argument('--training_output', required=True)
+    parser.add_argument('--output_metrics', required=False)
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of the run, calibrated with the records of telemetry_dir, instead of running it")
 
     args = parser.parse_args()
     config = args.config if args.config else None
     properties = settings.ConfReader(config=config).get_prop_dic()
+    if args.plan:
+        planner.print_plan("Model_training", {"input_excel": args.input_excel, "label": args.label}, properties)
+        return
 
     # Specific call of each building block
-    model_training(input_excel=args.input_excel, label=args.label, hyperparameters=args.hyperparameters, training_output=args.training_output, properties=properties)
+    model_training(input_excel=args.input_excel, label=args.label, hyperparameters=args.hyperparameters, training_output=args.training_output,
+                   output_metrics=args.output_metrics, properties=properties)
 
 
 if __name__ == '__main__':
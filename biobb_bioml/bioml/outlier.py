@@ -7,6 +7,10 @@ from biobb_common.generic.biobb_object import BiobbObject
 from biobb_common.configuration import settings
 from biobb_common.tools import file_utils as fu
 from biobb_common.tools.file_utils import launchlogger
+from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import sparse
+from biobb_bioml.bioml import telemetry
 
 
 class Outlier(BiobbObject):
@@ -16,13 +20,23 @@ class Outlier(BiobbObject):
     | Detect outliers from the selected features.
 
     Args:
-        input_excel (str): The file to where the selected features are saved in excel format. File type: input. Accepted formats: XLSX (edam:format_3620).
-        output_outlier (str): The path to the output for the outliers. File type: output. Accepted formats: CSV (edam:format_3752).
+        input_excel (str): The file to where the selected features are saved in excel format, or as a sparse CSR matrix, written as a dense CSV in the unique directory for BioML. File type: input. Accepted formats: XLSX (edam:format_3620), NPZ (edam:format_4003).
+        output_outlier (str): The path to the output for the outliers, or for the outlier scores of the new samples when purpose is "score". File type: output. Accepted formats: CSV (edam:format_3752).
+        input_model (str) (Optional): The fitted scaler and detectors persisted by a previous run, required when purpose is "score". File type: input. Accepted formats: JOBLIB (edam:format_2333).
+        output_model (str) (Optional): The path where the fitted scaler and detectors are persisted so they can be reused to score new samples. File type: output. Accepted formats: JOBLIB (edam:format_2333).
         properties (dict):
             * **num_thread** (*int*) - (10) The number of threads to use for the parallelization of outlier detection.
             * **scaler** (*str*) - ("robust") "Choose one of the scaler available in scikit-learn, defaults to RobustScaler. Option: ("robust", "standard", "minmax").
             * **contamination** (*float*) - (0.06) The expected % of outliers. 
             * **num_features** (*float*) - (0.8) The fraction of features to use, maximum 1 which is all the features.
+            * **purpose** (*str*) - ("detect") Fit the detectors on the training features or score new samples against a persisted model, ("detect", "score").
+            * **batch_size** (*int*) - (1000) The number of feature rows streamed through the persisted detectors at a time when purpose is "score".
+            * **dtype** (*str*) - ("float64") Floating point precision of the feature matrices from extraction to prediction, "float32" halves their memory, ("float32", "float64").
+            * **backend** (*str*) - ("subprocess") Run BioML in a new python process or inside the current interpreter, importing it only once when several blocks are chained from Python. The inprocess backend can not be combined with chdir_sandbox, container_path or dev, ("subprocess", "inprocess").
+            * **cache_dir** (*str*) - (None) Directory of the content addressed cache, the outputs are reused when the contents of the inputs and the properties match a previous run. If None the cache is disabled.
+            * **staging** (*str*) - ("copy") How the inputs are staged in the unique directory and the outputs brought back, "link" reflinks the inputs, hardlinks the read-only ones when reflinks are not supported and copies the rest, and moves the outputs, "symlink" uses symbolic links for the inputs, ("copy", "link", "symlink").
+            * **telemetry_dir** (*str*) - (None) Directory where a JSON telemetry record of every launch is written: wall time of the staging, command, outputs and cleanup phases, peak RSS, CPU time and io of the command process tree and the input and output sizes. If None no record is written.
+            * **memory_budget** (*float*) - (None) Megabytes shared by the num_thread workers, each of them holding its own copy of the features. num_thread is capped to the workers that fit, with the footprint of a worker taken from the largest process measured with psutil in the previous runs of the telemetry_dir, scaled to the size of the inputs, and BioML queues the rest of the tasks on the smaller pool. It only caps the pool, the tasks are not admitted one by one. Without previous runs num_thread is not capped and a warning is logged. If None num_thread is not capped.
 
     Examples:
         This is a use example of how to use the building block from Python::
@@ -35,8 +49,15 @@ class Outlier(BiobbObject):
 
             outlier(input_excel='training_features/selected_features.xlsx',
                             output_outlier = 'outliers.csv',
+                            output_model = 'outlier_model.joblib',
                             properties=prop)
 
+            # Score new samples against the persisted detectors
+            outlier(input_excel='extracted_features/new_features.xlsx',
+                            output_outlier = 'new_outliers.csv',
+                            input_model = 'outlier_model.joblib',
+                            properties={'purpose': 'score', 'batch_size': 1000})
+
     Info:
         * wrapped_software:
             * name: BioMl outlier model
@@ -47,7 +68,8 @@ class Outlier(BiobbObject):
             * schema: http://edamontology.org/EDAM.owl
     """
 
-    def __init__(self, input_excel: str, output_outlier: str, properties: dict = None, **kwargs) -> None:
+    def __init__(self, input_excel: str, output_outlier: str, input_model: str = None, output_model: str = None,
+                 properties: dict = None, **kwargs) -> None:
         properties = properties or {}
 
         # Call parent class constructor
@@ -57,8 +79,8 @@ class Outlier(BiobbObject):
 
         # Input/Output files
         self.io_dict = {
-            "in": {"input_excel": input_excel},
-            "out": {"output_outlier": output_outlier}
+            "in": {"input_excel": input_excel, "input_model": input_model},
+            "out": {"output_outlier": output_outlier, "output_model": output_model}
         }
 
         # Properties specific for BB
@@ -66,6 +88,14 @@ class Outlier(BiobbObject):
         self.scaler = properties.get('scaler', None)
         self.contamination = properties.get('contamination', None)
         self.num_features = properties.get('num_features', None)
+        self.purpose = properties.get('purpose', None)
+        self.batch_size = properties.get('batch_size', None)
+        self.dtype = properties.get('dtype', None)
+        self.backend = properties.get('backend', None)
+        self.cache_dir = properties.get('cache_dir', None)
+        self.staging = properties.get('staging', None)
+        self.telemetry_dir = properties.get('telemetry_dir', None)
+        self.memory_budget = properties.get('memory_budget', None)
         # Properties common in all BB
 
         # Check the properties
@@ -75,9 +105,16 @@ class Outlier(BiobbObject):
     def launch(self) -> int:
         """Execute the :class:`outlier <bioml.outlier.outlier>` object."""
 
+        if self.purpose == "score" and not self.io_dict["in"]["input_model"]:
+            fu.log('Scoring new samples requires the input_model persisted by a previous run', self.out_log, self.global_log)
+            raise ValueError("input_model is required when purpose is 'score'")
+
         # Setup Biobb
-        if self.check_restart(): return 0
-        self.stage_files()
+        if self.check_restart() or com.check_cache(self): return 0
+        com.stage_files(self)
+        sparse.stage_dense(self, "input_excel")
+        # Every worker holds its own copy of the features, only the ones that fit in the memory budget are started
+        self.num_thread = com.apply_memory_budget(self, self.num_thread)
 
         # This is a placeholder
         fu.log('Creating command line with parameters', self.out_log, self.global_log)
@@ -85,6 +122,19 @@ class Outlier(BiobbObject):
                     '-e', self.stage_io_dict["in"]["input_excel"],
                     '-o', self.stage_io_dict["out"]["output_outlier"]]
 
+        if self.purpose == "score":
+            # Reuse the fitted scaler and detectors instead of refitting the ensemble
+            self.cmd.append('--purpose')
+            self.cmd.append('score')
+            self.cmd.append('--model')
+            self.cmd.append(self.stage_io_dict["in"]["input_model"])
+            if self.batch_size:
+                self.cmd.append('--batch_size')
+                self.cmd.append(str(self.batch_size))
+        elif self.stage_io_dict["out"].get("output_model"):
+            self.cmd.append('--model_output')
+            self.cmd.append(self.stage_io_dict["out"]["output_model"])
+
         if self.num_thread:
             self.cmd.append('--num_thread')
             self.cmd.append(str(self.num_thread))
@@ -98,23 +148,34 @@ class Outlier(BiobbObject):
             self.cmd.append('--num_features')
             self.cmd.append(str(self.num_features))
 
+        if self.dtype:
+            self.cmd.append('--dtype')
+            self.cmd.append(self.dtype)
+
         # Run Biobb block
-        self.run_biobb()
+        com.apply_thread_budget(self, self.num_thread)
+        com.run_block(self)
 
         # Copy files to host
-        self.copy_to_host()
+        com.copy_to_host(self)
 
         # Remove temporal files
         self.tmp_files.extend([self.stage_io_dict.get("unique_dir"), ""])
-        self.remove_tmp_files()
+        com.remove_tmp_files(self)
+
+        # Cache the outputs for identical runs and write the telemetry record
+        com.store_cache(self)
+        telemetry.write_record(self)
 
         return self.return_code
 
 
-def outlier(input_excel: str, output_outlier: str, properties: dict = None, **kwargs) -> int:
+def outlier(input_excel: str, output_outlier: str, input_model: str = None, output_model: str = None,
+            properties: dict = None, **kwargs) -> int:
     """Create :class:`outlier <bioml.outlier.Outlier>` class and
         execute the :meth:`launch() <bioml.outlier.outlier.launch>` method."""
-    return Outlier(input_excel=input_excel, output_outlier=output_outlier, properties=properties, **kwargs).launch()
+    return Outlier(input_excel=input_excel, output_outlier=output_outlier, input_model=input_model,
+                   output_model=output_model, properties=properties, **kwargs).launch()
 
 
 def main():
@@ -127,13 +188,20 @@ def main():
     required_args = parser.add_argument_group('required arguments')
     required_args.add_argument('--input_excel', required=True)
     required_args.add_argument('--output_outlier', required=True)
+    parser.add_argument('--input_model', required=False)
+    parser.add_argument('--output_model', required=False)
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of the run, calibrated with the records of telemetry_dir, instead of running it")
 
     args = parser.parse_args()
     config = args.config if args.config else None
     properties = settings.ConfReader(config=config).get_prop_dic()
+    if args.plan:
+        planner.print_plan("Outlier", {"input_excel": args.input_excel, "input_model": args.input_model}, properties)
+        return
 
     # Specific call of each building block
-    outlier(input_excel=args.input_excel, output_outlier=args.output_outlier, properties=properties)
+    outlier(input_excel=args.input_excel, output_outlier=args.output_outlier, input_model=args.input_model,
+            output_model=args.output_model, properties=properties)
 
 
 if __name__ == '__main__':
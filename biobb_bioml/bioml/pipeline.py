@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""Module containing the Pipeline runner and the command line interface."""
+import argparse
+import importlib
+import inspect
+import json
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from biobb_common.configuration import settings
+from biobb_common.tools import file_utils as fu
+from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import planner
+
+
+class Pipeline:
+    """
+    | biobb_bioml Pipeline
+    | Run several biobb_bioml blocks described in a single configuration file.
+    | The dependencies between the steps are taken from their input and output paths, the
+      independent steps run concurrently as long as the sum of their cores fits in the cpu budget.
+      Cyclic dependencies and the chdir_sandbox property, process wide while the steps share the process, are refused.
+
+    The configuration follows the biobb workflow format, every step names its block in **tool**
+    (or ends with the block name, i.e. ``step1_generate_pssm``) and can reserve **cores**
+    (defaults to its num_thread property)::
+
+        working_dir_path: pipeline
+        cpu_budget: 40
+        step1_generate_pssm:
+          tool: generate_pssm
+          paths:
+            input_fasta: file:input.fasta
+            output_pssm: pssm.zip
+          properties:
+            num_thread: 30
+        step2_feature_extraction:
+          tool: feature_extraction
+          paths:
+            input_fasta: file:input.fasta
+            pssm: dependency/step1_generate_pssm/output_pssm
+            ...
+
+    Args:
+        config (str): Path to the YAML or JSON configuration of the pipeline.
+        cpu_budget (int): (host cores) Cores shared by the steps running at the same time.
+    """
+
+    def __init__(self, config: str, cpu_budget: int = None) -> None:
+        self.conf = settings.ConfReader(config=config)
+        self.global_log, _ = fu.get_logs(path=self.conf.get_working_dir_path(), light_format=True)
+        self.cpu_budget = int(cpu_budget or self.conf.properties.get("cpu_budget") or com.host_cores())
+
+        properties = self.conf.get_prop_dic(global_log=self.global_log)
+        paths = self.conf.get_paths_dic()
+        self.steps = {}
+        for name, step_conf in self.conf.properties.items():
+            if not isinstance(step_conf, dict) or not ("paths" in step_conf or "properties" in step_conf):
+                continue
+            self.steps[name] = self._load_step(name, step_conf, dict(paths.get(name, {})), dict(properties[name]))
+        self.dependencies = self._build_dag()
+        self._check_cycles()
+        self.report: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+    def _load_step(self, name: str, step_conf: dict, paths: dict, properties: dict) -> dict:
+        tool = step_conf.get("tool") or next((module for module in block_modules() if name.endswith(module)), None)
+        if not tool:
+            raise ValueError(f"Step {name} does not say which tool to run")
+        module = importlib.import_module(f"biobb_bioml.bioml.{tool}")
+        function = getattr(module, tool)
+        block_class = next(obj for obj in vars(module).values()
+                           if inspect.isclass(obj) and obj.__module__ == module.__name__ and obj.__name__.lower() == tool)
+        arguments, _ = fu.get_doc_dicts(block_class.__doc__)
+
+        if properties.get("chdir_sandbox"):
+            # The steps run on threads of this process and chdir changes the working directory of all of them
+            raise ValueError(f"Step {name} sets chdir_sandbox, which the pipeline can not run next to other steps")
+
+        # Arguments that are not files, like sheets, can be written in the properties section
+        kwargs = dict(paths)
+        for argument in inspect.signature(function).parameters:
+            if argument in properties and argument not in ("properties", "kwargs"):
+                kwargs[argument] = properties.pop(argument)
+
+        inputs, outputs = set(), set()
+        for argument, value in kwargs.items():
+            if not isinstance(value, str):
+                continue
+            io_type = arguments.get(argument, {}).get("input_output") or ("output" if "output" in argument else "input")
+            (outputs if io_type == "output" else inputs).add(str(Path(value).resolve()))
+
+        cores = step_conf.get("cores") or properties.get("num_thread") or 1
+        cores = min(int(cores), self.cpu_budget)
+        # The steps running at the same time share the host, cap the BLAS/OpenMP pools to the reserved cores
+        workers = int(properties.get("num_thread") or 1)
+        properties["env_vars_dict"] = {**com.limit_threads_env(com.thread_budget(workers, cores=cores)[1]),
+                                       **(properties.get("env_vars_dict") or {})}
+        return {"tool": tool, "block": block_class.__name__, "function": function, "kwargs": kwargs, "properties": properties,
+                "inputs": inputs, "outputs": outputs, "cores": cores}
+
+    def _build_dag(self) -> typing.Dict[str, typing.Set[str]]:
+        producers = {path: name for name, step in self.steps.items() for path in step["outputs"]}
+        return {name: {producers[path] for path in step["inputs"] if path in producers and producers[path] != name}
+                for name, step in self.steps.items()}
+
+    def _check_cycles(self) -> None:
+        """Refuse the steps that depend on each other, directly or through other steps, they could never start."""
+        remaining = {name: set(dependencies) for name, dependencies in self.dependencies.items()}
+        while True:
+            free = [name for name, dependencies in remaining.items() if not dependencies]
+            if not free:
+                break
+            for name in free:
+                del remaining[name]
+            for dependencies in remaining.values():
+                dependencies.difference_update(free)
+        if remaining:
+            raise ValueError(f"The steps {sorted(remaining)} depend on each other in a cycle")
+
+    def _run_step(self, name: str) -> int:
+        step = self.steps[name]
+        start = time.time()
+        fu.log(f'Starting {name} ({step["tool"]}) with {step["cores"]} cores', None, self.global_log)
+        try:
+            return_code = step["function"](**step["kwargs"], properties=step["properties"])
+        except Exception as error:
+            fu.log(f'{name} failed: {error!r}', None, self.global_log)
+            return_code = 1
+        end = time.time()
+        self.report[name] = {"tool": step["tool"], "cores": step["cores"], "start": start, "end": end,
+                             "duration": round(end - start, 3), "return_code": return_code or 0,
+                             "depends_on": sorted(self.dependencies[name])}
+        fu.log(f'Finished {name} in {end - start:.1f} s with exit code {return_code}', None, self.global_log)
+        return return_code or 0
+
+    def launch(self) -> int:
+        """Run every step as soon as its dependencies finish and its cores fit in the budget."""
+        pending = set(self.steps)
+        failed: typing.Set[str] = set()
+        succeeded: typing.Set[str] = set()
+        running = {}
+        free_cores = self.cpu_budget
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(1, len(self.steps))) as executor:
+            while pending or running:
+                # Steps depending on a failed one are never run
+                for name in [name for name in pending if self.dependencies[name] & failed]:
+                    fu.log(f'Skipping {name}, it depends on a failed step', None, self.global_log)
+                    pending.discard(name)
+                    failed.add(name)
+                ready = sorted((name for name in pending if not self.dependencies[name] - succeeded),
+                               key=lambda name: -self.steps[name]["cores"])
+                for name in ready:
+                    cores = self.steps[name]["cores"]
+                    if cores <= free_cores or not running:
+                        free_cores -= cores
+                        pending.discard(name)
+                        running[executor.submit(self._run_step, name)] = name
+                if not running:
+                    # Nothing can start any more, the steps left are never run
+                    fu.log(f'The steps {sorted(pending)} could not be scheduled', None, self.global_log)
+                    failed.update(pending)
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    free_cores += self.steps[name]["cores"]
+                    (failed if future.result() != 0 else succeeded).add(name)
+
+        path, length = self.critical_path()
+        fu.log(f'Pipeline finished in {time.time() - start:.1f} s, critical path: {" -> ".join(path)} ({length:.1f} s)',
+               None, self.global_log)
+        return 1 if failed else 0
+
+    def plan(self) -> typing.Dict[str, typing.Any]:
+        """Estimates of every step without running them, a step reading the outputs of another one is only estimated when they already exist."""
+        steps = {name: planner.plan(step["block"], step["kwargs"], step["properties"]) for name, step in self.steps.items()}
+        return {"cpu_budget": self.cpu_budget, "steps": steps,
+                "cpu_hours": round(sum(step["cpu_hours"] for step in steps.values()), 4),
+                "peak_memory_mb": max((step["peak_memory_mb"] for step in steps.values()), default=0),
+                "scratch_mb": round(sum(step["scratch_mb"] for step in steps.values()), 1)}
+
+    def critical_path(self) -> typing.Tuple[typing.List[str], float]:
+        """Longest chain of dependent steps by measured duration."""
+        finish: typing.Dict[str, typing.Tuple[float, typing.List[str]]] = {}
+
+        def longest(name: str) -> typing.Tuple[float, typing.List[str]]:
+            if name not in finish:
+                before = max((longest(dependency) for dependency in self.dependencies[name]),
+                             default=(0.0, []), key=lambda item: item[0])
+                finish[name] = (before[0] + self.report.get(name, {}).get("duration", 0.0), before[1] + [name])
+            return finish[name]
+
+        length, path = max((longest(name) for name in self.steps), default=(0.0, []), key=lambda item: item[0])
+        return path, length
+
+    def write_report(self, report_path: str) -> None:
+        path, length = self.critical_path()
+        with open(report_path, "w") as report_file:
+            json.dump({"cpu_budget": self.cpu_budget, "steps": self.report,
+                       "critical_path": path, "critical_path_duration": round(length, 3)}, report_file, indent=4)
+
+
+def block_modules() -> typing.List[str]:
+    """Names of the block modules of the package, longest first so suffixes match the right block."""
+    from biobb_bioml.bioml import __all__ as modules
+    return sorted(modules, key=len, reverse=True)
+
+
+def pipeline(config: str, report: str = None, cpu_budget: int = None) -> int:
+    """Create :class:`Pipeline <bioml.pipeline.Pipeline>` class and
+        execute the :meth:`launch() <bioml.pipeline.Pipeline.launch>` method."""
+    runner = Pipeline(config=config, cpu_budget=cpu_budget)
+    return_code = runner.launch()
+    if report:
+        runner.write_report(report)
+    return return_code
+
+
+def main():
+    """Command line execution of the pipeline runner."""
+    parser = argparse.ArgumentParser(description="Run a whole biobb_bioml pipeline described in one configuration file.",
+                                     formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, width=99999))
+    parser.add_argument('-c', '--config', required=True, help="This file can be a YAML file, JSON file or JSON string")
+    parser.add_argument('--report', required=False, help="JSON file with the timing of every step and the critical path")
+    parser.add_argument('--cpu_budget', required=False, type=int, help="Cores shared by the concurrent steps, defaults to the host cores")
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of every step instead of running them")
+
+    args = parser.parse_args()
+    if args.plan:
+        print(json.dumps(Pipeline(config=args.config, cpu_budget=args.cpu_budget).plan(), indent=4))
+        return
+    raise SystemExit(pipeline(config=args.config, report=args.report, cpu_budget=args.cpu_budget))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+"""Module containing the dry run planner of the blocks.
+
+The planner reads the inputs of a block without running it (number and length of the sequences,
+shape of the feature tables, the feature_range, rfe_steps, kfold_parameters and sheets) and reduces
+them to work units: the CPU work, the size of the data held in memory and the size of the outputs.
+The CPU seconds, the peak memory and the output bytes per unit are taken from the telemetry
+records of previous runs of the same block in the telemetry_dir (every record keeps the workload
+of its run), falling back to rough defaults while there are none. The estimates are printed by
+the ``--plan`` option of the command line of every block.
+"""
+import csv
+import json
+import statistics
+import typing
+from pathlib import Path
+import numpy as np
+from biobb_bioml.bioml import telemetry
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+# Uncalibrated CPU seconds per work unit and bytes of peak memory per memory unit
+DEFAULT_RATES = {
+    "Generate_pssm": {"cpu": 0.5, "memory": 50.0, "output": 200.0},
+    "Generate_pssm:pseudo": {"cpu": 2e-5, "memory": 50.0, "output": 200.0},
+    "Feature_extraction": {"cpu": 0.05, "memory": 200.0, "output": 50.0},
+    "Feature_selection": {"cpu": 2e-7, "memory": 8.0, "output": 1e-4},
+    "Outlier": {"cpu": 1e-5, "memory": 8.0, "output": 0.01},
+    "Model_training": {"cpu": 5e-5, "memory": 8.0, "output": 0.01},
+    "Ensemble": {"cpu": 5e-5, "memory": 8.0, "output": 0.01},
+    "Generate_model": {"cpu": 5e-5, "memory": 8.0, "output": 1.0},
+    "Predict": {"cpu": 1e-5, "memory": 8.0, "output": 0.01},
+    "Rerank": {"cpu": 1e-5, "memory": 16.0, "output": 1.0},
+}
+# Memory of the interpreter and the imported libraries before reading any data
+BASE_MEMORY_MB = 300.0
+
+
+def fasta_stats(path: str) -> typing.Dict[str, int]:
+    """Number of sequences, residues and the longest sequence of a fasta."""
+    sequences, residues, longest, current = 0, 0, 0, 0
+    with open(path, "rb") as fasta_file:
+        for line in fasta_file:
+            if line.startswith(b">"):
+                sequences += 1
+                longest, current = max(longest, current), 0
+            else:
+                length = len(line.strip())
+                residues += length
+                current += length
+    return {"sequences": sequences, "residues": residues, "max_length": max(longest, current)}
+
+
+def table_stats(path: str) -> typing.Dict[str, int]:
+    """Rows and columns (without the ids) of a CSV, CSR npz or Excel feature table, zeros when unknown."""
+    suffix = Path(path).suffix
+    if suffix == ".npz":
+        with np.load(path, allow_pickle=False) as loaded:
+            rows, columns = (int(size) for size in loaded["shape"])
+        return {"rows": rows, "columns": columns}
+    if suffix == ".csv":
+        with open(path, newline="") as table:
+            columns = len(next(csv.reader(table), [""])) - 1
+        with open(path, "rb") as table:
+            rows = sum(block.count(b"\n") for block in iter(lambda: table.read(2**20), b"")) - 1
+        return {"rows": max(rows, 0), "columns": max(columns, 0)}
+    if suffix in (".xlsx", ".xlsm") and openpyxl is not None:
+        workbook = openpyxl.load_workbook(path, read_only=True)
+        sheet = workbook.worksheets[0]
+        stats = {"rows": max((sheet.max_row or 1) - 1, 0), "columns": max((sheet.max_column or 1) - 1, 0),
+                 "sheets": len(workbook.worksheets)}
+        workbook.close()
+        return stats
+    return {"rows": 0, "columns": 0}
+
+
+def _splits(kfold_parameters: typing.Optional[str]) -> int:
+    return int(str(kfold_parameters or "5:0.2").split(":")[0] or 5)
+
+
+def _feature_sizes(feature_range: typing.Optional[str], rows: int, columns: int) -> int:
+    """Number of feature counts tried by Feature_selection for a feature_range in start:stop:step format."""
+    parts = str(feature_range or "20:none:10").split(":")
+    if len(parts) == 1:
+        return 1
+    start = int(parts[0])
+    stop = min(columns, rows // 2) if parts[1].lower() == "none" else int(parts[1])
+    step = int(parts[2]) if len(parts) > 2 and parts[2] else 10
+    return max(1, len(range(start, stop + 1, max(step, 1))))
+
+
+def _exists(path: typing.Any) -> bool:
+    return isinstance(path, str) and Path(path).is_file()
+
+
+def _sequences_workload(inputs, properties) -> typing.Dict[str, typing.Any]:
+    stats = fasta_stats(inputs["input_fasta"]) if _exists(inputs.get("input_fasta")) else {}
+    residues = stats.get("residues", 0)
+    if properties.get("mode") == "pseudo":
+        return {**stats, "key": "Generate_pssm:pseudo", "units": residues, "memory_units": stats.get("max_length", 0) * 20,
+                "output_units": residues}
+    iterations = int(properties.get("iterations") or 3)
+    return {**stats, "iterations": iterations, "units": residues * iterations,
+            "memory_units": stats.get("max_length", 0) * 20 * 1000, "output_units": residues}
+
+
+def _extraction_workload(inputs, properties) -> typing.Dict[str, typing.Any]:
+    stats = fasta_stats(inputs["input_fasta"]) if _exists(inputs.get("input_fasta")) else {}
+    return {**stats, "units": stats.get("residues", 0), "memory_units": stats.get("sequences", 0) * 1000,
+            "output_units": stats.get("sequences", 0) * 1000}
+
+
+def _table_workload(file_ref: str, splits_property: str = None, jobs: bool = False):
+    def workload(inputs, properties) -> typing.Dict[str, typing.Any]:
+        stats = table_stats(inputs[file_ref]) if _exists(inputs.get(file_ref)) else {"rows": 0, "columns": 0}
+        cells = stats["rows"] * stats["columns"]
+        factor = _splits(properties.get(splits_property)) if splits_property else 1
+        if jobs:
+            from biobb_bioml.bioml.common import parse_sheets
+            factor = sum(_splits(None) if fold is None else 1 for _, fold in parse_sheets(inputs.get("sheets") or "0"))
+        itemsize = 4 if properties.get("dtype") == "float32" else 8
+        return {**stats, "repetitions": factor, "units": cells * factor, "memory_units": cells * itemsize / 8,
+                "output_units": cells}
+    return workload
+
+
+def _selection_workload(inputs, properties) -> typing.Dict[str, typing.Any]:
+    stats = table_stats(inputs["input_features"]) if _exists(inputs.get("input_features")) else {"rows": 0, "columns": 0}
+    columns = stats["columns"]
+    if properties.get("out_of_core"):
+        columns = min(columns, int(properties.get("candidate_features") or 2000))
+    sizes = _feature_sizes(properties.get("feature_range"), stats["rows"], columns)
+    rfe_steps = int(properties.get("rfe_steps") or 40)
+    splits = _splits(properties.get("kfold_parameters"))
+    cells = stats["rows"] * columns
+    itemsize = 4 if properties.get("dtype") == "float32" else 8
+    return {**stats, "feature_sizes": sizes, "rfe_steps": rfe_steps, "splits": splits,
+            "units": cells * sizes * rfe_steps * splits, "memory_units": cells * itemsize / 8, "output_units": cells}
+
+
+WORKLOADS: typing.Dict[str, typing.Callable[[dict, dict], typing.Dict[str, typing.Any]]] = {
+    "Generate_pssm": _sequences_workload,
+    "Feature_extraction": _extraction_workload,
+    "Feature_selection": _selection_workload,
+    "Outlier": _table_workload("input_excel"),
+    "Model_training": _table_workload("input_excel", "kfold_parameters"),
+    "Ensemble": _table_workload("input_excel", "kfold_parameters"),
+    "Generate_model": _table_workload("input_excel", jobs=True),
+    "Predict": _table_workload("extracted"),
+    "Rerank": _table_workload("input_metrics"),
+}
+
+
+def workload(block: str, inputs: typing.Dict[str, typing.Any], properties: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """Work units of a run of block with the given input paths and properties."""
+    work = {"key": block, "units": 0, "memory_units": 0, "output_units": 0}
+    if block in WORKLOADS:
+        work.update(WORKLOADS[block](inputs, properties))
+    if not work["units"]:
+        work["note"] = "The inputs are missing or empty, there is nothing to estimate"
+    return work
+
+
+def _rate(records: typing.List[dict], value: typing.Callable[[dict], typing.Optional[float]], units: str) -> typing.Optional[float]:
+    rates = [value(record) / record["workload"][units] for record in records
+             if record["workload"].get(units) and value(record) is not None]
+    return statistics.median(rates) if rates else None
+
+
+def plan(block: str, inputs: typing.Dict[str, typing.Any], properties: typing.Dict[str, typing.Any],
+         records: typing.List[dict] = None) -> typing.Dict[str, typing.Any]:
+    """Estimated CPU hours, wall hours, peak memory and scratch disk of a run of block.
+
+    The rates come from the records of the same block (and mode) with a workload, the records
+    of the telemetry_dir property when records is None.
+    """
+    work = workload(block, inputs, properties)
+    if records is None and properties.get("telemetry_dir") and Path(properties["telemetry_dir"]).is_dir():
+        records = telemetry.load_records([properties["telemetry_dir"]])
+    history = [record for record in records or [] if (record.get("workload") or {}).get("key") == work["key"]
+               and not record.get("return_code")]
+    defaults = DEFAULT_RATES.get(work["key"], {"cpu": 1e-5, "memory": 8.0, "output": 1.0})
+    cpu_rate = _rate(history, lambda record: record.get("cpu_seconds"), "units")
+    memory_rate = _rate(history, lambda record: max(record["peak_rss_mb"] - BASE_MEMORY_MB, 0) * 2**20
+                        if record.get("peak_rss_mb") is not None else None, "memory_units")
+    output_rate = _rate(history, lambda record: sum((record.get("output_bytes") or {}).values()), "output_units")
+    cpu_seconds = work["units"] * (cpu_rate if cpu_rate is not None else defaults["cpu"])
+    utilizations = [record["cpu_utilization"] for record in history if record.get("cpu_utilization")]
+    parallelism = statistics.median(utilizations) if utilizations else max(1, int(properties.get("num_thread") or 1))
+    input_bytes = sum(Path(path).stat().st_size for path in inputs.values() if _exists(path))
+    output_bytes = work["output_units"] * (output_rate if output_rate is not None else defaults["output"])
+    # The inputs are copied to the sandbox unless they are linked, the outputs exist twice before the cleanup
+    staged_bytes = input_bytes if (properties.get("staging") or "copy") == "copy" else 0
+    return {"block": block, "workload": work, "calibrated_from": len(history),
+            "cpu_hours": round(cpu_seconds / 3600, 4),
+            "wall_hours": round(cpu_seconds / parallelism / 3600, 4),
+            "peak_memory_mb": round(BASE_MEMORY_MB + work["memory_units"] * (memory_rate if memory_rate is not None else defaults["memory"]) / 2**20, 1),
+            "scratch_mb": round((staged_bytes + 2 * output_bytes) / 2**20, 1)}
+
+
+def worker_footprint(block: str, inputs: typing.Dict[str, typing.Any], properties: typing.Dict[str, typing.Any],
+                     records: typing.List[dict] = None) -> typing.Tuple[float, int]:
+    """Megabytes held by one worker of block, each worker holding its own copy of the data, and the number of records it is calibrated from.
+
+    The footprint is the largest process measured with psutil in the previous runs of the same
+    block, scaled to the memory units of this run, or the default rate of the block without records.
+    """
+    work = workload(block, inputs, properties)
+    if records is None and properties.get("telemetry_dir") and Path(properties["telemetry_dir"]).is_dir():
+        records = telemetry.load_records([properties["telemetry_dir"]])
+    history = [record for record in records or [] if (record.get("workload") or {}).get("key") == work["key"]
+               and not record.get("return_code")]
+    rate = _rate(history, lambda record: max(record["peak_worker_rss_mb"] - BASE_MEMORY_MB, 0) * 2**20
+                 if record.get("peak_worker_rss_mb") is not None else None, "memory_units")
+    calibrated = sum(1 for record in history if record.get("peak_worker_rss_mb") is not None and record["workload"].get("memory_units"))
+    if rate is None:
+        rate = DEFAULT_RATES.get(work["key"], {"memory": 8.0})["memory"]
+    return round(BASE_MEMORY_MB + work["memory_units"] * rate / 2**20, 1), calibrated
+
+
+def print_plan(block: str, inputs: typing.Dict[str, typing.Any], properties: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    """Print the plan of a run of block as JSON, used by the --plan option of the command lines."""
+    estimate = plan(block, inputs, properties)
+    print(json.dumps(estimate, indent=4))
+    return estimate
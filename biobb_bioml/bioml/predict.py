@@ -3,11 +3,17 @@
 """Module containing the Predict class and the command line interface."""
 
 import argparse
+from pathlib import Path
 from biobb_common.generic.biobb_object import BiobbObject
 from biobb_common.configuration import settings
 from biobb_common.tools import file_utils as fu
 from biobb_common.tools.file_utils import launchlogger
+from biobb_bioml.bioml import cascade
 from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import distill
+from biobb_bioml.bioml import fasta_index
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import telemetry
 import os
 
 
@@ -21,11 +27,23 @@ class Predict(BiobbObject):
         input_excel (str): The file to where the selected features are saved in excel format.  File type: input. Accepted formats: XLSX (edam:format_3620)
         input_fasta (str): The fasta file path. File type: input. Accepted formats: FASTA (edam:format_1929).
         extracted (str): The file where the extracted features from the new data are stored. File type: input. Accepted formats: XLSX (edam:format_3620).
+        input_scaler (str) (Optional): The robust scaler saved by Generate_model (output_scaler), used by the cascade instead of fitting the scaler on input_excel. The scaler.npz among the models is used when it is not given. File type: input. Accepted formats: NPZ (edam:format_4003).
         properties (dict):
             * **scaler** (*str*) - ("robust") Choose one of the scaler available in scikit-learn, defaults to RobustScaler.
             * **model_output** (*str*) - ("models") The directory for the generated models.
             * **prediction_threshold** (*float*) - (1.0) Between 0.5 and 1 and determines what considers to be a positive prediction, if 1 only those predictions where all models agrees are considered to be positive.
             * **number_similar_samples** (*int*) - (1) The number of similar training samples to filter the predictions.
+            * **cascade** (*bool*) - (False) Let the models vote with early exit instead of running BioML: they are ordered from the cheapest to the most expensive and a sample stops being evaluated once the models left can not change its prediction. The models are read with joblib from model_output and every model is given the columns of its sheet of input_excel (the sheet is a folder of its path or the prefix of its file name, a workbook of several sheets is refused otherwise), scaled with scaler fitted on that sheet. The predictions are the same as evaluating every model, written to cascade_predictions.csv in the results. The applicability domain filter of number_similar_samples is not applied.
+            * **batch_size** (*int*) - (1024) The number of samples evaluated together by the cascade.
+            * **student** (*str*) - (None) Student model distilled by Generate_model, the path of its output_student or the name of a file among the models of model_output (student.npz), used as a fast first pass of the cascade: the samples it scores below student_threshold are negative without evaluating the ensemble. Setting it turns on cascade.
+            * **student_threshold** (*float*) - (0.05) Student probability below which a sample is rejected by the first pass.
+            * **student_audit** (*int*) - (100) The number of samples rejected by the student that are still evaluated by the ensemble to report how many positives the first pass misses.
+            * **sequence_ids** (*str*) - (None) Only use these records of input_fasta: a file with one id per line, a comma separated list of ids or a Python list. They are read through an index of the fasta (<input_fasta>.idx, built once and reused) instead of parsing the whole file. If None every record is used.
+            * **dtype** (*str*) - ("float64") Floating point precision of the feature matrices from extraction to prediction, "float32" halves their memory, ("float32", "float64").
+            * **backend** (*str*) - ("subprocess") Run BioML in a new python process or inside the current interpreter, importing it only once when several blocks are chained from Python. The inprocess backend can not be combined with chdir_sandbox, container_path or dev, ("subprocess", "inprocess").
+            * **cache_dir** (*str*) - (None) Directory of the content addressed cache, the outputs are reused when the contents of the inputs and the properties match a previous run. If None the cache is disabled.
+            * **staging** (*str*) - ("copy") How the inputs are staged in the unique directory and the outputs brought back, "link" reflinks the inputs, hardlinks the read-only ones when reflinks are not supported and copies the rest, and moves the outputs, "symlink" uses symbolic links for the inputs, ("copy", "link", "symlink").
+            * **telemetry_dir** (*str*) - (None) Directory where a JSON telemetry record of every launch is written: wall time of the staging, command, outputs, zipping and cleanup phases, peak RSS, CPU time and io of the command process tree and the input and output sizes. If None no record is written.
 
     Examples:
         This is a use example of how to use the building block from Python::
@@ -50,8 +68,10 @@ class Predict(BiobbObject):
             * name: EDAM
             * schema: http://edamontology.org/EDAM.owl
     """
+    # Properties holding paths, hashed by content in the cache key
+    FILE_PROPERTIES = ("model_output", "student", "sequence_ids")
 
-    def __init__(self, input_excel: str, input_fasta: str, extracted: str,
+    def __init__(self, input_excel: str, input_fasta: str, extracted: str, input_scaler: str = None,
                  properties: dict = None, **kwargs) -> None:
         properties = properties or {}
 
@@ -62,18 +82,27 @@ class Predict(BiobbObject):
 
         # Input/Output files
         self.io_dict = {
-            "in": {"input_excel": input_excel, "input_fasta": input_fasta, "extracted": extracted},
+            "in": {"input_excel": input_excel, "input_fasta": input_fasta, "extracted": extracted, "input_scaler": input_scaler},
             "out": {"prediction_results": prediction_results}
         }
 
         # Properties specific for BB
         self.scaler = properties.get('scaler', None)
 
-        self.model_output =  properties.get('mode_output', None)
-        #self.model_output = f"/data/galaxy_extra/tmp/{self.model_output}
-        self.model_output = f"/home/bubbles/Ruite/esterase_dataset/tmp/{self.model_output}"
+        self.model_output = properties.get('model_output', "models")
         self.prediction_threshold = properties.get('prediction_threshold', None)
         self.number_similar_samples = properties.get('number_similar_samples', None)
+        self.cascade = properties.get('cascade', False)
+        self.batch_size = properties.get('batch_size', 1024)
+        self.student = properties.get('student', None)
+        self.student_threshold = properties.get('student_threshold', 0.05)
+        self.student_audit = properties.get('student_audit', 100)
+        self.sequence_ids = properties.get('sequence_ids', None)
+        self.dtype = properties.get('dtype', None)
+        self.backend = properties.get('backend', None)
+        self.cache_dir = properties.get('cache_dir', None)
+        self.staging = properties.get('staging', None)
+        self.telemetry_dir = properties.get('telemetry_dir', None)
         # Properties common in all BB
 
         # Check the properties
@@ -84,8 +113,10 @@ class Predict(BiobbObject):
         """Execute the :class:`predict <bioml.predict.predict>` object."""
 
         # Setup Biobb
-        if self.check_restart(): return 0
-        self.stage_files()
+        if self.check_restart() or com.check_cache(self): return 0
+        com.stage_files(self, skip=("input_fasta",) if self.sequence_ids else ())
+        if self.sequence_ids:
+            fasta_index.stage_subset(self, self.sequence_ids)
 
         # This is a placeholder
         fu.log('Creating command line with parameters', self.out_log, self.global_log)
@@ -108,29 +139,49 @@ class Predict(BiobbObject):
             self.cmd.append('--number_similar_samples')
             self.cmd.append(str(self.number_similar_samples))
 
+        if self.dtype:
+            self.cmd.append('--dtype')
+            self.cmd.append(self.dtype)
+
         # Run Biobb block
-        self.run_biobb()
+        com.apply_thread_budget(self, None)
+        com.run_block(self, run=self.run_cascade if self.cascade or self.student else None)
 
         # Zip output
         results_path = os.path.join(os.path.dirname(os.path.dirname(self.stage_io_dict['out']['prediction_results'])), os.path.basename(self.stage_io_dict["out"]["prediction_results"]))
         to_zip = []
         to_zip.append(os.path.basename(self.stage_io_dict["unique_dir"]))
         print(f"Zipping {to_zip} to {results_path}")
-        com.zip_list(results_path, to_zip)
+        com.zip_list(results_path, to_zip, biobb_object=self)
 
         # Remove temporal files
         self.tmp_files.extend([self.stage_io_dict.get("unique_dir"), ""])
-        self.remove_tmp_files()
+        com.remove_tmp_files(self)
+
+        # Cache the outputs for identical runs and write the telemetry record
+        com.store_cache(self)
+        telemetry.write_record(self)
 
         return self.return_code
 
+    def run_cascade(self) -> None:
+        """Evaluate the models in this process with early exit instead of running BioML.predict."""
+        fu.log(f'Cascade prediction with the models of {self.model_output}', self.out_log, self.global_log)
+        cascade.run(self, first_pass=distill.first_pass(self.student_path(), self.student_threshold) if self.student else None)
+
+    def student_path(self) -> str:
+        """The student property, a path or the name of a file among the models of model_output, like student.npz."""
+        if Path(self.student).is_file():
+            return self.student
+        return str(Path(self.model_output).joinpath(self.student))
+
 
-def predict(input_excel: str, extracted: str, input_fasta: str, output_model: str, properties: dict = None,
+def predict(input_excel: str, extracted: str, input_fasta: str, output_model: str, input_scaler: str = None, properties: dict = None,
                    **kwargs) -> int:
     """Create :class:`predict <bioml.predict.Predict>` class and
         execute the :meth:`launch() <bioml.predict.predict.launch>` method."""
     return Predict(input_excel=input_excel,  extracted=extracted, input_fasta=input_fasta,
-                          output_model=output_model, properties=properties, **kwargs).launch()
+                          output_model=output_model, input_scaler=input_scaler, properties=properties, **kwargs).launch()
 
 
 def main():
@@ -145,14 +196,19 @@ def main():
     required_args.add_argument('--extracted', required=True)
     required_args.add_argument('--input_fasta', required=True)
     required_args.add_argument('--output_model', required=True)
+    parser.add_argument('--input_scaler', required=False)
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of the run, calibrated with the records of telemetry_dir, instead of running it")
 
     args = parser.parse_args()
     config = args.config if args.config else None
     properties = settings.ConfReader(config=config).get_prop_dic()
+    if args.plan:
+        planner.print_plan("Predict", {"input_excel": args.input_excel, "input_fasta": args.input_fasta, "extracted": args.extracted, "input_scaler": args.input_scaler}, properties)
+        return
 
     # Specific call of each building block
     predict(input_excel=args.input_excel, extracted=args.extracted, input_fasta=args.input_fasta,
-                   output_model=args.output_model, properties=properties)
+                   output_model=args.output_model, input_scaler=args.input_scaler, properties=properties)
 
 
 if __name__ == '__main__':
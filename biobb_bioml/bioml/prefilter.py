@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+"""Module containing the out-of-core prefilter of Feature_selection.
+
+The variance and the univariate ANOVA F score of every feature only need per class counts, means
+and squared deviations, so they are merged over chunks of rows read within a memory budget. Constant
+features are dropped, the best candidate_features by F score are kept and the table is written again
+with only those columns, small enough for BioML to load for its filters and the RFE stage.
+
+The F score ranking runs before the univariate filters of BioML, which then only see the candidates:
+a feature that another filter would rank high but with a low F score is lost, so the selection can
+differ from the one of the whole table. candidate_features 0 only drops the constant features.
+"""
+import csv
+import itertools
+import typing
+from pathlib import Path
+import numpy as np
+from biobb_common.tools import file_utils as fu
+from biobb_bioml.bioml import sparse
+
+
+def read_labels(label_path: str) -> typing.Tuple[typing.Optional[typing.List[str]], np.ndarray]:
+    """Ids and labels of a csv with the labels in the last column, with or without header.
+
+    The ids are in the first column, None when the csv only has the label column.
+    """
+    with open(label_path, newline="") as label_file:
+        rows = [row for row in csv.reader(label_file) if row]
+    try:
+        float(rows[0][-1])
+    except ValueError:
+        rows = rows[1:]
+    ids = [row[0] for row in rows] if len(rows[0]) > 1 else None
+    return ids, np.array([row[-1] for row in rows])
+
+
+def column_labels(features: str, label_column: str) -> typing.Dict[str, str]:
+    """Labels by row id of the label_column of a CSV feature table, reading only that column."""
+    with open(features, newline="") as features_file:
+        reader = csv.reader(features_file)
+        header = next(reader)
+        if label_column not in header:
+            raise ValueError(f"{label_column} is neither a label file nor a column of {features}")
+        position = header.index(label_column)
+        return {row[0]: row[position] for row in reader if row}
+
+
+class RowLabels:
+    """The labels of the rows of a feature table, by row id, or by position when the labels have no ids.
+
+    Ids that match none of the first rows, like the 0 to n index written by pandas, are ignored.
+    """
+
+    def __init__(self, labels: np.ndarray, ids: typing.Optional[typing.Sequence[str]] = None) -> None:
+        self.labels = np.asarray(labels)
+        self.by_id = dict(zip(ids, self.labels)) if ids is not None else None
+        self.classes = np.unique(self.labels)
+        self.start = 0
+
+    def take(self, ids: typing.Sequence[str]) -> np.ndarray:
+        """The labels of the next rows, with the given ids."""
+        if self.by_id is None:
+            labels = self.labels[self.start:self.start + len(ids)]
+            if len(labels) != len(ids):
+                raise ValueError(f"There are more feature rows than the {len(self.labels)} labels")
+        elif self.start == 0 and not any(row_id in self.by_id for row_id in ids):
+            self.by_id = None
+            return self.take(ids)
+        else:
+            missing = [row_id for row_id in ids if row_id not in self.by_id]
+            if missing:
+                raise ValueError(f"{len(missing)} feature rows have no label: {missing[:10]}")
+            labels = np.array([self.by_id[row_id] for row_id in ids])
+        self.start += len(ids)
+        return labels
+
+
+class ColumnStats:
+    """Per class count, mean and sum of squared deviations of every column, merged chunk by chunk.
+
+    The chunks are merged with the pairwise update of Chan et al., so the variance of a column with a
+    large mean and a small spread does not cancel out as the difference of two large sums would.
+    """
+
+    def __init__(self, n_columns: int, classes: np.ndarray) -> None:
+        self.classes = classes
+        self.counts = np.zeros(len(classes))
+        self.means = np.zeros((len(classes), n_columns))
+        self.deviations = np.zeros((len(classes), n_columns))
+        self.minimum = np.full(n_columns, np.inf)
+        self.maximum = np.full(n_columns, -np.inf)
+        self.shift = None
+
+    def add(self, values: np.ndarray, labels: np.ndarray) -> None:
+        if not len(values):
+            return
+        # The values are summed relative to the first row read, which lies within the spread of every column
+        if self.shift is None:
+            self.shift = np.array(values[0], dtype=np.float64)
+        for index, label in enumerate(self.classes):
+            rows = values[labels == label] - self.shift
+            if len(rows):
+                mean = rows.mean(axis=0)
+                self.merge(index, len(rows), mean + self.shift, np.square(rows - mean).sum(axis=0))
+        self.minimum = np.minimum(self.minimum, values.min(axis=0))
+        self.maximum = np.maximum(self.maximum, values.max(axis=0))
+
+    def add_csr(self, matrix, row_class: np.ndarray) -> None:
+        """Statistics of a CSR matrix with the class index of every row, the zeros are never densified."""
+        n_classes, n_columns = len(self.classes), matrix.shape[1]
+        data = matrix.data.astype(np.float64)
+        minimum, maximum = np.full(n_columns, np.inf), np.full(n_columns, -np.inf)
+        np.minimum.at(minimum, matrix.indices, data)
+        np.maximum.at(maximum, matrix.indices, data)
+        # Columns with zeros have 0 in their range, the others are shifted by their minimum before summing
+        dense_columns = np.bincount(matrix.indices, minlength=n_columns) == matrix.shape[0]
+        shift = np.where(dense_columns, minimum, 0.0)
+        data -= shift[matrix.indices]
+
+        counts = np.bincount(row_class, minlength=n_classes).astype(float)
+        cells = np.repeat(row_class, np.diff(matrix.indptr)) * n_columns + matrix.indices
+        size = n_classes * n_columns
+        sums = np.bincount(cells, weights=data, minlength=size).reshape(n_classes, n_columns)
+        stored = np.bincount(cells, minlength=size).reshape(n_classes, n_columns)
+        means = sums / np.maximum(counts, 1)[:, None]
+        # Deviations of the stored values plus the ones of the implicit zeros
+        deviations = np.bincount(cells, weights=np.square(data - means.ravel()[cells]), minlength=size).reshape(n_classes, n_columns)
+        deviations += (counts[:, None] - stored) * means ** 2
+        for index in range(n_classes):
+            if counts[index]:
+                self.merge(index, counts[index], means[index] + shift, deviations[index])
+        self.minimum = np.minimum(self.minimum, np.where(dense_columns, minimum, np.minimum(minimum, 0.0)))
+        self.maximum = np.maximum(self.maximum, np.where(dense_columns, maximum, np.maximum(maximum, 0.0)))
+
+    def merge(self, index: int, count: float, mean: np.ndarray, deviations: np.ndarray) -> None:
+        total = self.counts[index] + count
+        delta = mean - self.means[index]
+        self.deviations[index] += deviations + delta ** 2 * self.counts[index] * count / total
+        self.means[index] += delta * count / total
+        self.counts[index] = total
+
+    def between(self) -> np.ndarray:
+        """Sum of squares of the class means around the overall mean, weighted by the class counts."""
+        counts = self.counts[:, None]
+        mean = (counts * self.means).sum(axis=0) / self.counts.sum()
+        return (counts * (self.means - mean) ** 2).sum(axis=0)
+
+    def variance(self) -> np.ndarray:
+        variance = (self.deviations.sum(axis=0) + self.between()) / self.counts.sum()
+        # The constant columns are found exactly by their range, not by a tolerance on the variance
+        variance[self.maximum <= self.minimum] = 0.0
+        return variance
+
+    def f_score(self) -> np.ndarray:
+        """One way ANOVA F statistic of every column against the classes."""
+        total, n_classes = self.counts.sum(), len(self.classes)
+        between = self.between() / max(n_classes - 1, 1)
+        within = self.deviations.sum(axis=0) / max(total - n_classes, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            score = np.nan_to_num(between / within, nan=0.0, posinf=np.finfo(float).max)
+        score[self.maximum <= self.minimum] = 0.0
+        return score
+
+
+def chunk_rows(line_bytes: int, n_columns: int, memory_mb: float) -> int:
+    """Rows read at once: the text of the lines, the parsed float64 block and its temporaries fit in memory_mb."""
+    row_bytes = 2 * line_bytes + 3 * 8 * n_columns
+    return max(1, int(memory_mb * 2**20 // row_bytes))
+
+
+def _csv_chunks(features: str, rows_per_chunk: int, columns: typing.Sequence[int]) -> typing.Iterator[typing.Tuple[typing.List[str], np.ndarray]]:
+    with open(features) as features_file:
+        next(features_file)
+        while True:
+            lines = [line for line in itertools.islice(features_file, rows_per_chunk) if line.strip()]
+            if not lines:
+                return
+            ids = [line.split(",", 1)[0] for line in lines]
+            yield ids, np.loadtxt(lines, delimiter=",", usecols=columns, ndmin=2)
+
+
+def select_candidates(stats: ColumnStats, candidate_features: int, exclude: typing.Sequence[int] = ()) -> np.ndarray:
+    """The non constant columns with the candidate_features highest F scores, all of them when candidate_features is 0."""
+    variance = stats.variance()
+    variance[list(exclude)] = 0.0
+    variable = np.flatnonzero(variance > 0)
+    if candidate_features <= 0:
+        return variable
+    scores = stats.f_score()[variable]
+    best = variable[np.argsort(-scores, kind="stable")[:candidate_features]]
+    return np.sort(best)
+
+
+def prefilter(features: str, label: str, output: str, candidate_features: int = 2000, memory_mb: float = 4096,
+              out_log=None, global_log=None) -> typing.Dict[str, typing.Any]:
+    """Write to output the candidate_features best columns of features, never holding more than memory_mb MB of rows.
+
+    label is a csv of labels or the name of the label column of features, kept in output for
+    BioML. The labels are matched to the rows by their ids, by position when the csv has no ids.
+    CSV tables are streamed twice, the statistics pass and the projection pass. CSR npz tables
+    are already compact and are filtered in memory.
+    """
+    label_column = None if Path(label).is_file() else label
+    if sparse.is_sparse_table(features):
+        matrix, rows, columns = sparse.load_csr(features)
+        n_columns = matrix.shape[1]
+        exclude = []
+        if label_column is not None:
+            if label_column not in columns:
+                raise ValueError(f"{label_column} is neither a label file nor a column of {features}")
+            exclude = [list(columns).index(label_column)]
+            labels = RowLabels(matrix[:, exclude[0]].toarray().ravel())
+        else:
+            ids, values = read_labels(label)
+            labels = RowLabels(values, ids)
+        row_labels = labels.take(list(rows))
+        if labels.by_id is None and len(row_labels) != len(labels.labels):
+            raise ValueError(f"{features} has {len(row_labels)} rows but {label} has {len(labels.labels)} labels")
+        classes = np.unique(row_labels)
+        stats = ColumnStats(n_columns, classes)
+        stats.add_csr(matrix, np.searchsorted(classes, row_labels))
+        selected = select_candidates(stats, candidate_features, exclude)
+        _write_csr_columns(matrix, rows, columns, np.sort(np.concatenate([selected, exclude]).astype(int)), output)
+        constant = int(np.sum(np.delete(stats.variance(), exclude) == 0))
+        n_features = n_columns - len(exclude)
+    else:
+        with open(features) as features_file:
+            header = next(csv.reader([features_file.readline()]))
+            line_bytes = len(features_file.readline())
+        if label_column is not None:
+            by_id = column_labels(features, label_column)
+            labels = RowLabels(list(by_id.values()), list(by_id))
+        else:
+            ids, values = read_labels(label)
+            labels = RowLabels(values, ids)
+        # Header positions of the features, without the ids and the label column
+        positions = [position for position in range(1, len(header)) if header[position] != label_column]
+        n_features = len(positions)
+        rows_per_chunk = chunk_rows(line_bytes, n_features, memory_mb)
+        fu.log(f'Out-of-core prefilter of {features}: {n_features} features, {rows_per_chunk} rows per chunk', out_log, global_log)
+        stats = ColumnStats(n_features, labels.classes)
+        for ids, values in _csv_chunks(features, rows_per_chunk, positions):
+            stats.add(values, labels.take(ids))
+        if labels.by_id is None and labels.start != len(labels.labels):
+            raise ValueError(f"{features} has {labels.start} rows but {label} has {len(labels.labels)} labels")
+        selected = select_candidates(stats, candidate_features)
+        constant = int(np.sum(stats.variance() == 0))
+        kept = [positions[column] for column in selected]
+        label_position = [header.index(label_column)] if label_column is not None else []
+        with open(output, "w", newline="") as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow([header[0]] + [header[position] for position in kept + label_position])
+            for ids, values in _csv_chunks(features, rows_per_chunk, kept):
+                # The label column is copied from the labels read by id
+                writer.writerows([row_id] + [repr(float(value)) for value in row] + ([labels.by_id[row_id]] if label_position else [])
+                                 for row_id, row in zip(ids, values))
+    report = {"features": n_features, "candidates": int(len(selected)), "constant_features": constant}
+    fu.log(f'Prefilter kept {report["candidates"]} of {n_features} features for the in-memory selection', out_log, global_log)
+    return report
+
+
+def _write_csr_columns(matrix, rows, columns, selected: np.ndarray, output: str) -> None:
+    new_index = np.full(matrix.shape[1], -1)
+    new_index[selected] = np.arange(len(selected))
+    keep = new_index[matrix.indices] >= 0
+    row_of_value = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(row_of_value[keep], minlength=matrix.shape[0]))])
+    np.savez_compressed(output, data=matrix.data[keep], indices=new_index[matrix.indices[keep]].astype(np.int32),
+                        indptr=indptr.astype(np.int64), shape=np.array((matrix.shape[0], len(selected))),
+                        format=np.array("csr"), rows=np.array(rows, dtype=str),
+                        columns=np.array([columns[column] for column in selected], dtype=str))
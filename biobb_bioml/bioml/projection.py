@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""Module containing the column projection of the "filter" purpose of Feature_extraction.
+
+The columns selected at training time tell which descriptor families are needed for new data, so
+only those families are computed, and stored feature tables are read column by column instead of
+whole.
+"""
+import csv
+import typing
+from pathlib import Path
+import numpy as np
+from biobb_common.tools import file_utils as fu
+from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import sparse
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+IFEATURE_FAMILIES = ("APAAC", "PAAC", "CKSAAGP", "Moran", "Geary", "NMBroto", "CTDC", "CTDT", "CTDD", "CTriad",
+                     "GDPC", "GTPC", "QSOrder", "SOCNumber", "GAAC", "KSCtriad")
+POSSUM_FAMILIES = ("aac_pssm", "ab_pssm", "d_fpssm", "dp_pssm", "dpc_pssm", "edp", "eedp", "rpm_pssm",
+                   "k_separated_bigrams_pssm", "pssm_ac", "pssm_cc", "pssm_composition", "rpssm", "s_fpssm",
+                   "smoothed_pssm:5", "smoothed_pssm:7", "smoothed_pssm:9", "tpc", "tri_gram_pssm",
+                   "pse_pssm:1", "pse_pssm:2", "pse_pssm:3")
+
+
+def sheet_headers(excel: str, sheets: str = None) -> typing.Dict[str, typing.List[str]]:
+    """Names of the features selected at training time in every given sheet of excel, the ids column left out.
+
+    The sheets use the format of the sheets property, the kfold indices are ignored. CSV files
+    are read directly as a single sheet named after the file, Excel files need openpyxl.
+    """
+    if Path(excel).suffix == ".csv":
+        with open(excel, newline="") as excel_file:
+            return {Path(excel).stem: next(csv.reader(excel_file))[1:]}
+    if openpyxl is None:
+        raise ImportError("openpyxl is needed to read the selected features of an Excel file")
+    workbook = openpyxl.load_workbook(excel, read_only=True)
+    names = [sheet for sheet, _ in com.parse_sheets(sheets)] if sheets else workbook.sheetnames
+    headers: typing.Dict[str, typing.List[str]] = {}
+    for name in dict.fromkeys(names):
+        sheet = workbook.worksheets[int(name)] if name.isdigit() else workbook[name]
+        header = next(sheet.iter_rows(max_row=1, values_only=True), ())
+        headers[sheet.title] = [str(column) for column in header[1:] if column is not None]
+    workbook.close()
+    return headers
+
+
+def selected_columns(excel: str, sheets: str = None) -> typing.List[str]:
+    """Names of the features selected at training time, the header of the given sheets of excel without repeats."""
+    columns: typing.Dict[str, None] = {}
+    for header in sheet_headers(excel, sheets).values():
+        columns.update(dict.fromkeys(header))
+    return list(columns)
+
+
+def family_of(column: str) -> typing.List[str]:
+    """Families that can produce a column, the longest family name prefixing it. Empty when unknown."""
+    def matches(family: str, lower: bool) -> bool:
+        name, prefix = (column.lower(), family.split(":")[0].lower()) if lower else (column, family.split(":")[0])
+        return name.startswith(prefix) and (len(name) == len(prefix) or not name[len(prefix)].isalpha())
+
+    for lower in (False, True):
+        candidates = [family for family in IFEATURE_FAMILIES + POSSUM_FAMILIES if matches(family, lower)]
+        if candidates:
+            longest = max(len(family.split(":")[0]) for family in candidates)
+            # The window of smoothed_pssm and pse_pssm is not in the column name, all of them are kept
+            return [family for family in candidates if len(family.split(":")[0]) == longest]
+    return []
+
+
+def required_families(columns: typing.Iterable[str]) -> typing.Optional[typing.List[str]]:
+    """Minimal families to compute the columns, None when a column belongs to no known family."""
+    families: typing.Dict[str, None] = {}
+    for column in columns:
+        column_families = family_of(column)
+        if not column_families:
+            return None
+        families.update(dict.fromkeys(column_families))
+    return list(families)
+
+
+def run_for(families: typing.Iterable[str]) -> str:
+    """Value of the run property that computes the families, "possum", "ifeature" or "both"."""
+    tools = {"possum" if family in POSSUM_FAMILIES else "ifeature" for family in families}
+    return tools.pop() if len(tools) == 1 else "both"
+
+
+def project_columns(table: str, columns: typing.Sequence[str], output: str,
+                    rows: typing.Sequence[str] = None) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    """Write the first column and the given columns of a stored feature table (CSV or CSR npz) as CSV.
+
+    CSV tables are streamed row by row, only the selected cells are kept. When rows is given only
+    the rows with those ids are written. Returns the columns and the rows missing from the table.
+    """
+    wanted = set(rows) if rows is not None else None
+    found = set()
+    if sparse.is_sparse_table(table):
+        matrix, row_ids, names = sparse.load_csr(table)
+        positions = {name: index for index, name in enumerate(names)}
+        present = [column for column in columns if column in positions]
+        selected = np.array([positions[column] for column in present], dtype=int)
+        with open(output, "w", newline="") as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow([""] + present)
+            for row_index, row_id in enumerate(row_ids):
+                if wanted is not None and str(row_id) not in wanted:
+                    continue
+                found.add(str(row_id))
+                start, end = matrix.indptr[row_index], matrix.indptr[row_index + 1]
+                values = np.zeros(len(names))
+                values[matrix.indices[start:end]] = matrix.data[start:end]
+                writer.writerow([row_id] + [repr(float(value)) for value in values[selected]])
+    else:
+        with open(table, newline="") as table_file, open(output, "w", newline="") as output_file:
+            reader, writer = csv.reader(table_file), csv.writer(output_file)
+            header = next(reader)
+            positions = {name: index for index, name in enumerate(header)}
+            present = [column for column in columns if column in positions]
+            selected = [0] + [positions[column] for column in present]
+            writer.writerow([header[0]] + present)
+            for row in reader:
+                if not row or (wanted is not None and row[0] not in wanted):
+                    continue
+                found.add(row[0])
+                writer.writerow([row[index] for index in selected])
+    missing_rows = [row_id for row_id in rows if row_id not in found] if rows is not None else []
+    return [column for column in columns if column not in set(present)], missing_rows
+
+
+def write_new_features(table: str, headers: typing.Dict[str, typing.List[str]], output: str) -> None:
+    """Write a projected feature table as new_features, one sheet with the columns of every sheet of headers.
+
+    A CSV output gets the table as is, Excel outputs need openpyxl.
+    """
+    with open(table, newline="") as table_file:
+        reader = csv.reader(table_file)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    if Path(output).suffix == ".csv":
+        with open(output, "w", newline="") as output_file:
+            csv.writer(output_file).writerows([header] + rows)
+        return
+    if openpyxl is None:
+        raise ImportError(f"openpyxl is needed to write {output}")
+    positions = {name: index for index, name in enumerate(header)}
+    workbook = openpyxl.Workbook(write_only=True)
+    for title, columns in headers.items():
+        sheet = workbook.create_sheet(title)
+        sheet.append([header[0]] + columns)
+        selected = [positions[column] for column in columns]
+        for row in rows:
+            sheet.append([row[0]] + [float(row[index]) if row[index] != "" else None for index in selected])
+    workbook.save(output)
+
+
+def plan_filter(biobb_object) -> typing.Optional[typing.List[str]]:
+    """Selected columns of a Feature_extraction in "filter" purpose, narrowing its type and run to the families they need.
+
+    The type is only narrowed when it is "all" and every column maps to a known family.
+    """
+    columns = selected_columns(biobb_object.excel, biobb_object.sheets)
+    families = required_families(columns)
+    if families is None:
+        fu.log('Some selected features belong to no known family, computing all of them', biobb_object.out_log, biobb_object.global_log)
+    elif (biobb_object.type or "all") == "all":
+        biobb_object.type = " ".join(families)
+        biobb_object.run = run_for(families)
+        fu.log(f'{len(columns)} selected features need {len(families)} families: {biobb_object.type}',
+               biobb_object.out_log, biobb_object.global_log)
+    return columns
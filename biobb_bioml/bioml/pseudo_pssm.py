@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Module containing the pseudo PSSM profiles of the "pseudo" mode of Generate_pssm.
+
+Instead of searching homologs with PSI-BLAST, the row of every residue is its row of the BLOSUM62
+substitution matrix, the log-odds of the residues replacing it across many protein families. A
+small local profile database, a fasta of sequences related to the screened ones, shifts the scores
+towards the residues that are more frequent in it than in the background frequencies of BLOSUM62.
+The matrices are written in the ASCII format of PSI-BLAST (-out_ascii_pssm), one ``<id>.pssm``
+per record, so POSSUM and the rest of the pssm based features read them unchanged.
+"""
+import typing
+from pathlib import Path
+import numpy as np
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from biobb_common.tools import file_utils as fu
+
+AMINO_ACIDS = "ARNDCQEGHILKMFPSTWYV"
+
+BLOSUM62 = np.array([
+    [4, -1, -2, -2, 0, -1, -1, 0, -2, -1, -1, -1, -1, -2, -1, 1, 0, -3, -2, 0],
+    [-1, 5, 0, -2, -3, 1, 0, -2, 0, -3, -2, 2, -1, -3, -2, -1, -1, -3, -2, -3],
+    [-2, 0, 6, 1, -3, 0, 0, 0, 1, -3, -3, 0, -2, -3, -2, 1, 0, -4, -2, -3],
+    [-2, -2, 1, 6, -3, 0, 2, -1, -1, -3, -4, -1, -3, -3, -1, 0, -1, -4, -3, -3],
+    [0, -3, -3, -3, 9, -3, -4, -3, -3, -1, -1, -3, -1, -2, -3, -1, -1, -2, -2, -1],
+    [-1, 1, 0, 0, -3, 5, 2, -2, 0, -3, -2, 1, 0, -3, -1, 0, -1, -2, -1, -2],
+    [-1, 0, 0, 2, -4, 2, 5, -2, 0, -3, -3, 1, -2, -3, -1, 0, -1, -3, -2, -2],
+    [0, -2, 0, -1, -3, -2, -2, 6, -2, -4, -4, -2, -3, -3, -2, 0, -2, -2, -3, -3],
+    [-2, 0, 1, -1, -3, 0, 0, -2, 8, -3, -3, -1, -2, -1, -2, -1, -2, -2, 2, -3],
+    [-1, -3, -3, -3, -1, -3, -3, -4, -3, 4, 2, -3, 1, 0, -3, -2, -1, -3, -1, 3],
+    [-1, -2, -3, -4, -1, -2, -3, -4, -3, 2, 4, -2, 2, 0, -3, -2, -1, -2, -1, 1],
+    [-1, 2, 0, -1, -3, 1, 1, -2, -1, -3, -2, 5, -1, -3, -1, 0, -1, -3, -2, -2],
+    [-1, -1, -2, -3, -1, 0, -2, -3, -2, 1, 2, -1, 5, 0, -2, -1, -1, -1, -1, 1],
+    [-2, -3, -3, -3, -2, -3, -3, -3, -1, 0, 0, -3, 0, 6, -4, -2, -2, 1, 3, -1],
+    [-1, -2, -2, -1, -3, -1, -1, -2, -2, -3, -3, -1, -2, -4, 7, -1, -1, -4, -3, -2],
+    [1, -1, 1, 0, -1, 0, 0, 0, -1, -2, -2, 0, -1, -2, -1, 4, 1, -3, -2, -2],
+    [0, -1, 0, -1, -1, -1, -1, -2, -2, -1, -1, -1, -1, -2, -1, 1, 5, -2, -2, 0],
+    [-3, -3, -4, -4, -2, -2, -3, -2, -2, -3, -2, -3, -1, 1, -4, -3, -2, 11, 2, -3],
+    [-2, -2, -2, -3, -2, -1, -2, -3, 2, -1, -1, -2, -1, 3, -3, -2, -2, 2, 7, -1],
+    [0, -3, -3, -3, -1, -2, -2, -3, -3, 3, 1, -2, 1, -1, -2, -2, 0, -3, -1, 4]])
+
+# Background frequencies of the BLOSUM62 alignments (Henikoff and Henikoff, 1992)
+BACKGROUND = np.array([0.074, 0.052, 0.045, 0.054, 0.025, 0.034, 0.054, 0.074, 0.026, 0.068,
+                       0.099, 0.058, 0.025, 0.047, 0.039, 0.057, 0.051, 0.013, 0.032, 0.073])
+
+# Ambiguous residues score like the residues they stand for, the rest like the average residue
+AMBIGUOUS = {"B": "ND", "Z": "QE", "J": "IL", "U": "C", "O": "K"}
+
+
+def composition(fasta: str) -> np.ndarray:
+    """Frequency of the 20 amino acids in the sequences of a fasta, with one pseudo count each."""
+    counts = np.ones(len(AMINO_ACIDS))
+    lookup = {residue: index for index, residue in enumerate(AMINO_ACIDS)}
+    with open(fasta) as fasta_file:
+        for _, sequence in SimpleFastaParser(fasta_file):
+            for residue in sequence.upper():
+                if residue in lookup:
+                    counts[lookup[residue]] += 1
+    return counts / counts.sum()
+
+
+def profile_bias(profile_db: str = None) -> np.ndarray:
+    """Half bit scores of the enrichment of every residue in profile_db over the BLOSUM62 background, zeros without it."""
+    if not profile_db:
+        return np.zeros(len(AMINO_ACIDS))
+    return 2 * np.log2(composition(profile_db) / BACKGROUND)
+
+
+def pseudo_pssm(sequence: str, bias: np.ndarray = None) -> np.ndarray:
+    """The L x 20 integer scores of a sequence, the BLOSUM62 row of every residue plus the bias of the profile database."""
+    rows = {residue: BLOSUM62[index].astype(float) for index, residue in enumerate(AMINO_ACIDS)}
+    for residue, meaning in AMBIGUOUS.items():
+        rows[residue] = np.mean([rows[member] for member in meaning], axis=0)
+    average = BLOSUM62.mean(axis=0)
+    scores = np.array([rows.get(residue, average) for residue in sequence.upper().rstrip("*")]).reshape(-1, len(AMINO_ACIDS))
+    if bias is not None:
+        scores = scores + bias
+    return np.rint(scores).astype(int)
+
+
+def write_ascii_pssm(sequence: str, scores: np.ndarray, output: str) -> None:
+    """Write scores in the ASCII PSSM layout of PSI-BLAST, the observed percentages are those of the sequence alone."""
+    header = "           " + "  ".join(AMINO_ACIDS) + "   " + "   ".join(AMINO_ACIDS)
+    lookup = {residue: index for index, residue in enumerate(AMINO_ACIDS)}
+    with open(output, "w") as pssm_file:
+        pssm_file.write("\nLast position-specific scoring matrix computed, weighted observed percentages rounded down, "
+                        "information per position, and relative weight of gapped frame matches to pseudo-counts\n")
+        pssm_file.write(header + "\n")
+        for position, (residue, row) in enumerate(zip(sequence.upper().rstrip("*"), scores), start=1):
+            observed = np.zeros(len(AMINO_ACIDS), dtype=int)
+            if residue in lookup:
+                observed[lookup[residue]] = 100
+            pssm_file.write(f"{position:>5} {residue} " + "".join(f"{score:>3}" for score in row) + " "
+                            + "".join(f"{percentage:>4}" for percentage in observed) + "  0.00 0.00\n")
+        pssm_file.write("\n                      K         Lambda\nStandard Ungapped    0.1335     0.3150\n"
+                        "PSI Ungapped         0.0000     0.0000\n")
+
+
+def generate(input_fasta: str, pssm_dir: str, profile_db: str = None, out_log=None, global_log=None) -> int:
+    """Write the pseudo PSSM of every record of input_fasta to pssm_dir/<id>.pssm and return how many were written."""
+    Path(pssm_dir).mkdir(parents=True, exist_ok=True)
+    bias = profile_bias(profile_db)
+    written = 0
+    with open(input_fasta) as fasta_file:
+        for title, sequence in SimpleFastaParser(fasta_file):
+            record_id = title.split(None, 1)[0] if title.strip() else f"sequence_{written}"
+            write_ascii_pssm(sequence, pseudo_pssm(sequence, bias), str(Path(pssm_dir).joinpath(f"{record_id}.pssm")))
+            written += 1
+    fu.log(f'Wrote {written} pseudo PSSM profiles to {pssm_dir}'
+           + (f', biased by the composition of {profile_db}' if profile_db else ''), out_log, global_log)
+    return written
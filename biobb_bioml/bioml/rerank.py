@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+"""Module containing the Rerank class and the command line interface."""
+import argparse
+import csv
+import typing
+import numpy as np
+from biobb_common.generic.biobb_object import BiobbObject
+from biobb_common.configuration import settings
+from biobb_common.tools import file_utils as fu
+from biobb_common.tools.file_utils import launchlogger
+from biobb_bioml.bioml import common as com
+from biobb_bioml.bioml import planner
+from biobb_bioml.bioml import telemetry
+
+SPLITS = ("train", "test")
+METRICS = ("MCC", "precision_0", "recall_0", "f1_0", "precision_1", "recall_1", "f1_1")
+
+
+def read_metrics(metrics_path: str) -> typing.Tuple[typing.List[str], typing.Dict[str, np.ndarray]]:
+    """Read the metrics table written by Model_training or Ensemble.
+
+    The table has one row per candidate, the candidate name in the first column and
+    one ``<split>_<metric>`` column for every split in SPLITS and metric in METRICS.
+    """
+    with open(metrics_path, newline='') as metrics_file:
+        reader = csv.reader(metrics_file)
+        header = next(reader)
+        names = []
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            names.append(row[0])
+            rows.append(row[1:])
+    values = np.array(rows, dtype=float).reshape(len(rows), len(header) - 1)
+    columns = {column: values[:, index] for index, column in enumerate(header[1:])}
+    missing = [f"{split}_{metric}" for split in SPLITS for metric in METRICS if f"{split}_{metric}" not in columns]
+    if missing:
+        raise ValueError(f"The metrics table {metrics_path} is missing the columns {missing}")
+    return names, columns
+
+
+def rank_scores(columns: typing.Dict[str, np.ndarray], precision_weight: float = 1, recall_weight: float = 0.8,
+                class0_weight: float = 0.5, report_weight: float = 0.25, difference_weight: float = 1.1) -> np.ndarray:
+    """Score every candidate at once from its train and test metrics.
+
+    Each split is scored as MCC + report_weight * (report of class 1 + class0_weight * report of class 0),
+    the report of a class being precision_weight * precision + recall_weight * recall + f1. The final score
+    is the test score penalized by difference_weight times its distance to the train score.
+    """
+    split_scores = {}
+    for split in SPLITS:
+        report = [precision_weight * columns[f"{split}_precision_{label}"] +
+                  recall_weight * columns[f"{split}_recall_{label}"] +
+                  columns[f"{split}_f1_{label}"] for label in (0, 1)]
+        split_scores[split] = columns[f"{split}_MCC"] + report_weight * (report[1] + class0_weight * report[0])
+    return split_scores["test"] - difference_weight * np.abs(split_scores["train"] - split_scores["test"])
+
+
+class Rerank(BiobbObject):
+    """
+    | biobb_bioml Rerank
+    | Rank the candidates of Model_training or Ensemble again with new weights.
+    | Apply new ranking weights to the persisted metrics table without retraining any model.
+
+    Args:
+        input_metrics (str): The metrics table written by Model_training or Ensemble with the train and test metrics of every candidate. File type: input. Accepted formats: CSV (edam:format_3752).
+        output_ranking (str): The candidates sorted by their new score. File type: output. Accepted formats: CSV (edam:format_3752).
+        properties (dict):
+            * **precision_weight** (*float*) - (1) Weights to specify how relevant is the precision for the ranking of the different features.
+            * **recall_weight** (*float*) - (0.8) Weights to specify how relevant is the recall for the ranking of the different features.
+            * **class0_weight** (*float*) - (0.5) Weights to specify how relevant is the f1, precision and recall scores of the class 0 or the negative class for the ranking of the different features with respect to class 1 or the positive class.
+            * **report_weight** (*float*) - (0.25) Weights to specify how relevant is the f1, precision and recall for the ranking of the different features with respect to MCC which is a more general measures of the performance of a model.
+            * **difference_weight** (*float*) - (1.1) How important is to have similar training and test metrics.
+            * **cache_dir** (*str*) - (None) Directory of the content addressed cache, the outputs are reused when the contents of the inputs and the properties match a previous run. If None the cache is disabled.
+            * **staging** (*str*) - ("copy") How the inputs are staged in the unique directory and the outputs brought back, "link" reflinks the inputs, hardlinks the read-only ones when reflinks are not supported and copies the rest, and moves the outputs, "symlink" uses symbolic links for the inputs, ("copy", "link", "symlink").
+            * **telemetry_dir** (*str*) - (None) Directory where a JSON telemetry record of every launch is written: wall time of the staging, command, outputs and cleanup phases, peak RSS, CPU time and io of the command process tree and the input and output sizes. If None no record is written.
+
+    Examples:
+        This is a use example of how to use the building block from Python::
+
+            from biobb_bioml.rerank import rerank
+            prop = { precision_weight: 1,
+                    recall_weight: 1,
+                    class0_weight: 0.3,
+                    report_weight: 0.25,
+                    difference_weight: 1.5}
+
+            rerank(input_metrics='training_results/metrics.csv',
+                    output_ranking='ranking.csv',
+                    properties=prop)
+
+    Info:
+        * wrapped_software:
+            * name: In house
+            * license: LGPL 2.1
+        * ontology:
+            * name: EDAM
+            * schema: http://edamontology.org/EDAM.owl
+    """
+
+    def __init__(self, input_metrics: str, output_ranking: str, properties: dict = None, **kwargs) -> None:
+        properties = properties or {}
+
+        # Call parent class constructor
+        super().__init__(properties)
+
+        # Input/Output files
+        self.io_dict = {
+            "in": {"input_metrics": input_metrics},
+            "out": {"output_ranking": output_ranking}
+        }
+
+        # Properties specific for BB
+        self.precision_weight = float(properties.get('precision_weight', 1))
+        self.recall_weight = float(properties.get('recall_weight', 0.8))
+        self.class0_weight = float(properties.get('class0_weight', 0.5))
+        self.report_weight = float(properties.get('report_weight', 0.25))
+        self.difference_weight = float(properties.get('difference_weight', 1.1))
+        self.cache_dir = properties.get('cache_dir', None)
+        self.staging = properties.get('staging', None)
+        self.telemetry_dir = properties.get('telemetry_dir', None)
+
+        # Properties common in all BB
+
+        # Check the properties
+        self.check_properties(properties)
+
+    @launchlogger
+    def launch(self) -> int:
+        """Execute the :class:`Rerank <bioml.rerank.Rerank>` object."""
+
+        # Setup Biobb
+        if self.check_restart() or com.check_cache(self): return 0
+        com.stage_files(self)
+
+        telemetry.mark(self, "command")
+        names, columns = read_metrics(self.stage_io_dict["in"]["input_metrics"])
+        scores = rank_scores(columns, precision_weight=self.precision_weight, recall_weight=self.recall_weight,
+                             class0_weight=self.class0_weight, report_weight=self.report_weight,
+                             difference_weight=self.difference_weight)
+        order = np.argsort(-scores, kind="stable")
+        fu.log(f'Ranked {len(names)} candidates, best: {names[order[0]] if names else None}', self.out_log, self.global_log)
+
+        with open(self.stage_io_dict["out"]["output_ranking"], 'w', newline='') as ranking_file:
+            writer = csv.writer(ranking_file)
+            writer.writerow(["rank", "candidate", "score"])
+            for rank, index in enumerate(order, start=1):
+                writer.writerow([rank, names[index], f"{scores[index]:.6f}"])
+        self.return_code = 0
+        telemetry.mark(self, "outputs")
+
+        # Copy files to host
+        com.copy_to_host(self)
+
+        # Remove temporal files
+        self.tmp_files.extend([self.stage_io_dict.get("unique_dir"), ""])
+        com.remove_tmp_files(self)
+
+        # Cache the outputs for identical runs and write the telemetry record
+        com.store_cache(self)
+        telemetry.write_record(self)
+
+        return self.return_code
+
+
+def rerank(input_metrics: str, output_ranking: str, properties: dict = None, **kwargs) -> int:
+    """Create :class:`Rerank <bioml.rerank.Rerank>` class and
+        execute the :meth:`launch() <bioml.rerank.Rerank.launch>` method."""
+    return Rerank(input_metrics=input_metrics, output_ranking=output_ranking, properties=properties, **kwargs).launch()
+
+
+def main():
+    """Command line execution of this building block. Please check the command line documentation."""
+    parser = argparse.ArgumentParser(description="Rank the Model_training or Ensemble candidates with new weights.",
+                                     formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, width=99999))
+    parser.add_argument('-c', '--config', required=False, help="This file can be a YAML file, JSON file or JSON string")
+
+    # Specific args of each building block
+    required_args = parser.add_argument_group('required arguments')
+    required_args.add_argument('--input_metrics', required=True)
+    required_args.add_argument('--output_ranking', required=True)
+    parser.add_argument('--plan', required=False, action='store_true', help="Print the estimated CPU hours, peak memory and scratch disk of the run, calibrated with the records of telemetry_dir, instead of running it")
+
+    args = parser.parse_args()
+    config = args.config if args.config else None
+    properties = settings.ConfReader(config=config).get_prop_dic()
+    if args.plan:
+        planner.print_plan("Rerank", {"input_metrics": args.input_metrics}, properties)
+        return
+
+    # Specific call of each building block
+    rerank(input_metrics=args.input_metrics, output_ranking=args.output_ranking, properties=properties)
+
+
+if __name__ == '__main__':
+    main()
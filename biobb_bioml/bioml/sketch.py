@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+"""Module containing the mergeable quantile sketches and the streaming robust scaler.
+
+The sketch is a KLL style compactor hierarchy kept for every column at once: every level is a
+``(items, columns)`` array whose items weigh ``2**level``, and a full level is sorted column by column
+and half of its items, the odd or the even ones at random, are promoted to the next level. Every
+column sees the same number of values, so the compactions are vectorized over the columns. With
+``k`` items per level the rank error is about ``log2(n / k) / k`` of n, and two sketches of
+different chunks, maybe built by different workers, merge level by level into the sketch of all
+the rows. The robust scaler only needs the median and the quartiles of every column, so it is
+fitted without holding the columns in memory and saved as an npz next to the models.
+"""
+import argparse
+import csv
+import os
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+
+class ColumnQuantileSketch:
+    """Quantile sketch of every column of a table, updated with chunks of rows.
+
+    Args:
+        n_columns (int): Number of columns.
+        k (int): (256) Items per level, the rank error is about log2(n / k) / k.
+        seed (int): (0) Seed of the random choice of the items kept by the compactions.
+    """
+
+    def __init__(self, n_columns: int, k: int = 256, seed: int = 0) -> None:
+        self.n_columns = n_columns
+        self.k = max(2, int(k))
+        self.count = 0
+        self.levels: typing.List[np.ndarray] = []
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values: np.ndarray) -> None:
+        """Add a (rows, n_columns) chunk."""
+        values = np.asarray(values, dtype=np.float64).reshape(-1, self.n_columns)
+        self.count += len(values)
+        self._add(0, values)
+        self._compress()
+
+    def _add(self, level: int, items: np.ndarray) -> None:
+        while len(self.levels) <= level:
+            self.levels.append(np.zeros((0, self.n_columns)))
+        self.levels[level] = np.vstack([self.levels[level], items])
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.k:
+                items = np.sort(items, axis=0)
+                # An odd item out stays at this level so the weights add up exactly
+                keep = len(items) % 2
+                self.levels[level] = items[:keep]
+                self._add(level + 1, items[keep + self.rng.integers(2)::2])
+            level += 1
+
+    def merge(self, other: "ColumnQuantileSketch") -> "ColumnQuantileSketch":
+        """Add the rows summarized by other to this sketch."""
+        if other.n_columns != self.n_columns:
+            raise ValueError(f"Can not merge sketches of {self.n_columns} and {other.n_columns} columns")
+        for level, items in enumerate(other.levels):
+            self._add(level, items)
+        self.count += other.count
+        self._compress()
+        return self
+
+    def quantiles(self, qs: typing.Sequence[float], block_columns: int = 256) -> np.ndarray:
+        """The (len(qs), n_columns) estimates of the quantiles qs, between 0 and 1, of every column.
+
+        The columns are sorted in blocks of block_columns to bound the memory of the query.
+        """
+        estimates = np.full((len(qs), self.n_columns), np.nan)
+        if not self.count:
+            return estimates
+        weights = np.concatenate([np.full(len(level), 2.0 ** index) for index, level in enumerate(self.levels)])
+        for first in range(0, self.n_columns, block_columns):
+            items = np.vstack([level[:, first:first + block_columns] for level in self.levels])
+            order = np.argsort(items, axis=0, kind="stable")
+            cumulative = np.cumsum(weights[order], axis=0)
+            columns = np.arange(items.shape[1])
+            for row, q in enumerate(qs):
+                # Linear interpolation between the closest ranks, like np.percentile, exact while no item was compacted
+                rank = q * (cumulative[-1] - 1)
+                below, above = np.floor(rank), np.ceil(rank)
+                low = np.minimum((cumulative <= below).sum(axis=0), len(items) - 1)
+                high = np.minimum((cumulative <= above).sum(axis=0), len(items) - 1)
+                low_values, high_values = items[order[low, columns], columns], items[order[high, columns], columns]
+                estimates[row, first:first + block_columns] = low_values + (rank - below) * (high_values - low_values)
+        return estimates
+
+    def to_arrays(self) -> typing.Dict[str, np.ndarray]:
+        arrays = {f"level_{index}": level for index, level in enumerate(self.levels)}
+        return {**arrays, "count": np.array(self.count), "k": np.array(self.k)}
+
+    @classmethod
+    def from_arrays(cls, arrays: typing.Mapping[str, np.ndarray], seed: int = 0) -> "ColumnQuantileSketch":
+        levels = [np.asarray(arrays[f"level_{index}"]) for index in range(sum(name.startswith("level_") for name in arrays))]
+        sketch = cls(levels[0].shape[1] if levels else 0, int(arrays["k"]), seed)
+        sketch.levels, sketch.count = levels, int(arrays["count"])
+        return sketch
+
+
+def _byte_ranges(path: str, parts: int) -> typing.List[typing.Tuple[int, int]]:
+    """Split the rows of a CSV, after its header, in parts byte ranges starting at line boundaries."""
+    with open(path, "rb") as table:
+        table.readline()
+        start, size = table.tell(), os.path.getsize(path)
+        bounds = [start]
+        for part in range(1, parts):
+            table.seek(max(start + (size - start) * part // parts, bounds[-1]))
+            table.readline()
+            bounds.append(max(table.tell(), bounds[-1]))
+        bounds.append(size)
+    return [(begin, end) for begin, end in zip(bounds[:-1], bounds[1:]) if end > begin]
+
+
+def _sketch_range(path: str, begin: int, end: int, columns: typing.Sequence[int], k: int, chunk_rows: int,
+                  seed: int) -> typing.Dict[str, np.ndarray]:
+    sketch = ColumnQuantileSketch(len(columns), k, seed)
+    with open(path, "rb") as table:
+        table.seek(begin)
+        lines = []
+        while table.tell() < end:
+            line = table.readline()
+            if line.strip():
+                lines.append(line.decode())
+            if len(lines) == chunk_rows or (lines and table.tell() >= end):
+                sketch.update(np.loadtxt(lines, delimiter=",", usecols=columns, ndmin=2))
+                lines = []
+    return sketch.to_arrays()
+
+
+def sketch_table(path: str, columns: typing.Sequence[str] = None, k: int = 256, chunk_rows: int = 10000,
+                 workers: int = 1) -> typing.Tuple[typing.List[str], ColumnQuantileSketch]:
+    """Sketch of the given columns (all by default) of a feature table, ids in the first column.
+
+    CSV tables are split in byte ranges sketched by workers processes and merged, Excel tables
+    (first sheet) are streamed by a single reader with openpyxl.
+    """
+    if Path(path).suffix == ".csv":
+        with open(path, newline="") as table:
+            header = next(csv.reader(table))
+        names = list(columns) if columns else header[1:]
+        positions = [header.index(name) for name in names]
+        ranges = _byte_ranges(path, max(1, int(workers)))
+        if len(ranges) > 1:
+            with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+                parts = list(executor.map(_sketch_range, *zip(*[(path, begin, end, positions, k, chunk_rows, seed)
+                                                                 for seed, (begin, end) in enumerate(ranges)])))
+        else:
+            parts = [_sketch_range(path, ranges[0][0], ranges[0][1], positions, k, chunk_rows, 0)] if ranges else []
+        sketch = ColumnQuantileSketch(len(names), k)
+        for part in parts:
+            sketch.merge(ColumnQuantileSketch.from_arrays(part))
+        return names, sketch
+    if openpyxl is None:
+        raise ImportError(f"openpyxl is needed to read {path}")
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    rows = workbook.worksheets[0].iter_rows(values_only=True)
+    header = [str(name) for name in next(rows)]
+    names = list(columns) if columns else header[1:]
+    positions = [header.index(name) for name in names]
+    sketch, block = ColumnQuantileSketch(len(names), k), []
+    for row in rows:
+        block.append([row[position] for position in positions])
+        if len(block) == chunk_rows:
+            sketch.update(np.array(block, dtype=float))
+            block = []
+    if block:
+        sketch.update(np.array(block, dtype=float))
+    workbook.close()
+    return names, sketch
+
+
+class StreamingRobustScaler:
+    """RobustScaler of scikit-learn (centered on the median, scaled by the interquartile range) fitted with quantile sketches.
+
+    Args:
+        quantile_range (tuple): ((25.0, 75.0)) Percentiles of the range the features are scaled by.
+        k (int): (256) Items per level of the sketches.
+    """
+
+    def __init__(self, quantile_range: typing.Tuple[float, float] = (25.0, 75.0), k: int = 256) -> None:
+        self.quantile_range = tuple(quantile_range)
+        self.k = k
+        self.sketch: typing.Optional[ColumnQuantileSketch] = None
+        self.columns: typing.List[str] = []
+        self.center_ = self.scale_ = None
+
+    def partial_fit(self, values: np.ndarray) -> "StreamingRobustScaler":
+        values = np.asarray(values, dtype=np.float64)
+        if self.sketch is None:
+            self.sketch = ColumnQuantileSketch(values.shape[1], self.k)
+        self.sketch.update(values)
+        return self._finalize()
+
+    def fit(self, values: np.ndarray, chunk_rows: int = 10000) -> "StreamingRobustScaler":
+        for start in range(0, len(values), chunk_rows):
+            self.partial_fit(values[start:start + chunk_rows])
+        return self
+
+    def fit_table(self, path: str, columns: typing.Sequence[str] = None, chunk_rows: int = 10000, workers: int = 1) -> "StreamingRobustScaler":
+        self.columns, self.sketch = sketch_table(path, columns, self.k, chunk_rows, workers)
+        return self._finalize()
+
+    def merge(self, other: "StreamingRobustScaler") -> "StreamingRobustScaler":
+        self.sketch = other.sketch if self.sketch is None else self.sketch.merge(other.sketch)
+        return self._finalize()
+
+    def _finalize(self) -> "StreamingRobustScaler":
+        low, median, high = self.sketch.quantiles([self.quantile_range[0] / 100, 0.5, self.quantile_range[1] / 100])
+        self.center_ = median
+        # Constant columns are only centered, like in scikit-learn
+        self.scale_ = np.where(high - low > 0, high - low, 1.0)
+        return self
+
+    def select(self, columns: typing.Sequence[str]) -> "StreamingRobustScaler":
+        """A scaler of the given columns, in their order, of a scaler fitted on a named table."""
+        positions = [self.columns.index(column) for column in columns]
+        selected = StreamingRobustScaler(self.quantile_range, self.k)
+        selected.center_, selected.scale_, selected.columns = self.center_[positions], self.scale_[positions], list(columns)
+        return selected
+
+    def transform(self, values: np.ndarray) -> np.ndarray:
+        return (np.asarray(values) - self.center_) / self.scale_
+
+    def fit_transform(self, values: np.ndarray) -> np.ndarray:
+        return self.fit(values).transform(values)
+
+    def save(self, path: str) -> None:
+        """Save the center, the scale and the columns with the sketch, so the scaler can also be refined with more rows."""
+        with open(path, "wb") as scaler_file:
+            np.savez(scaler_file, center=self.center_, scale=self.scale_, columns=np.array(self.columns, dtype=str),
+                     quantile_range=np.array(self.quantile_range), **self.sketch.to_arrays())
+
+    @classmethod
+    def load(cls, path: str) -> "StreamingRobustScaler":
+        with np.load(path, allow_pickle=False) as loaded:
+            arrays = dict(loaded)
+        scaler = cls(tuple(arrays["quantile_range"]), int(arrays["k"]))
+        scaler.sketch = ColumnQuantileSketch.from_arrays(arrays)
+        scaler.center_, scaler.scale_, scaler.columns = arrays["center"], arrays["scale"], arrays["columns"].tolist()
+        return scaler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit a robust scaler on a feature table with streaming quantile sketches.")
+    parser.add_argument('table', help="CSV or Excel feature table, ids in the first column")
+    parser.add_argument('output', help="npz of the fitted scaler")
+    parser.add_argument('--k', type=int, default=256)
+    parser.add_argument('--chunk_rows', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    scaler = StreamingRobustScaler(k=args.k).fit_table(args.table, chunk_rows=args.chunk_rows, workers=args.workers)
+    scaler.save(args.output)
+    print(f"Fitted on {scaler.sketch.count} rows and {len(scaler.columns)} columns, saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
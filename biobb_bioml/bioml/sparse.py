@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""Module containing the sparse (CSR) storage of the feature tables.
+
+The matrices are saved as ``.npz`` files with the ``data``, ``indices``, ``indptr``, ``shape`` and
+``format`` arrays of ``scipy.sparse.save_npz``, so ``scipy.sparse.load_npz`` reads them, plus the
+``rows`` (sequence ids) and ``columns`` (feature names) of the table. scipy is optional, without it
+the matrices are returned as a :class:`CSR` tuple of numpy arrays.
+"""
+import csv
+import typing
+from pathlib import Path
+import numpy as np
+from biobb_common.tools import file_utils as fu
+try:
+    from scipy import sparse as sp
+except ImportError:
+    sp = None
+
+
+class CSR(typing.NamedTuple):
+    data: np.ndarray
+    indices: np.ndarray
+    indptr: np.ndarray
+    shape: typing.Tuple[int, int]
+
+
+def csv_to_csr(csv_path: str, npz_path: str, dtype: typing.Any = np.float64, chunk_rows: int = 1000) -> typing.Dict[str, typing.Any]:
+    """Convert a feature table (ids in the first column, names in the header) to a CSR npz row by row.
+
+    Only the non zero values are kept in memory, the dense table is never built.
+    """
+    data_chunks, index_chunks, row_nnz, rows = [], [], [], []
+    with open(csv_path, newline="") as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)[1:]
+        block: typing.List[typing.List[str]] = []
+        for row in reader:
+            if not row:
+                continue
+            rows.append(row[0])
+            block.append(row[1:])
+            if len(block) == chunk_rows:
+                _add_block(block, dtype, data_chunks, index_chunks, row_nnz)
+                block = []
+        if block:
+            _add_block(block, dtype, data_chunks, index_chunks, row_nnz)
+    data = np.concatenate(data_chunks) if data_chunks else np.zeros(0, dtype=dtype)
+    indices = np.concatenate(index_chunks).astype(np.int32) if index_chunks else np.zeros(0, dtype=np.int32)
+    indptr = np.concatenate([[0], np.cumsum(row_nnz)]).astype(np.int64)
+    shape = (len(rows), len(columns))
+    np.savez_compressed(npz_path, data=data, indices=indices, indptr=indptr, shape=np.array(shape), format=np.array("csr"),
+                        rows=np.array(rows, dtype=str), columns=np.array(columns, dtype=str))
+    cells = shape[0] * shape[1]
+    return {"rows": shape[0], "columns": shape[1], "nnz": int(data.size),
+            "density": round(data.size / cells, 4) if cells else 0.0,
+            "dense_bytes": cells * np.dtype(dtype).itemsize, "sparse_bytes": Path(npz_path).stat().st_size}
+
+
+def _add_block(block, dtype, data_chunks, index_chunks, row_nnz) -> None:
+    # Empty cells are missing features, stored as zeros
+    values = np.array([[cell if cell.strip() else 0 for cell in row] for row in block], dtype=dtype)
+    row_index, column_index = np.nonzero(values)
+    data_chunks.append(values[row_index, column_index])
+    index_chunks.append(column_index)
+    row_nnz.extend(np.bincount(row_index, minlength=len(block)))
+
+
+def load_csr(npz_path: str) -> typing.Tuple[typing.Any, typing.List[str], typing.List[str]]:
+    """The matrix, the row ids and the column names of a CSR npz.
+
+    The matrix is a scipy.sparse.csr_matrix when scipy is installed, a :class:`CSR` otherwise.
+    """
+    with np.load(npz_path, allow_pickle=False) as loaded:
+        shape = tuple(int(size) for size in loaded["shape"])
+        parts = loaded["data"], loaded["indices"], loaded["indptr"]
+        rows = loaded["rows"].tolist() if "rows" in loaded else [str(index) for index in range(shape[0])]
+        columns = loaded["columns"].tolist() if "columns" in loaded else [str(index) for index in range(shape[1])]
+    matrix = sp.csr_matrix(parts, shape=shape) if sp else CSR(*parts, shape)
+    return matrix, rows, columns
+
+
+def csr_to_csv(npz_path: str, csv_path: str) -> None:
+    """Write a CSR npz back as a dense feature table, row by row, for the programs that only read dense tables."""
+    matrix, rows, columns = load_csr(npz_path)
+    with open(csv_path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow([""] + columns)
+        for row_index, row_id in enumerate(rows):
+            start, end = matrix.indptr[row_index], matrix.indptr[row_index + 1]
+            values = np.zeros(len(columns), dtype=matrix.data.dtype)
+            values[matrix.indices[start:end]] = matrix.data[start:end]
+            writer.writerow([row_id] + [repr(float(value)) for value in values])
+
+
+def stage_dense(biobb_object, file_ref: str) -> None:
+    """Replace a staged CSR npz input of a block by its dense CSV, BioML only reads dense tables."""
+    staged = biobb_object.stage_io_dict["in"].get(file_ref)
+    if not staged or not is_sparse_table(staged):
+        return
+    dense = str(Path(staged).with_suffix(".csv"))
+    csr_to_csv(staged, dense)
+    fu.log(f'BioML reads dense tables, {Path(staged).name} was written as {Path(dense).name}', biobb_object.out_log, biobb_object.global_log)
+    biobb_object.stage_io_dict["in"][file_ref] = dense
+    biobb_object.tmp_files.append(dense)
+
+
+def is_sparse_table(path: str) -> bool:
+    return Path(path).suffix == ".npz"
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+"""Module containing the streaming of the PSSM features while Generate_pssm runs.
+
+PSI-BLAST writes one ``.pssm`` file per sequence. A watcher thread polls the pssm folder and, as
+soon as a file stops growing, queues it (a file that changes after being queued is queued again,
+and a profile without the trailer of PSI-BLAST is not read); every ``batch_size`` files a feature worker computes their
+POSSUM descriptors and writes them to a partial table. Feature extraction overlaps with the
+profiling, and when the last profile is written only the last batch is left, so the features are
+ready without zipping and unzipping the pssm folder. The partial tables are merged in the order of
+the fasta, reading the rows through their byte offsets instead of loading them.
+"""
+import os
+import re
+import threading
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+from biobb_common.tools import file_utils as fu
+
+AMINO_ACIDS = "ARNDCQEGHILKMFPSTWYV"
+AC_LAGS = 10
+
+
+def read_pssm(pssm_path: str, length: int = None) -> np.ndarray:
+    """The L x 20 scores of an ASCII pssm of PSI-BLAST (-out_ascii_pssm), or of a plain table of 20 scores per row.
+
+    An ASCII pssm without the Lambda trailer that PSI-BLAST writes last, or with a number of rows
+    other than length when it is given, is still being written and raises a ValueError.
+    """
+    rows, ascii_pssm, trailer = [], False, False
+    with open(pssm_path) as pssm_file:
+        for line in pssm_file:
+            fields = line.split()
+            if len(fields) >= 22 and fields[0].isdigit() and fields[1].isalpha():
+                rows.append(fields[2:22])
+            elif len(fields) == 20 and all(re.fullmatch(r"-?\d+", field) for field in fields):
+                rows.append(fields)
+            elif line.startswith("Last position-specific scoring matrix"):
+                ascii_pssm = True
+            elif "Lambda" in fields or line.startswith("PSI Gapped"):
+                trailer = True
+    if not rows:
+        raise ValueError(f"No pssm scores in {pssm_path}")
+    if ascii_pssm and not trailer:
+        raise ValueError(f"The pssm {pssm_path} is incomplete, it has no Lambda trailer")
+    if length is not None and len(rows) != length:
+        raise ValueError(f"The pssm {pssm_path} has {len(rows)} rows for a sequence of {length} residues")
+    return np.array(rows, dtype=float)
+
+
+def normalize(scores: np.ndarray) -> np.ndarray:
+    """Logistic scaling of the scores to (0, 1) as POSSUM does before computing the descriptors."""
+    return 1.0 / (1.0 + np.exp(-scores))
+
+
+def aac_pssm(pssm: np.ndarray) -> np.ndarray:
+    """Average of every column of the pssm, 20 values."""
+    return pssm.mean(axis=0)
+
+
+def dpc_pssm(pssm: np.ndarray) -> np.ndarray:
+    """Dipeptide composition, the mean product of the scores of consecutive residues, 400 values."""
+    if len(pssm) < 2:
+        return np.zeros(400)
+    return (pssm[:-1].T @ pssm[1:]).ravel() / (len(pssm) - 1)
+
+
+def pssm_ac(pssm: np.ndarray) -> np.ndarray:
+    """Auto covariance of every column with the lags 1 to 10, 200 values."""
+    centered = pssm - pssm.mean(axis=0)
+    values = np.zeros((AC_LAGS, 20))
+    for lag in range(1, min(AC_LAGS, len(pssm) - 1) + 1):
+        values[lag - 1] = (centered[:-lag] * centered[lag:]).mean(axis=0)
+    return values.ravel()
+
+
+DESCRIPTORS: typing.Dict[str, typing.Callable[[np.ndarray], np.ndarray]] = {
+    "aac_pssm": aac_pssm, "dpc_pssm": dpc_pssm, "pssm_ac": pssm_ac}
+SIZES = {"aac_pssm": 20, "dpc_pssm": 400, "pssm_ac": 20 * AC_LAGS}
+
+
+def feature_names(descriptors: typing.Sequence[str]) -> typing.List[str]:
+    """Column names of the descriptors, <family>_<index> like the columns of Feature_extraction."""
+    return [f"{name}_{index}" for name in descriptors for index in range(1, SIZES[name] + 1)]
+
+
+def compute_batch(pssm_files: typing.Sequence[str], descriptors: typing.Sequence[str], output: str) -> typing.Dict[str, typing.Any]:
+    """Write a headerless table with the descriptors of every pssm, the id (the file stem) in the first column."""
+    failed = []
+    with open(output, "w") as output_file:
+        for pssm_file in pssm_files:
+            try:
+                pssm = normalize(read_pssm(pssm_file))
+            except (OSError, ValueError):
+                failed.append(pssm_file)
+                continue
+            values = np.concatenate([DESCRIPTORS[name](pssm) for name in descriptors])
+            output_file.write(Path(pssm_file).stem + "," + ",".join(f"{value:.6g}" for value in values) + "\n")
+    return {"table": output, "rows": len(pssm_files) - len(failed), "failed": failed}
+
+
+def fasta_ids(fasta: str) -> typing.List[str]:
+    """Ids of the records of a fasta in order, the first word of every header."""
+    with open(fasta) as fasta_file:
+        return [line[1:].split(None, 1)[0] for line in fasta_file if line.startswith(">") and line[1:].strip()]
+
+
+class PssmStream:
+    """Context manager computing the descriptors of the pssm files of pssm_dir while they are written.
+
+    Args:
+        pssm_dir (str): Folder where PSI-BLAST writes the .pssm files, it may not exist yet.
+        work_dir (str): Folder for the partial tables of the batches.
+        descriptors (list): Names of the descriptors, keys of DESCRIPTORS.
+        batch_size (int): (16) Number of pssm files per feature job.
+        workers (int): (2) Number of feature jobs running at the same time.
+        interval (float): (1.0) Seconds between two scans of pssm_dir. A file is queued when its size did not change between two scans, and queued again if it changes later.
+    """
+
+    def __init__(self, pssm_dir: str, work_dir: str, descriptors: typing.Sequence[str], batch_size: int = 16,
+                 workers: int = 2, interval: float = 1.0, out_log=None, global_log=None) -> None:
+        unknown = [name for name in descriptors if name not in DESCRIPTORS]
+        if unknown:
+            raise ValueError(f"Unknown pssm descriptors {unknown}, available: {list(DESCRIPTORS)}")
+        self.pssm_dir = Path(pssm_dir)
+        self.work_dir = Path(work_dir)
+        self.descriptors = list(descriptors)
+        self.batch_size = max(1, int(batch_size))
+        self.interval = interval
+        self.out_log, self.global_log = out_log, global_log
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)))
+        self.futures: typing.List[Future] = []
+        self.sizes: typing.Dict[str, int] = {}
+        # Size and modification time of every queued file when it was queued
+        self.queued: typing.Dict[str, typing.Tuple[int, int]] = {}
+        self.pending: typing.List[str] = []
+        self.overlapped = 0
+        self.requeued = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+
+    def __enter__(self) -> "PssmStream":
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
+        # The command is over, every file left is complete
+        self._scan(final=True)
+        self._submit(flush=True)
+        self.executor.shutdown(wait=True)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._scan()
+            self.overlapped = len(self.queued)
+            self._submit()
+
+    def _scan(self, final: bool = False) -> None:
+        if not self.pssm_dir.is_dir():
+            return
+        with os.scandir(self.pssm_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".pssm"):
+                    continue
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if entry.path in self.queued:
+                    if self.queued[entry.path] == signature:
+                        continue
+                    # Written again after it was queued, its features are computed once more when it is stable
+                    del self.queued[entry.path]
+                    self.sizes[entry.path] = stat.st_size
+                    self.requeued += 1
+                    if not final:
+                        continue
+                if final or (stat.st_size and self.sizes.get(entry.path) == stat.st_size):
+                    self.queued[entry.path] = signature
+                    self.pending.append(entry.path)
+                else:
+                    self.sizes[entry.path] = stat.st_size
+
+    def _submit(self, flush: bool = False) -> None:
+        while len(self.pending) >= self.batch_size or (flush and self.pending):
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            output = str(self.work_dir.joinpath(f"batch_{len(self.futures):06d}.csv"))
+            self.futures.append(self.executor.submit(compute_batch, batch, self.descriptors, output))
+
+    def write(self, output: str, order: typing.Sequence[str] = None,
+              duplicates: typing.Dict[str, typing.List[str]] = None) -> typing.Dict[str, typing.Any]:
+        """Merge the partial tables in output with a header, the rows in the order of the ids in order.
+
+        Rows not in order go at the end sorted by id, the duplicates get a copy of the row of their
+        kept record. Returns the report of the stream, also logged.
+        """
+        results = [future.result() for future in self.futures]
+        offsets: typing.Dict[str, typing.Tuple[str, int]] = {}
+        for result in results:
+            with open(result["table"], "rb") as table:
+                position = 0
+                for line in table:
+                    offsets[line.split(b",", 1)[0].decode()] = (result["table"], position)
+                    position += len(line)
+        for record_id, copies in (duplicates or {}).items():
+            for copy in copies:
+                if record_id in offsets:
+                    offsets.setdefault(copy, offsets[record_id])
+        ordered = [record_id for record_id in dict.fromkeys(order or []) if record_id in offsets]
+        ordered += sorted(set(offsets) - set(ordered))
+        tables = {result["table"]: open(result["table"], "rb") for result in results}
+        try:
+            with open(output, "wb") as output_file:
+                output_file.write((",".join([""] + feature_names(self.descriptors)) + "\n").encode())
+                for record_id in ordered:
+                    table, position = offsets[record_id]
+                    tables[table].seek(position)
+                    values = tables[table].readline().split(b",", 1)[1]
+                    output_file.write(record_id.encode() + b"," + values)
+        finally:
+            for table in tables.values():
+                table.close()
+        # A file that failed while it was being written may have been read when it was queued again
+        failed = list(dict.fromkeys(path for result in results for path in result["failed"] if Path(path).stem not in offsets))
+        report = {"batches": len(results), "rows": len(ordered), "overlapped_files": self.overlapped,
+                  "requeued_files": self.requeued, "unreadable_files": len(failed)}
+        fu.log(f'Streamed the features of {report["rows"]} sequences in {report["batches"]} batches, '
+               f'{report["overlapped_files"]} pssm files queued while PSI-BLAST was running', self.out_log, self.global_log)
+        if failed:
+            fu.log(f'Could not read {len(failed)} pssm files: {failed[:10]}', self.out_log, self.global_log)
+        return report
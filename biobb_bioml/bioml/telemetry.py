@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""Module containing the per block telemetry records, their aggregation and the command line interface."""
+import argparse
+import datetime
+import json
+import os
+import threading
+import time
+import typing
+import uuid
+from pathlib import Path
+import psutil
+
+# Environment variable marking the processes started by the command of a block, so the blocks
+# running at the same time in this process are not counted in each other's records
+MARKER = "BIOBB_BIOML_RUN"
+
+
+class ProcessSampler(threading.Thread):
+    """Sample the resident memory, cpu time and io of the child processes of a block.
+
+    Only the children whose environment has the MARKER variable set to token are sampled, every
+    child when token is None. Processes starting and exiting between two samples are not seen.
+    """
+
+    def __init__(self, token: str = None, include_self: bool = False, interval: float = 0.2) -> None:
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.token = token
+        self.include_self = include_self
+        self._members: typing.Dict[int, bool] = {}
+        self.process = psutil.Process(os.getpid())
+        self.peak_rss = 0
+        # Largest single process, the footprint of one worker of a pool
+        self.peak_process_rss = 0
+        # Last values seen for every pid, the processes that already exited keep their last sample
+        self.cpu_seconds: typing.Dict[int, float] = {}
+        self.io_bytes: typing.Dict[int, typing.Tuple[int, int]] = {}
+        self._base = self._self_counters() if include_self else (0.0, 0, 0)
+        self._stop_event = threading.Event()
+
+    def _self_counters(self) -> typing.Tuple[float, int, int]:
+        cpu = self.process.cpu_times()
+        try:
+            io = self.process.io_counters()
+            return cpu.user + cpu.system, io.read_bytes, io.write_bytes
+        except (AttributeError, psutil.AccessDenied):
+            return cpu.user + cpu.system, 0, 0
+
+    def _is_member(self, proc: psutil.Process) -> bool:
+        if self.token is None:
+            return True
+        if proc.pid not in self._members:
+            try:
+                self._members[proc.pid] = proc.environ().get(MARKER) == self.token
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                return False
+        return self._members[proc.pid]
+
+    def sample(self) -> None:
+        processes = [proc for proc in self.process.children(recursive=True) if self._is_member(proc)]
+        if self.include_self:
+            processes.append(self.process)
+        rss = 0
+        for proc in processes:
+            try:
+                with proc.oneshot():
+                    process_rss = proc.memory_info().rss
+                    rss += process_rss
+                    self.peak_process_rss = max(self.peak_process_rss, process_rss)
+                    cpu = proc.cpu_times()
+                    self.cpu_seconds[proc.pid] = cpu.user + cpu.system
+                    if hasattr(proc, "io_counters"):
+                        io = proc.io_counters()
+                        self.io_bytes[proc.pid] = (io.read_bytes, io.write_bytes)
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self) -> typing.Dict[str, typing.Any]:
+        self.sample()
+        self._stop_event.set()
+        self.join()
+        cpu_seconds = sum(self.cpu_seconds.values())
+        read_bytes = sum(read for read, _ in self.io_bytes.values())
+        written_bytes = sum(written for _, written in self.io_bytes.values())
+        if self.include_self:
+            cpu_seconds -= self._base[0]
+            read_bytes -= self._base[1]
+            written_bytes -= self._base[2]
+        return {"peak_rss_mb": round(self.peak_rss / 2**20, 1), "peak_worker_rss_mb": round(self.peak_process_rss / 2**20, 1),
+                "cpu_seconds": round(cpu_seconds, 3),
+                "read_bytes": read_bytes, "written_bytes": written_bytes}
+
+
+class BlockTelemetry:
+    """Wall time of the phases of a block launch and the resources used by its child command."""
+
+    def __init__(self, biobb_object) -> None:
+        self.biobb_object = biobb_object
+        self.start = time.perf_counter()
+        self.phases: typing.Dict[str, float] = {}
+        self.current: typing.Optional[str] = None
+        self.current_start = self.start
+        self.sampler: typing.Optional[ProcessSampler] = None
+        self.resources: typing.Dict[str, typing.Any] = {}
+
+    def mark(self, phase: str) -> None:
+        """Close the running phase and start a new one, the command phase is sampled with psutil."""
+        now = time.perf_counter()
+        if self.current:
+            self.phases[self.current] = round(self.phases.get(self.current, 0.0) + now - self.current_start, 3)
+        if self.sampler:
+            self.resources = self.sampler.stop()
+            self.sampler = None
+        self.current, self.current_start = phase, now
+        if phase == "command":
+            # Blocks running in this process, like the in-process backend or Rerank, are sampled as well
+            in_process = getattr(self.biobb_object, "backend", None) == "inprocess" or not getattr(self.biobb_object, "cmd", None)
+            token = uuid.uuid4().hex
+            self.biobb_object.env_vars_dict = {**(getattr(self.biobb_object, "env_vars_dict", None) or {}), MARKER: token}
+            self.sampler = ProcessSampler(token=token, include_self=in_process)
+            self.sampler.start()
+
+    def record(self) -> typing.Dict[str, typing.Any]:
+        self.mark(None)
+        biobb_object = self.biobb_object
+        command_time = self.phases.get("command", 0.0)
+        record = {"block": type(biobb_object).__name__, "step": biobb_object.step,
+                  "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                  "host": {"cores": psutil.cpu_count(logical=False) or psutil.cpu_count(),
+                           "memory_mb": round(psutil.virtual_memory().total / 2**20)},
+                  "num_thread": getattr(biobb_object, "num_thread", None), "return_code": biobb_object.return_code,
+                  "wall_time": round(time.perf_counter() - self.start, 3), "phases": self.phases, **self.resources,
+                  "input_bytes": _sizes(biobb_object.io_dict["in"]), "output_bytes": _sizes(biobb_object.io_dict["out"]),
+                  "staging": getattr(biobb_object, "staging_report", None),
+                  "deduplication": getattr(biobb_object, "dedup_report", None),
+                  "streaming": getattr(biobb_object, "stream_report", None),
+                  "cascade": getattr(biobb_object, "cascade_report", None),
+                  "workload": getattr(biobb_object, "workload", None),
+                  "admission": getattr(biobb_object, "admission_report", None),
+                  "distillation": getattr(biobb_object, "distill_report", None)}
+        if command_time and "cpu_seconds" in record:
+            record["cpu_utilization"] = round(record["cpu_seconds"] / command_time, 2)
+        return record
+
+
+def _sizes(paths: typing.Dict[str, typing.Any]) -> typing.Dict[str, int]:
+    sizes = {}
+    for file_ref, file_path in paths.items():
+        if isinstance(file_path, str) and Path(file_path).is_file():
+            sizes[file_ref] = Path(file_path).stat().st_size
+        elif isinstance(file_path, str) and Path(file_path).is_dir():
+            sizes[file_ref] = sum(p.stat().st_size for p in Path(file_path).rglob("*") if p.is_file())
+    return sizes
+
+
+def mark(biobb_object, phase: str) -> None:
+    """Start a phase of the launch of a block, the first call starts its telemetry."""
+    if not getattr(biobb_object, "telemetry_dir", None):
+        return
+    if getattr(biobb_object, "block_telemetry", None) is None:
+        biobb_object.block_telemetry = BlockTelemetry(biobb_object)
+    biobb_object.block_telemetry.mark(phase)
+
+
+def write_record(biobb_object) -> typing.Optional[str]:
+    """Write the telemetry record of a finished launch to the telemetry_dir of the block."""
+    block_telemetry = getattr(biobb_object, "block_telemetry", None)
+    if block_telemetry is None:
+        return None
+    record = block_telemetry.record()
+    biobb_object.block_telemetry = None
+    Path(biobb_object.telemetry_dir).mkdir(parents=True, exist_ok=True)
+    name = f"{biobb_object.step or record['block'].lower()}_{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}.json"
+    record_path = str(Path(biobb_object.telemetry_dir).joinpath(name))
+    with open(record_path, "w") as record_file:
+        json.dump(record, record_file, indent=4)
+    return record_path
+
+
+def load_records(paths: typing.Iterable[str]) -> typing.List[typing.Dict[str, typing.Any]]:
+    """Read the records of the given files and of the json files inside the given directories."""
+    records = []
+    for path in paths:
+        files = sorted(Path(path).glob("*.json")) if Path(path).is_dir() else [Path(path)]
+        for file_path in files:
+            with open(file_path) as record_file:
+                records.append(json.load(record_file))
+    return records
+
+
+def aggregate(records: typing.List[typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.Any]:
+    """Merge the records of a workflow in a single report, the stages sorted from the hottest."""
+    stages = sorted(records, key=lambda record: record.get("wall_time", 0), reverse=True)
+    total = sum(record.get("wall_time", 0) for record in records)
+    phases: typing.Dict[str, float] = {}
+    for record in records:
+        for phase, seconds in record.get("phases", {}).items():
+            phases[phase] = round(phases.get(phase, 0.0) + seconds, 3)
+    return {"stages": len(records), "wall_time": round(total, 3), "phases": phases,
+            "cpu_seconds": round(sum(record.get("cpu_seconds", 0) for record in records), 3),
+            "peak_rss_mb": max((record.get("peak_rss_mb", 0) for record in records), default=0),
+            "hot_stage": stages[0].get("step") or stages[0].get("block") if stages else None,
+            "ranking": [{"stage": record.get("step") or record.get("block"), "block": record.get("block"),
+                         "wall_time": record.get("wall_time"),
+                         "share": round(record.get("wall_time", 0) / total, 3) if total else 0,
+                         "peak_rss_mb": record.get("peak_rss_mb"), "cpu_utilization": record.get("cpu_utilization")}
+                        for record in stages]}
+
+
+def main():
+    """Command line execution of the telemetry aggregator."""
+    parser = argparse.ArgumentParser(description="Merge the biobb_bioml telemetry records of a workflow in one report.",
+                                     formatter_class=lambda prog: argparse.RawTextHelpFormatter(prog, width=99999))
+    parser.add_argument('records', nargs='+', help="Telemetry record files or the telemetry_dir of the blocks")
+    parser.add_argument('-o', '--output', required=False, help="JSON file for the report, printed if not given")
+
+    args = parser.parse_args()
+    report = aggregate(load_records(args.records))
+    if args.output:
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == '__main__':
+    main()